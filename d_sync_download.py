@@ -3,10 +3,16 @@ Download script for d-sync
 Downloads encrypted/compressed files from Discord CDN and reconstructs them
 """
 
+import bisect
 import json
+import os
 import requests
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 import sys
 from datetime import datetime
 
@@ -15,8 +21,12 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from utils import (
     Logger, EncryptionManager, CompressionManager, HashManager,
-    FILES_JSON, MAX_PARTITION_SIZE, DOWNLOAD_LOG_FILE, BASE_DIR
+    FILES_JSON, FILES_JSON_UPLOAD_META, DOWNLOAD_LOG_FILE, BASE_DIR, LAYOUT_WHOLE, LAYOUT_STREAM, LAYOUT_PACK,
+    LAYOUT_CDC, LAYOUT_FRAMES, COMPRESSION_WORKERS, PACK_CACHE_SIZE, HttpTransport, get_transport, load_remote_manifest
 )
+from utils.manifest_codec import load_manifest
+from utils.compression import DEFAULT_CODEC
+from utils.encryption import FORMAT_FERNET
 from utils.webhook_refresh import WebhookMessageRefresh
 
 logger = Logger(__name__)
@@ -24,31 +34,70 @@ logger = Logger(__name__)
 # Download to d-synced2 for testing
 D_SYNCED2_DIR = BASE_DIR / "d-synced2"
 
+_decode_pool: Optional[ThreadPoolExecutor] = None
+_decode_pool_lock = threading.Lock()
+
+
+def get_decode_pool() -> ThreadPoolExecutor:
+    """Threads shared by every downloader for decrypting and decompressing chunks"""
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ThreadPoolExecutor(
+                max_workers=COMPRESSION_WORKERS, thread_name_prefix='d-sync-decode'
+            )
+        return _decode_pool
+
 
 class D_SyncDownload:
     """Main download manager for d-sync"""
 
-    def __init__(self):
+    def __init__(self, transport: Optional[HttpTransport] = None,
+                 files_metadata: Optional[Dict[str, Dict]] = None):
+        self.transport = transport or get_transport()
         self.encryption_manager = EncryptionManager()
         self.compression_manager = CompressionManager()
         self.files_metadata: Dict[str, Dict] = {}
-        self._load_files_metadata()
+        # Recently downloaded packs, so many files can be restored from one fetch
+        self._pack_cache: OrderedDict = OrderedDict()
+        if files_metadata is not None:
+            # Entries supplied by the caller, e.g. the web server reading the metadata store
+            self.files_metadata = files_metadata
+        else:
+            self._load_files_metadata()
 
     def _load_files_metadata(self):
         """Load files metadata from JSON"""
         if not FILES_JSON.exists():
+            if self._load_remote_manifest():
+                return
             logger.error(f"Files metadata not found: {FILES_JSON}")
             logger.info("You need to upload files first using d_sync_upload.py")
             return
 
         try:
-            with open(FILES_JSON, 'r') as f:
-                data = json.load(f)
-                self.files_metadata = data.get('files', {})
-                logger.info(f"Loaded metadata for {len(self.files_metadata)} files")
-        except json.JSONDecodeError as e:
+            # files.json may be plain JSON or the binary manifest encoding
+            self.files_metadata = load_manifest(FILES_JSON).get('files', {})
+            logger.info(f"Loaded metadata for {len(self.files_metadata)} files")
+        except (ValueError, zlib.error) as e:
             logger.error(f"Could not parse files.json: {e}")
 
+    def _load_remote_manifest(self) -> bool:
+        """Fall back to the remote manifest recorded by the uploader"""
+        try:
+            with open(FILES_JSON_UPLOAD_META, 'r') as f:
+                root_url = ((json.load(f).get('root') or {}).get('cdn_url'))
+        except (OSError, json.JSONDecodeError):
+            return False
+        if not root_url:
+            return False
+        files = load_remote_manifest(self.transport, root_url)
+        if files is None:
+            return False
+        self.files_metadata = files
+        logger.info(f"Loaded metadata for {len(self.files_metadata)} files from the remote manifest")
+        return True
+
     def _refresh_webhook_message(self, webhook_url: str, chunk_filename: str) -> Optional[str]:
         """
         Try to refresh a webhook message by getting recent messages
@@ -59,7 +108,7 @@ class D_SyncDownload:
             
             # Get webhook info to find channel ID
             webhook_info_url = f"https://discord.com/api/webhooks/{webhook_id}/{webhook_token}"
-            response = requests.get(webhook_info_url, timeout=10)
+            response = self.transport.get(webhook_info_url, timeout=10)
             response.raise_for_status()
             webhook_data = response.json()
             
@@ -81,7 +130,7 @@ class D_SyncDownload:
                        chunk_filename: Optional[str] = None) -> Optional[bytes]:
         """Download a chunk from Discord CDN with 404 fallback"""
         try:
-            response = requests.get(cdn_url, timeout=60)
+            response = self.transport.get(cdn_url)
             
             # Check for 404 - try webhook refresh
             if response.status_code == 404:
@@ -93,7 +142,7 @@ class D_SyncDownload:
                     
                     if new_url:
                         logger.info(f"Retrying with refreshed URL")
-                        response = requests.get(new_url, timeout=60)
+                        response = self.transport.get(new_url)
                 
                 if response.status_code == 404:
                     logger.error(f"File expired on Discord CDN: {chunk_filename}")
@@ -120,8 +169,12 @@ class D_SyncDownload:
         except Exception as e:
             logger.error(f"Error logging response: {e}")
 
-    def download_file(self, file_path: str) -> bool:
-        """Download and reconstruct a file"""
+    def download_file(self, file_path: str, version: Optional[int] = None) -> bool:
+        """Download and reconstruct a file.
+
+        version picks an earlier version from the entry's ``versions`` list
+        (0 is the one replaced most recently) instead of the current one.
+        """
         logger.info(f"Downloading file: {file_path}")
 
         if file_path not in self.files_metadata:
@@ -136,11 +189,26 @@ class D_SyncDownload:
                 logger.warning(f"File is marked as deleted: {file_path}")
                 return False
 
+            if version is not None:
+                versions = metadata.get('versions', [])
+                if not 0 <= version < len(versions):
+                    logger.error(f"{file_path} has no version {version} ({len(versions)} kept)")
+                    return False
+                metadata = {**versions[version], 'file_path': file_path}
+
             chunks = metadata.get('chunks', [])
             if not chunks:
                 logger.error(f"No chunks found for file: {file_path}")
                 return False
 
+            layout = metadata.get('layout', LAYOUT_WHOLE)
+            if layout == LAYOUT_STREAM:
+                return self._download_stream_file(file_path, metadata)
+            if layout == LAYOUT_PACK:
+                return self._download_packed_file(file_path, metadata)
+            if layout in (LAYOUT_CDC, LAYOUT_FRAMES):
+                return self._download_chunked_file(file_path, metadata)
+
             # Download all chunks
             downloaded_chunks = {}
             for chunk_info in chunks:
@@ -162,10 +230,7 @@ class D_SyncDownload:
                     return False
 
                 # Verify chunk hash
-                calculated_hash = HashManager.calculate_chunk_hash(chunk_data)
-                expected_hash = chunk_info.get('chunk_hash')
-
-                if calculated_hash != expected_hash:
+                if not HashManager.verify(chunk_data, chunk_info.get('chunk_hash', '')):
                     logger.error(
                         f"Chunk hash mismatch for {file_path} chunk {chunk_index}"
                     )
@@ -183,20 +248,22 @@ class D_SyncDownload:
             # Decrypt if encrypted
             if metadata.get('encrypted', False):
                 reconstructed_data = self.encryption_manager.decrypt_data(
-                    reconstructed_data
+                    reconstructed_data, metadata.get('encryption', FORMAT_FERNET)
                 )
                 logger.debug(f"Decrypted file: {file_path}")
 
             # Decompress if compressed
             if metadata.get('compressed', False):
                 reconstructed_data = self.compression_manager.decompress_data(
-                    reconstructed_data
+                    reconstructed_data, metadata.get('codec', DEFAULT_CODEC)
                 )
                 logger.debug(f"Decompressed file: {file_path}")
 
             # Verify file hash
-            file_hash = HashManager.calculate_data_hash(reconstructed_data)
-            expected_file_hash = metadata.get('file_hash')
+            expected_file_hash = metadata.get('file_hash', '')
+            file_hash = HashManager.calculate_data_hash(
+                reconstructed_data, HashManager.algorithm_of(expected_file_hash)
+            )
 
             if file_hash != expected_file_hash:
                 logger.error(f"File hash mismatch for {file_path}")
@@ -219,6 +286,276 @@ class D_SyncDownload:
             self._log_response(file_path, "ERROR", str(e))
             return False
 
+    def _fetch_chunk(self, file_path: str, chunk_info: Dict) -> Optional[bytes]:
+        """Download one chunk and check it against its recorded hash"""
+        chunk_index = chunk_info.get('chunk_index')
+        cdn_url = chunk_info.get('cdn_url')
+        if not cdn_url:
+            logger.error(f"No CDN URL for chunk {chunk_index}")
+            return None
+
+        chunk_filename = f"{file_path}_chunk_{chunk_index}.bin"
+        chunk_data = self._download_chunk(cdn_url, chunk_info.get('webhook_url'), chunk_filename)
+        if not chunk_data:
+            logger.error(f"Failed to download chunk {chunk_index}")
+            return None
+
+        if not HashManager.verify(chunk_data, chunk_info.get('chunk_hash', '')):
+            logger.error(f"Chunk hash mismatch for {file_path} chunk {chunk_index}")
+            return None
+        return chunk_data
+
+    def _iter_chunks_in_order(self, file_path: str, metadata: Dict) -> Iterator[Tuple[Dict, bytes]]:
+        """Yield (chunk_info, verified ciphertext) for each chunk in index order"""
+        chunks = sorted(metadata.get('chunks', []), key=lambda c: c.get('chunk_index'))
+        for expected_index, chunk_info in enumerate(chunks):
+            if chunk_info.get('chunk_index') != expected_index:
+                raise ValueError(f"Missing chunk {expected_index} for {file_path}")
+
+            chunk_data = self._fetch_chunk(file_path, chunk_info)
+            if chunk_data is None:
+                raise ValueError(f"Could not fetch chunk {expected_index} for {file_path}")
+            yield chunk_info, chunk_data
+
+    def _write_verified(self, file_path: str, metadata: Dict, pieces: Iterator[bytes]) -> bool:
+        """Write plaintext pieces to a temporary file and move it into place if the hash matches"""
+        expected_file_hash = metadata.get('file_hash', '')
+        file_hash = HashManager.hasher(HashManager.algorithm_of(expected_file_hash))
+        output_path = D_SYNCED2_DIR / file_path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output_path.with_name(output_path.name + '.part')
+
+        try:
+            with open(temp_path, 'wb') as out:
+                for piece in pieces:
+                    file_hash.update(piece)
+                    out.write(piece)
+
+            if file_hash.hexdigest() != expected_file_hash:
+                logger.error(f"File hash mismatch for {file_path}")
+                logger.error(f"Expected: {expected_file_hash}, Got: {file_hash.hexdigest()}")
+                return False
+
+            os.replace(temp_path, output_path)
+        except ValueError as e:
+            logger.error(str(e))
+            return False
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+        logger.info(f"Successfully downloaded and reconstructed: {file_path}")
+        self._log_response(file_path, "SUCCESS", "File downloaded and reconstructed")
+        return True
+
+    def _decode_chunk(self, file_path: str, metadata: Dict, chunk_info: Dict, chunk_data: bytes) -> bytes:
+        """Decrypt, decompress and verify one self-contained chunk"""
+        # Chunks that record their own encoding may come from another file
+        source = chunk_info if 'compressed' in chunk_info else metadata
+        if metadata.get('encrypted', False):
+            chunk_data = self.encryption_manager.decrypt_data(
+                chunk_data, source.get('encryption', FORMAT_FERNET)
+            )
+        if source.get('compressed', False):
+            chunk_data = self.compression_manager.decompress_data(
+                chunk_data, source.get('codec', DEFAULT_CODEC)
+            )
+
+        plain_hash = chunk_info.get('plain_hash')
+        if plain_hash and not HashManager.verify(chunk_data, plain_hash):
+            raise ValueError(
+                f"Content hash mismatch for {file_path} chunk {chunk_info.get('chunk_index')}"
+            )
+        if 'plain_size' in chunk_info and len(chunk_data) != chunk_info['plain_size']:
+            raise ValueError(f"Size mismatch for {file_path} chunk {chunk_info.get('chunk_index')}")
+        return chunk_data
+
+    @staticmethod
+    def _check_merkle_root(file_path: str, metadata: Dict) -> bool:
+        """Whether the chunk list matches the file's Merkle root (entries without one pass).
+
+        Run before any download, so a damaged or altered chunk list is caught
+        up front; each chunk is then checked against its own hash as it arrives.
+        """
+        expected = metadata.get('merkle_root')
+        if not expected:
+            return True
+        chunks = sorted(metadata.get('chunks', []), key=lambda c: c.get('chunk_index'))
+        if all(chunk.get('plain_hash') for chunk in chunks) and \
+                HashManager.merkle_root([chunk['plain_hash'] for chunk in chunks]) == expected:
+            return True
+        logger.error(f"Chunk list of {file_path} does not match its Merkle root")
+        return False
+
+    def _download_chunked_file(self, file_path: str, metadata: Dict) -> bool:
+        """Restore a file made of self-contained chunks (compressed and encrypted on their own).
+
+        Chunks are decoded on the shared decode pool while later ones download,
+        and written in order.
+        """
+        if not self._check_merkle_root(file_path, metadata):
+            return False
+        pool = get_decode_pool()
+
+        def pieces():
+            window = deque()
+            for chunk_info, chunk_data in self._iter_chunks_in_order(file_path, metadata):
+                window.append(pool.submit(self._decode_chunk, file_path, metadata, chunk_info, chunk_data))
+                if len(window) > COMPRESSION_WORKERS:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+
+        return self._write_verified(file_path, metadata, pieces())
+
+    def _stream_pieces(self, file_path: str, metadata: Dict) -> Iterator[bytes]:
+        """Plaintext of a streamed file, one partition at a time"""
+        decompressor = (
+            self.compression_manager.decompressor(metadata.get('codec', DEFAULT_CODEC))
+            if metadata.get('compressed', False) else None
+        )
+        for _, chunk_data in self._iter_chunks_in_order(file_path, metadata):
+            if metadata.get('encrypted', False):
+                chunk_data = self.encryption_manager.decrypt_data(
+                    chunk_data, metadata.get('encryption', FORMAT_FERNET)
+                )
+            yield decompressor.decompress(chunk_data) if decompressor else chunk_data
+        if decompressor:
+            yield decompressor.flush()
+
+    def _download_stream_file(self, file_path: str, metadata: Dict) -> bool:
+        """Restore a streamed file one partition at a time.
+
+        Each partition is verified, decrypted and fed to an incremental
+        decompressor, so memory use does not grow with file size.
+        """
+        return self._write_verified(file_path, metadata, self._stream_pieces(file_path, metadata))
+
+    @staticmethod
+    def _chunk_spans(metadata: Dict) -> Optional[List[Tuple[int, int, Dict]]]:
+        """(plaintext start, end, chunk) per chunk of a self-contained layout, else None"""
+        if metadata.get('layout', LAYOUT_WHOLE) not in (LAYOUT_CDC, LAYOUT_FRAMES):
+            return None
+        spans = []
+        offset = 0
+        for chunk_info in sorted(metadata.get('chunks', []), key=lambda c: c.get('chunk_index')):
+            if 'plain_size' not in chunk_info:
+                return None
+            start = chunk_info.get('plain_offset', offset)
+            offset = start + chunk_info['plain_size']
+            spans.append((start, offset, chunk_info))
+        return spans
+
+    def read_range(self, file_path: str, start: int, length: int) -> Optional[bytes]:
+        """Plaintext bytes [start, start + length) of a file, or None on failure.
+
+        For frames and cdc files only the chunks covering the range are
+        fetched and decoded, in parallel. Streamed files are decoded from the
+        start until the range is covered; other layouts are not supported.
+        Each chunk is verified by its hash, but the whole-file hash cannot be.
+        """
+        metadata = self.files_metadata.get(file_path)
+        if metadata is None or metadata.get('deleted', False):
+            logger.error(f"File not available for range read: {file_path}")
+            return None
+        end = min(start + length, metadata.get('file_size', 0))
+        if start >= end:
+            return b''
+
+        try:
+            spans = self._chunk_spans(metadata)
+            if spans is not None:
+                if not self._check_merkle_root(file_path, metadata):
+                    return None
+                first = max(0, bisect.bisect_right([span[0] for span in spans], start) - 1)
+                covering = [span for span in spans[first:] if span[0] < end and span[1] > start]
+
+                def fetch(chunk_info: Dict) -> bytes:
+                    chunk_data = self._fetch_chunk(file_path, chunk_info)
+                    if chunk_data is None:
+                        raise ValueError(f"Could not fetch chunk {chunk_info.get('chunk_index')} for {file_path}")
+                    return self._decode_chunk(file_path, metadata, chunk_info, chunk_data)
+
+                pool = get_decode_pool()
+                futures = [pool.submit(fetch, chunk_info) for _, _, chunk_info in covering]
+                out = bytearray()
+                for (chunk_start, _, _), future in zip(covering, futures):
+                    plain = future.result()
+                    out += plain[max(0, start - chunk_start):end - chunk_start]
+                return bytes(out)
+
+            if metadata.get('layout', LAYOUT_WHOLE) == LAYOUT_STREAM:
+                out = bytearray()
+                position = 0
+                for piece in self._stream_pieces(file_path, metadata):
+                    if position + len(piece) > start:
+                        out += piece[max(0, start - position):end - position]
+                    position += len(piece)
+                    if position >= end:
+                        break
+                return bytes(out)
+        except Exception as e:
+            logger.error(f"Range read failed for {file_path}: {e}")
+            return None
+
+        logger.error(f"Range reads are not supported for the {metadata.get('layout', LAYOUT_WHOLE)} layout")
+        return None
+
+    def _get_pack(self, pack_id: str, chunk_info: Dict, file_path: str) -> Optional[bytes]:
+        """Return a pack's bytes, downloading and verifying it on a cache miss"""
+        if pack_id in self._pack_cache:
+            self._pack_cache.move_to_end(pack_id)
+            return self._pack_cache[pack_id]
+
+        cdn_url = chunk_info.get('cdn_url')
+        if not cdn_url:
+            logger.error(f"No CDN URL for pack {pack_id}")
+            return None
+
+        pack_data = self._download_chunk(cdn_url, chunk_info.get('webhook_url'), f"pack_{pack_id}.bin")
+        if not pack_data:
+            logger.error(f"Failed to download pack {pack_id} for {file_path}")
+            return None
+        if not HashManager.verify(pack_data, chunk_info.get('chunk_hash', '')):
+            logger.error(f"Pack hash mismatch for pack {pack_id}")
+            return None
+
+        self._pack_cache[pack_id] = pack_data
+        while len(self._pack_cache) > PACK_CACHE_SIZE:
+            self._pack_cache.popitem(last=False)
+        return pack_data
+
+    def _download_packed_file(self, file_path: str, metadata: Dict) -> bool:
+        """Restore a file stored inside a shared pack"""
+        pack = metadata.get('pack') or {}
+        pack_data = self._get_pack(pack.get('pack_id'), metadata['chunks'][0], file_path)
+        if pack_data is None:
+            return False
+
+        offset, length = pack.get('offset', 0), pack.get('length', 0)
+        data = pack_data[offset:offset + length]
+        if len(data) != length:
+            logger.error(f"Pack {pack.get('pack_id')} is too short for {file_path}")
+            return False
+
+        if metadata.get('encrypted', False):
+            data = self.encryption_manager.decrypt_data(data, metadata.get('encryption', FORMAT_FERNET))
+        if metadata.get('compressed', False):
+            data = self.compression_manager.decompress_data(data, metadata.get('codec', DEFAULT_CODEC))
+
+        if not HashManager.verify(data, metadata.get('file_hash', '')):
+            logger.error(f"File hash mismatch for {file_path}")
+            return False
+
+        output_path = D_SYNCED2_DIR / file_path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'wb') as f:
+            f.write(data)
+
+        logger.info(f"Successfully downloaded and reconstructed: {file_path}")
+        self._log_response(file_path, "SUCCESS", "File restored from pack")
+        return True
+
     def download_all_files(self) -> int:
         """Download all files from metadata"""
         logger.info("Starting download of all files")
@@ -227,8 +564,14 @@ class D_SyncDownload:
             logger.warning("No files in metadata")
             return 0
 
+        # Restore files that share a pack back to back so each pack is fetched once
+        ordered = sorted(
+            self.files_metadata.keys(),
+            key=lambda path: (self.files_metadata[path].get('pack') or {}).get('pack_id', '')
+        )
+
         success_count = 0
-        for file_path in self.files_metadata.keys():
+        for file_path in ordered:
             # Skip deleted files
             if self.files_metadata[file_path].get('deleted', False):
                 logger.info(f"Skipping deleted file: {file_path}")
@@ -238,6 +581,7 @@ class D_SyncDownload:
                 success_count += 1
 
         logger.info(f"Downloaded {success_count}/{len(self.files_metadata)} files")
+        self.transport.log_stats()
         return success_count
 
     def download_specific_file(self, file_path: str) -> bool:
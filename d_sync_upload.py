@@ -3,11 +3,15 @@ Main upload script for d-sync
 Monitors d-synced folder and uploads files to Discord
 """
 
+import io
 import json
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 import sys
 import os
 
@@ -16,9 +20,15 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from utils import (
     Logger, EncryptionManager, CompressionManager, HashManager,
-    WebhookManager, D_SYNCED_DIR, FILES_JSON, FOLDERS_JSON,
-    MAX_PARTITION_SIZE, UPLOAD_LOG_FILE, FILES_JSON_UPLOAD_META
+    WebhookManager, UploadPool, UploadPriorities, AttachmentBatcher, PackBuilder, ContentDefinedChunker,
+    ChunkIndex, StatCache, FolderStats, MetadataStore, ManifestSync, ShardedManifest, InotifyWatcher, when_all, then, D_SYNCED_DIR, FILES_JSON, FOLDERS_JSON,
+    UPLOAD_LOG_FILE, CHUNK_SIZE, HASH_ALGORITHM,
+    LAYOUT_STREAM, LAYOUT_PACK, LAYOUT_CDC, LAYOUT_FRAMES, FRAME_SIZE, FRAME_LAYOUT_THRESHOLD,
+    COMPRESSION_WORKERS, STREAM_SEGMENT_SIZE, CHUNKING_MODE, UPLOAD_CONCURRENCY, FILE_UPLOAD_CONCURRENCY,
+    FILE_VERSIONS_KEPT,
+    BATCH_ATTACHMENT_THRESHOLD, PACK_SMALL_FILES, PACK_FILE_THRESHOLD, WATCH_MODE
 )
+from utils.hashing import Hasher
 
 logger = Logger(__name__)
 
@@ -26,22 +36,30 @@ logger = Logger(__name__)
 class FileMetadata:
     """Represents metadata for a file"""
 
-    def __init__(self, file_path: Path, compressed: bool = False, encrypted: bool = False):
+    def __init__(self, file_path: Path, compressed: bool = False, encrypted: bool = False,
+                 layout: str = LAYOUT_STREAM, file_hash: Optional[str] = None,
+                 codec: Optional[str] = None, encryption: Optional[str] = None):
         self.file_path = file_path
         self.relative_path = file_path.relative_to(D_SYNCED_DIR)
-        self.file_hash = HashManager.calculate_file_hash(file_path)
-        self.file_size = file_path.stat().st_size
-        self.date_created = datetime.fromtimestamp(
-            file_path.stat().st_ctime
-        ).isoformat()
+        # Stat before reading so a concurrent edit is caught by the next scan
+        self.stat_ns = time.time_ns()
+        self.stat = file_path.stat()
+        self.file_hash = file_hash  # None until the upload pass has read the file
+        self.merkle_root = None  # Over the chunks' plaintext hashes, for self-contained chunks
+        self.file_size = self.stat.st_size
+        self.date_created = datetime.fromtimestamp(self.stat.st_ctime).isoformat()
         self.file_type = file_path.suffix
         self.compressed = compressed
+        self.codec = codec if compressed else None  # Compression codec id, see utils.compression_codecs
         self.encrypted = encrypted
+        self.encryption = encryption if encrypted else None  # Encryption format id, see utils.encryption
+        self.layout = layout
+        self.pack = None  # {pack_id, offset, length} for packed files
         self.chunks = []  # List of {chunk_index, hash, cdn_url}
         self.deleted = False
 
     def to_dict(self):
-        return {
+        data = {
             'file_path': str(self.relative_path),
             'file_hash': self.file_hash,
             'file_size': self.file_size,
@@ -49,22 +67,33 @@ class FileMetadata:
             'file_type': self.file_type,
             'compressed': self.compressed,
             'encrypted': self.encrypted,
+            'layout': self.layout,
             'chunks': self.chunks,
             'deleted': self.deleted
         }
+        if self.codec:
+            data['codec'] = self.codec
+        if self.encryption:
+            data['encryption'] = self.encryption
+        if self.pack:
+            data['pack'] = self.pack
+        if self.merkle_root:
+            data['merkle_root'] = self.merkle_root
+        return data
 
 
 class FolderMetadata:
     """Represents metadata for a folder"""
 
-    def __init__(self, folder_path: Path):
+    def __init__(self, folder_path: Path, file_count: int = 0, folder_count: int = 0):
         self.folder_path = folder_path
         self.relative_path = folder_path.relative_to(D_SYNCED_DIR)
         self.date_created = datetime.fromtimestamp(
             folder_path.stat().st_ctime
         ).isoformat()
-        self.file_count = sum(1 for _ in folder_path.rglob('*') if _.is_file())
-        self.folder_count = sum(1 for _ in folder_path.rglob('*') if _.is_dir())
+        # Counted from the scanner's listings, so hidden and metadata files are excluded
+        self.file_count = file_count
+        self.folder_count = folder_count
         self.cdn_url = None
 
     def to_dict(self):
@@ -80,277 +109,883 @@ class FolderMetadata:
 class D_SyncUpload:
     """Main upload manager for d-sync"""
 
-    def __init__(self):
+    def __init__(self, upload_concurrency: int = UPLOAD_CONCURRENCY,
+                 file_concurrency: int = FILE_UPLOAD_CONCURRENCY):
         self.webhook_manager = WebhookManager()
         self.encryption_manager = EncryptionManager()
         self.compression_manager = CompressionManager()
+        # Frames of large files are compressed on every core
+        self.compression_pool = ThreadPoolExecutor(
+            max_workers=COMPRESSION_WORKERS, thread_name_prefix='d-sync-compress'
+        )
+        # Frames read ahead per file; files in parallel share the workers
+        self._frame_window = max(2, COMPRESSION_WORKERS // max(1, int(file_concurrency)) + 1)
+        # Chunk uploads are scheduled by the priority class of their file
+        self.priorities = UploadPriorities()
+        self.upload_pool = UploadPool(upload_concurrency, self.priorities.weights())
+        self.batcher = AttachmentBatcher(
+            self.webhook_manager, self.upload_pool,
+            on_response=lambda names, response: self._log_response(', '.join(names), response)
+        )
+        self.packer = PackBuilder(self._upload_blob)
+        self.pack_small_files = PACK_SMALL_FILES
+        self.chunking_mode = CHUNKING_MODE
+        self.chunker = ContentDefinedChunker()
+        # Self-contained chunks already stored, keyed by plaintext hash
+        self.chunk_index = ChunkIndex()
+        self._chunk_uploads: Dict[str, Future] = {}  # plain_hash -> in-flight upload
+        self.hash_algorithm = HASH_ALGORITHM
+        self._chunk_lock = threading.Lock()
+        # file_hash -> relative path of an entry whose chunks hold that content
+        self.files_by_hash: Dict[str, str] = {}
+        # file_hash -> (path, future) of the first upload of that content still in
+        # flight; the future resolves to the path once recorded, or None on failure
+        self._file_uploads: Dict[str, Tuple[str, Future]] = {}
+        self.stats = {
+            'chunks_uploaded': 0, 'bytes_uploaded': 0,
+            'chunks_deduplicated': 0, 'bytes_deduplicated': 0,
+            'files_deduplicated': 0, 'files_renamed': 0, 'files_updated': 0,
+        }
+        self._stats_lock = threading.Lock()
+        self.file_concurrency = max(1, int(file_concurrency))
         self.files_metadata: Dict[str, Dict] = {}
         self.folders_metadata: Dict[str, Dict] = {}
         self.tracked_files = set()
+        # Guards files_metadata/tracked_files and the metadata files on disk
+        self._metadata_lock = threading.RLock()
+        self._log_lock = threading.Lock()
+        # Files and folders whose uploads are queued but not finished
+        self._in_progress = set()
+        self._uploads_pending = 0
+        self._uploads_cond = threading.Condition()
+        self.store = MetadataStore()
+        # files.json is exported and its changed shards pushed in the background, coalescing changes
+        self.remote_manifest = ShardedManifest(self.webhook_manager)
+        self.manifest_sync = ManifestSync(self._sync_files_metadata)
+        self._store_synced_at = time.time()
+        self._folders_changed = False
+        self.stat_cache = StatCache()
+        self.folder_stats = FolderStats()
+        self.folder_stats.rebuild(self.stat_cache.dirs)
+        # Paths that left the tree; forgotten once moves have had a chance to match
+        self._vanished: List[str] = []
         self._load_existing_metadata()
+        for relative_path, file_metadata in self.files_metadata.items():
+            self._index_entry(relative_path, file_metadata)
+        self._resume_journal()
+        # The first sync checks every shard against the last upload and sends only differences
+        self.remote_manifest.touch(self.files_metadata)
+        self.manifest_sync.mark_dirty()
 
     def _load_existing_metadata(self):
-        """Load existing metadata from JSON files"""
-        if FILES_JSON.exists():
-            try:
-                with open(FILES_JSON, 'r') as f:
-                    data = json.load(f)
-                    self.files_metadata = data.get('files', {})
-                    logger.info("Loaded existing files metadata")
-            except json.JSONDecodeError:
-                logger.warning("Could not parse files.json, starting fresh")
-
-        if FOLDERS_JSON.exists():
-            try:
-                with open(FOLDERS_JSON, 'r') as f:
-                    data = json.load(f)
-                    self.folders_metadata = data.get('folders', {})
-                    logger.info("Loaded existing folders metadata")
-            except json.JSONDecodeError:
-                logger.warning("Could not parse folders.json, starting fresh")
-
-    def _save_files_metadata(self):
-        """Save files metadata to JSON"""
-        metadata = {
-            'last_updated': datetime.now().isoformat(),
-            'files': self.files_metadata
+        """Load existing metadata from the store (files.json/folders.json are imported on first run)"""
+        self.files_metadata = self.store.all_files()
+        self.folders_metadata = self.store.all_folders()
+        logger.info(
+            f"Loaded metadata for {len(self.files_metadata)} files and {len(self.folders_metadata)} folders"
+        )
+
+    def _merge_external_changes(self):
+        """Pick up entries other processes (e.g. the web server) changed since the last check"""
+        since, self._store_synced_at = self._store_synced_at, time.time()
+        # The overlap covers clock granularity; our own writes compare equal and are skipped
+        changed = self.store.files_changed_since(since - 1.0)
+        with self._metadata_lock:
+            external = {
+                path: entry for path, entry in changed.items()
+                if self.files_metadata.get(path) != entry
+            }
+            self.files_metadata.update(external)
+        if external:
+            self.remote_manifest.touch(external)
+            logger.info(f"Picked up {len(external)} metadata changes made by other processes")
+            self.manifest_sync.mark_dirty()
+
+    def _resume_journal(self):
+        """Reuse chunks an interrupted run uploaded, so unfinished files resume where they stopped"""
+        journal = self.store.journal_entries()
+        settled = [plain_hash for plain_hash in journal if self.chunk_index.get(plain_hash)]
+        if settled:
+            self.store.settle_journal(settled)
+        resumable = {plain_hash: entry for plain_hash, entry in journal.items() if plain_hash not in settled}
+        for plain_hash, entry in resumable.items():
+            self.chunk_index.add(plain_hash, entry['chunk'])
+        if resumable:
+            logger.info(
+                f"Upload journal: {len(resumable)} chunks "
+                f"({sum(e['chunk'].get('plain_size', 0) for e in resumable.values())} bytes) "
+                f"of {len({e['path'] for e in resumable.values()})} unfinished files will not be sent again"
+            )
+
+    def _report_journal(self):
+        """Log journaled chunks no file references; see python -m utils.metadata_store journal"""
+        with self._metadata_lock:
+            active = set(self._in_progress)
+        orphans = self.store.orphaned_journal(active)
+        if orphans:
+            logger.warning(
+                f"{len(orphans)} uploaded chunks "
+                f"({sum(e['chunk'].get('plain_size', 0) for e in orphans.values())} bytes) belong to "
+                f"interrupted uploads of files that have since changed or gone; list them with "
+                f"'python -m utils.metadata_store journal'"
+            )
+
+    def _index_entry(self, relative_path: str, entry: Dict):
+        """Make a stored entry's content reusable by later files"""
+        if entry.get('chunks') and entry.get('file_hash'):
+            self.files_by_hash.setdefault(entry['file_hash'], relative_path)
+        self.chunk_index.index_file(entry)
+
+    def _record_file(self, relative_path: str, entry: Dict, metadata: Optional[FileMetadata] = None,
+                     changed: Optional[Dict[str, Dict]] = None):
+        """Store a finished file entry, plus any other entries it changed, in one transaction.
+
+        An entry replacing a live one with different content keeps the old
+        one as its newest version.
+        """
+        with self._metadata_lock:
+            previous = self.files_metadata.get(relative_path)
+            if previous is not None and not previous.get('deleted'):
+                entry['versions'] = previous.get('versions', [])
+                if previous.get('file_hash') != entry.get('file_hash'):
+                    self._add_version(relative_path, entry, previous)
+            self.files_metadata[relative_path] = entry
+            self._index_entry(relative_path, entry)
+            written = {**(changed or {}), relative_path: entry}
+            self.store.put_files(written)
+            plain_hashes = [chunk['plain_hash'] for chunk in entry.get('chunks', []) if chunk.get('plain_hash')]
+            if plain_hashes:
+                self.store.settle_journal(plain_hashes)
+            self.remote_manifest.touch(written)
+            self.manifest_sync.mark_dirty()
+            self.tracked_files.add(relative_path)
+        if metadata is not None:
+            self.stat_cache.record_file(relative_path, metadata.stat, metadata.stat_ns)
+
+    def _add_version(self, relative_path: str, entry: Dict, previous: Dict):
+        """Keep a replaced entry's contents as the newest of the entry's versions"""
+        version = {
+            key: value for key, value in previous.items()
+            if key not in ('file_path', 'versions', 'deleted', 'renamed_to')
         }
-        FILES_JSON.parent.mkdir(parents=True, exist_ok=True)
-        with open(FILES_JSON, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        logger.info(f"Saved files metadata to {FILES_JSON}")
-        # Attempt to upload or update files.json on remote storage
+        version['replaced_at'] = datetime.now().isoformat()
+        entry['versions'] = [version] + entry['versions'][:FILE_VERSIONS_KEPT - 1] if FILE_VERSIONS_KEPT > 0 else []
+
+        old_chunks = {chunk.get('plain_hash') for chunk in previous.get('chunks', [])} - {None}
+        reused = sum(1 for chunk in entry.get('chunks', []) if chunk.get('plain_hash') in old_chunks)
+        self._count('files_updated', 1)
+        logger.info(
+            f"Updated {relative_path}: {len(entry.get('chunks', [])) - reused} chunks new, "
+            f"{reused} reused from the previous version"
+        )
+
+    def _sync_files_metadata(self) -> Optional[int]:
+        """Export files.json from the metadata store and push changed manifest shards.
+
+        Runs on the manifest sync thread; returns bytes sent or None on failure.
+        """
+        count = self.store.export_files_json(FILES_JSON)
+        logger.info(f"Exported metadata for {count} files to {FILES_JSON}")
         try:
-            self._ensure_files_json_remote()
+            return self.remote_manifest.sync(self._entries_for)
         except Exception as e:
-            logger.debug(f"Could not ensure remote files.json: {e}")
+            logger.debug(f"Could not sync remote manifest: {e}")
+            return None
+
+    def _entries_for(self, paths) -> Dict[str, Dict]:
+        """Current entries for the given paths, for building manifest shards"""
+        with self._metadata_lock:
+            return {path: dict(self.files_metadata[path]) for path in paths if path in self.files_metadata}
+
+    def _save_folders_metadata(self):
+        """Export folders.json from the metadata store if any folder changed"""
+        with self._metadata_lock:
+            if not self._folders_changed:
+                return
+            self._folders_changed = False
+            count = self.store.export_folders_json(FOLDERS_JSON)
+        logger.info(f"Exported metadata for {count} folders to {FOLDERS_JSON}")
+
+    def _iter_partitions(self, stream: BinaryIO, codec: Optional[str]) -> Iterator[bytes]:
+        """Read, compress and encrypt a stream incrementally, yielding partitions.
 
-    def _ensure_files_json_remote(self):
-        """Upload files.json once and PATCH the remote message on updates.
-        Stores remote info in `FILES_JSON_UPLOAD_META`.
+        The compressed stream is cut into STREAM_SEGMENT_SIZE segments and each
+        segment is encrypted on its own, so memory use is bounded by one segment
+        regardless of file size.
         """
-        # Choose a webhook to use
-        webhook_url = self.webhook_manager.get_random_webhook()
-        if not webhook_url:
-            logger.warning("No webhook available to upload files.json")
-            return
+        compressor = self.compression_manager.compressor(codec) if codec else None
+        buffer = bytearray()
+        emitted = 0
 
-        # Read local files.json bytes
-        try:
-            with open(FILES_JSON, 'rb') as f:
-                data_bytes = f.read()
-        except Exception as e:
-            logger.error(f"Failed to read {FILES_JSON} for remote upload: {e}")
-            return
+        for block in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            buffer += compressor.compress(block) if compressor else block
+            while len(buffer) >= STREAM_SEGMENT_SIZE:
+                segment = bytes(buffer[:STREAM_SEGMENT_SIZE])
+                del buffer[:STREAM_SEGMENT_SIZE]
+                emitted += 1
+                yield self.encryption_manager.encrypt_data(segment)
+
+        if compressor:
+            buffer += compressor.flush()
+        # Always emit at least one partition so empty files still get a chunk
+        if buffer or emitted == 0:
+            yield self.encryption_manager.encrypt_data(bytes(buffer))
+
+    def _encode_chunk(self, plain: bytes, codec: Optional[str]) -> Tuple[bytes, Dict]:
+        """Compress (where it pays off) and encrypt one self-contained chunk.
+
+        Returns (stored bytes, stored fields). Runs on the compression pool.
+        """
+        data, compressed = (
+            self.compression_manager.compress_chunk(plain, codec) if codec else (plain, False)
+        )
+        fields = {'compressed': compressed, 'encryption': self.encryption_manager.scheme}
+        if compressed:
+            fields['codec'] = codec
+        return self.encryption_manager.encrypt_data(data), fields
 
-        prev_meta = None
-        if FILES_JSON_UPLOAD_META.exists():
+    def _queue_chunks(self, relative_path: str, chunks: Iterable[bytes], codec: Optional[str],
+                      hasher: Hasher, failed: threading.Event, pending: list, priority: Optional[str] = None):
+        """Hash, deduplicate and queue self-contained chunks in a single read pass.
+
+        Each chunk's plaintext feeds the file hash and is looked up by its own
+        hash; new chunks are compressed and encrypted on the compression pool a
+        few ahead and uploaded in order. Appends (chunk_index, future, extra
+        fields) to pending.
+        """
+        window = deque()  # (chunk_index, plain_hash, size, encoding future, extra)
+
+        def upload_next():
+            chunk_index, plain_hash, size, encoding, extra = window.popleft()
             try:
-                with open(FILES_JSON_UPLOAD_META, 'r') as mf:
-                    prev_meta = json.load(mf)
+                data, fields = encoding.result()
             except Exception:
-                prev_meta = None
-
-        # If we have previous meta, try to PATCH the message first
-        if prev_meta:
-            prev_webhook = prev_meta.get('webhook_url')
-            prev_msg_id = prev_meta.get('message_id')
-            if prev_webhook and prev_msg_id:
-                logger.info(f"Attempting to PATCH existing files.json message {prev_msg_id}")
-                resp = self.webhook_manager.patch_message(prev_webhook, prev_msg_id, data=data_bytes, filename='files.json')
-                if resp:
-                    # Update meta
-                    new_meta = {
-                        'webhook_url': prev_webhook,
-                        'message_id': resp.get('id'),
-                        'cdn_url': self.webhook_manager.extract_cdn_url(resp),
-                        'last_updated': datetime.now().isoformat()
-                    }
-                    with open(FILES_JSON_UPLOAD_META, 'w') as mf:
-                        json.dump(new_meta, mf, indent=2)
-                    logger.info("Patched remote files.json message successfully")
-                    return
-                else:
-                    logger.info("Patching files.json failed; will upload a new message")
-
-        # Upload a new message with files.json
-        logger.info("Uploading files.json to remote storage")
-        resp = self.webhook_manager.upload_bytes(webhook_url, data_bytes, 'files.json')
-        if resp:
-            msg_id = resp.get('id')
-            cdn = self.webhook_manager.extract_cdn_url(resp)
-            new_meta = {
-                'webhook_url': webhook_url,
-                'message_id': msg_id,
-                'cdn_url': cdn,
-                'last_updated': datetime.now().isoformat()
-            }
-            with open(FILES_JSON_UPLOAD_META, 'w') as mf:
-                json.dump(new_meta, mf, indent=2)
-            logger.info(f"Uploaded files.json as message {msg_id}")
-            # If there was a previous message, try to delete it for cleanup
-            if prev_meta and prev_meta.get('webhook_url') and prev_meta.get('message_id'):
-                try:
-                    self.webhook_manager.delete_message(prev_meta.get('webhook_url'), prev_meta.get('message_id'))
-                    logger.info(f"Deleted previous files.json message {prev_meta.get('message_id')}")
-                except Exception:
-                    logger.debug("Failed to delete previous files.json message")
-        else:
-            logger.error("Failed to upload files.json to remote storage")
+                self._release_chunk(plain_hash)
+                raise
+            pending.append((
+                chunk_index, self._store_chunk(relative_path, plain_hash, size, data, fields, failed, priority),
+                extra
+            ))
 
-    def _save_folders_metadata(self):
-        """Save folders metadata to JSON"""
-        metadata = {
-            'last_updated': datetime.now().isoformat(),
-            'folders': self.folders_metadata
-        }
-        FOLDERS_JSON.parent.mkdir(parents=True, exist_ok=True)
-        with open(FOLDERS_JSON, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        logger.info(f"Saved folders metadata to {FOLDERS_JSON}")
-
-    def _partition_file(self, file_data: bytes) -> List[bytes]:
-        """Partition file data into chunks of MAX_PARTITION_SIZE"""
-        chunks = []
-        for i in range(0, len(file_data), int(MAX_PARTITION_SIZE)):
-            chunk = file_data[i:i + int(MAX_PARTITION_SIZE)]
-            chunks.append(chunk)
-        logger.debug(f"Partitioned data into {len(chunks)} chunks")
-        return chunks
-
-    def _process_file(self, file_path: Path) -> bool:
-        """Process and upload a single file"""
+        offset = 0
+        try:
+            for chunk_index, plain in enumerate(chunks):
+                if failed.is_set():
+                    break
+                hasher.update(plain)
+                plain_hash = HashManager.calculate_chunk_hash(plain, self.hash_algorithm)
+                extra = {'plain_hash': plain_hash, 'plain_offset': offset, 'plain_size': len(plain)}
+                offset += len(plain)
+
+                future, claimed = self._claim_chunk(plain_hash, len(plain))
+                if not claimed:
+                    pending.append((chunk_index, future, extra))
+                    continue
+                window.append((
+                    chunk_index, plain_hash, len(plain),
+                    self.compression_pool.submit(self._encode_chunk, plain, codec), extra
+                ))
+                if len(window) >= self._frame_window:
+                    upload_next()
+            while window:
+                upload_next()
+        finally:
+            # Only left over after an error; waiting files must not hang on these
+            for _, plain_hash, _, _, _ in window:
+                self._release_chunk(plain_hash)
+        pending.sort(key=lambda item: item[0])
+
+    def _process_file(self, file_path: Path, source: str = 'scan') -> bool:
+        """Queue a single file for upload.
+
+        Returns once every chunk has been handed to the upload pool or the
+        attachment batcher; the file's metadata is saved when its last chunk lands.
+        source ("scan" or "watch") feeds the file's priority class, unless
+        the web server asked for the upload.
+        """
         logger.info(f"Processing file: {file_path}")
+        relative_path = str(file_path.relative_to(D_SYNCED_DIR))
 
-        try:
-            # Check if already uploaded
-            relative_path = str(file_path.relative_to(D_SYNCED_DIR))
-            if relative_path in self.files_metadata:
+        with self._metadata_lock:
+            # A tracked file is uploaded again only if it changed since it was synced
+            previous = self.files_metadata.get(relative_path)
+            if previous is not None and self._unmodified(relative_path, previous, file_path.stat()):
                 logger.info(f"File already tracked: {relative_path}")
+                self.stat_cache.record_file(relative_path, file_path.stat())
                 return True
+            if relative_path in self._in_progress:
+                logger.debug(f"File upload already in progress: {relative_path}")
+                return True
+            self._in_progress.add(relative_path)
 
-            # Read file data
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-
-            # Compress if enabled
-            compressed = False
-            if len(file_data) > 1024 * 100:  # Compress files > 100KB
-                file_data = self.compression_manager.compress_data(file_data)
-                compressed = True
-                logger.debug(f"Compressed file: {file_path}")
-
-            # Encrypt if enabled
-            encrypted = False
-            if True:  # Encryption enabled by default
-                file_data = self.encryption_manager.encrypt_data(file_data)
-                encrypted = True
-                logger.debug(f"Encrypted file: {file_path}")
+        metadata = None
+        try:
+            st = file_path.stat()
+            source = self.store.take_upload_request(relative_path) or source
+            priority = self.priorities.classify(relative_path, st.st_size, st.st_mtime, source)
+            logger.debug(f"Upload priority of {relative_path}: {priority} ({source})")
+            # Compress only where it pays off; encryption is enabled by default
+            compressed = self.compression_manager.should_compress(file_path, st.st_size)
+            codec = self.compression_manager.select_codec(relative_path, st.st_mtime) if compressed else None
+            encrypted = True
 
-            # Partition file
-            chunks = self._partition_file(file_data)
+            # A vanished path with the same inode, size and mtime means the
+            # file was moved, so its stored hash is reused without reading it
+            renamed_from = self._find_moved_file(relative_path, st)
+            known_hash = self.files_metadata[renamed_from]['file_hash'] if renamed_from else None
 
             # Create metadata
-            metadata = FileMetadata(file_path, compressed, encrypted)
+            metadata = FileMetadata(
+                file_path, compressed, encrypted, file_hash=known_hash, codec=codec,
+                encryption=self.encryption_manager.scheme
+            )
 
-            # Upload chunks
-            for chunk_index, chunk_data in enumerate(chunks):
-                chunk_hash = HashManager.calculate_chunk_hash(chunk_data)
-                webhook_url = self.webhook_manager.get_random_webhook()
+            # Every file is read once. Chunked files are hashed as they are
+            # chunked and deduplicated per chunk; files that fit in one
+            # partition, and small files bound for a pack, are read into
+            # memory and hashed up front.
+            packed = self.pack_small_files and metadata.file_size <= PACK_FILE_THRESHOLD
+            chunked = not packed and (
+                self.chunking_mode == 'cdc' or metadata.file_size > FRAME_LAYOUT_THRESHOLD
+            )
+            data = None
+            if known_hash is None and not chunked:
+                with open(file_path, 'rb') as f:
+                    data = f.read()
+                metadata.file_hash = HashManager.calculate_data_hash(data, self.hash_algorithm)
+            elif (known_hash is None and previous is not None and previous.get('file_hash')
+                  and previous.get('file_size') == metadata.file_size
+                  and not self.stat_cache.has_file(relative_path)):
+                # No stat record to trust (first run after an upgrade, or a lost
+                # stat cache): hashing the file is cheaper than uploading it again
+                previous_hash = previous['file_hash']
+                if HashManager.calculate_file_hash(file_path, HashManager.algorithm_of(previous_hash)) == previous_hash:
+                    metadata.file_hash = previous_hash
 
-                if not webhook_url:
-                    logger.error("No webhooks available")
-                    return False
+            if previous is not None and metadata.file_hash == previous.get('file_hash'):
+                # Touched but not changed
+                logger.info(f"File already tracked: {relative_path} (content unchanged)")
+                self.stat_cache.record_file(relative_path, metadata.stat, metadata.stat_ns)
+                with self._metadata_lock:
+                    self._in_progress.discard(relative_path)
+                return True
 
-                # Create temporary file for upload
-                chunk_filename = f"{metadata.file_hash}_chunk_{chunk_index}.bin"
-                response = self.webhook_manager.upload_bytes(
-                    webhook_url, chunk_data, chunk_filename
+            # Content already stored under another path: reference its chunks.
+            # Content another path is uploading right now is referenced once
+            # that upload is recorded; otherwise this file claims the upload.
+            first_upload = None
+            with self._metadata_lock:
+                source_path = renamed_from or self.files_by_hash.get(metadata.file_hash)
+                if source_path is None and metadata.file_hash is not None:
+                    claim = self._file_uploads.get(metadata.file_hash)
+                    if claim is None:
+                        self._file_uploads[metadata.file_hash] = (relative_path, Future())
+                    else:
+                        first_upload = claim[1]
+            if source_path is not None:
+                self._clone_file(relative_path, metadata, source_path)
+                with self._metadata_lock:
+                    self._in_progress.discard(relative_path)
+                return True
+            if first_upload is not None:
+                with self._uploads_cond:
+                    self._uploads_pending += 1
+                first_upload.add_done_callback(
+                    lambda f: self._clone_when_stored(relative_path, metadata, f.result())
                 )
+                return True
 
-                if response:
-                    cdn_url = self.webhook_manager.extract_cdn_url(response)
-                    if cdn_url:
-                        metadata.chunks.append({
-                            'chunk_index': chunk_index,
-                            'chunk_hash': chunk_hash,
-                            'webhook_url': webhook_url,
-                            'cdn_url': cdn_url
-                        })
-                        logger.info(f"Uploaded chunk {chunk_index}: {chunk_filename}")
-
-                        # Save response to log
-                        self._log_response(chunk_filename, response)
-                    else:
-                        logger.warning(f"No CDN URL in response for chunk {chunk_index}")
-                else:
-                    logger.error(f"Failed to upload chunk {chunk_index}")
-                    return False
+            if packed:
+                return self._pack_file(relative_path, data, metadata)
+        except Exception as e:
+            logger.error(f"Error processing file {file_path}: {e}", exc_info=True)
+            self._settle_file_upload(relative_path, metadata.file_hash if metadata else None, False)
+            with self._metadata_lock:
+                self._in_progress.discard(relative_path)
+            return False
 
-            # Save metadata
-            self.files_metadata[relative_path] = metadata.to_dict()
-            self._save_files_metadata()
+        # Partitions are produced lazily; the upload pool bounds how many are in flight
+        failed = threading.Event()
+        pending = []  # (chunk_index, future, extra fields) in chunk order
+        try:
+            if chunked:
+                metadata.layout = LAYOUT_CDC if self.chunking_mode == 'cdc' else LAYOUT_FRAMES
+                hasher = HashManager.hasher(self.hash_algorithm)
+                with open(file_path, 'rb') as f:
+                    chunks = (
+                        self.chunker.chunks(f) if self.chunking_mode == 'cdc'
+                        else iter(lambda: f.read(FRAME_SIZE), b"")
+                    )
+                    self._queue_chunks(relative_path, chunks, codec, hasher, failed, pending, priority)
+                metadata.file_hash = hasher.hexdigest()
+                metadata.merkle_root = HashManager.merkle_root([extra['plain_hash'] for _, _, extra in pending])
+            else:
+                for chunk_index, chunk_data in enumerate(self._iter_partitions(io.BytesIO(data), codec)):
+                    if failed.is_set():
+                        break
+                    pending.append(self._queue_chunk(metadata.file_hash, chunk_index, chunk_data, failed, priority))
+        except Exception as e:
+            logger.error(f"Error processing file {file_path}: {e}", exc_info=True)
+            failed.set()
 
-            logger.info(f"Successfully uploaded file: {relative_path}")
-            self.tracked_files.add(relative_path)
+        with self._uploads_cond:
+            self._uploads_pending += 1
+        when_all(
+            [future for _, future, _ in pending],
+            lambda: self._finish_file(relative_path, metadata, pending, failed)
+        )
+        return not failed.is_set()
+
+    def _unmodified(self, relative_path: str, entry: Dict, st: os.stat_result) -> bool:
+        """Whether a tracked file needs no upload: deleted on purpose, or unchanged since synced.
+
+        Files the stat cache does not vouch for are read and compared by hash.
+        """
+        if entry.get('deleted'):
             return True
+        return entry.get('file_size') == st.st_size and self.stat_cache.file_unchanged(relative_path, st)
+
+    def _find_moved_file(self, relative_path: str, st: os.stat_result) -> Optional[str]:
+        """Tracked path that this file was moved from, judged by the stat cache alone"""
+        old_path = self.stat_cache.find_by_stat(st)
+        if not old_path or old_path == relative_path or (D_SYNCED_DIR / old_path).exists():
+            return None
+        with self._metadata_lock:
+            entry = self.files_metadata.get(old_path)
+            if entry and entry.get('file_hash') and entry.get('chunks') and not entry.get('deleted'):
+                return old_path
+        return None
 
+    def _settle_file_upload(self, relative_path: str, file_hash: Optional[str], stored: bool):
+        """Resolve this path's claim on uploading its content, if it holds one"""
+        with self._metadata_lock:
+            claim = self._file_uploads.get(file_hash)
+            if claim is None or claim[0] != relative_path:
+                return
+            del self._file_uploads[file_hash]
+        claim[1].set_result(relative_path if stored else None)
+
+    def _clone_when_stored(self, relative_path: str, metadata: FileMetadata, source_path: Optional[str]):
+        """Record a file whose content another path was uploading, once that upload finished"""
+        try:
+            if source_path is None:
+                logger.error(f"Failed to upload {relative_path}: the upload of the same content failed")
+                return
+            self._clone_file(relative_path, metadata, source_path)
         except Exception as e:
-            logger.error(f"Error processing file {file_path}: {e}", exc_info=True)
+            logger.error(f"Error finishing file {relative_path}: {e}", exc_info=True)
+        finally:
+            self._upload_finished(relative_path)
+
+    def _clone_file(self, relative_path: str, metadata: FileMetadata, source_path: str):
+        """Record a file whose content is already stored, without any upload.
+
+        If the source path no longer exists on disk the file was renamed, and
+        the old entry is marked deleted.
+        """
+        with self._metadata_lock:
+            source = self.files_metadata[source_path]
+            entry = metadata.to_dict()
+            # Storage fields describe the stored bytes, so they are shared as-is
+            for key in ('compressed', 'codec', 'encrypted', 'encryption', 'layout', 'pack'):
+                if key in source:
+                    entry[key] = source[key]
+                else:
+                    entry.pop(key, None)
+            entry['chunks'] = [dict(chunk) for chunk in source.get('chunks', [])]
+
+            renamed = not (D_SYNCED_DIR / source_path).exists() and not source.get('deleted', False)
+            if renamed:
+                source['deleted'] = True
+                source['renamed_to'] = relative_path
+                # Later copies should point at the live entry
+                self.files_by_hash[metadata.file_hash] = relative_path
+            self._record_file(relative_path, entry, metadata,
+                              changed={source_path: source} if renamed else None)
+
+        if renamed:
+            self.stat_cache.forget(source_path)
+            self._count('files_renamed', 1)
+            logger.info(f"Detected rename: {source_path} -> {relative_path}")
+        else:
+            self._count('files_deduplicated', 1, 'bytes_deduplicated', metadata.file_size)
+            logger.info(f"Deduplicated {relative_path}: same content as {source_path}")
+
+    def _queue_chunk(self, file_hash: str, chunk_index: int, chunk_data: bytes,
+                     failed: threading.Event, priority: Optional[str] = None):
+        """Hand a chunk to the batcher (small) or the upload pool (large).
+
+        Returns (chunk_index, future, extra fields); the future resolves to the
+        chunk's stored fields or None on failure.
+        """
+        chunk_hash = HashManager.calculate_chunk_hash(chunk_data, self.hash_algorithm)
+        chunk_filename = f"{file_hash.rpartition(':')[2]}_chunk_{chunk_index}.bin"
+        stored_size = len(chunk_data)
+
+        def stored(result: tuple) -> Dict:
+            # Counted once the upload has landed; failed uploads resolve to None and skip this
+            self._count('chunks_uploaded', 1, 'bytes_uploaded', stored_size)
+            return {'chunk_hash': chunk_hash, 'webhook_url': result[0], 'cdn_url': result[1]}
+
+        future = then(self._upload_blob(chunk_filename, chunk_data, failed, priority), stored)
+        return chunk_index, future, {}
+
+    def _claim_chunk(self, plain_hash: str, size: int) -> Tuple[Future, bool]:
+        """Future for a chunk's stored fields, and whether the caller must upload it.
+
+        A chunk already stored or in flight resolves from that upload.
+        Otherwise the hash is reserved, so concurrent files wait for this
+        upload instead of repeating it, and the caller must follow up with
+        ``_store_chunk`` or ``_release_chunk``.
+        """
+        with self._chunk_lock:
+            known = self.chunk_index.get(plain_hash)
+            in_flight = self._chunk_uploads.get(plain_hash)
+            if not known and not in_flight:
+                reservation = self._chunk_uploads[plain_hash] = Future()
+                return reservation, True
+
+        self._count('chunks_deduplicated', 1, 'bytes_deduplicated', size)
+        if in_flight:
+            return in_flight, False
+        future = Future()
+        future.set_result({
+            key: known[key]
+            for key in ('chunk_hash', 'webhook_url', 'cdn_url', 'compressed', 'codec', 'encryption')
+            if key in known
+        })
+        return future, False
+
+    def _store_chunk(self, relative_path: str, plain_hash: str, size: int, data: bytes, fields: Dict,
+                     failed: threading.Event, priority: Optional[str] = None) -> Future:
+        """Upload an encoded chunk claimed with _claim_chunk; resolves its reservation.
+
+        The landed chunk is journaled right away, so it is not sent again if
+        the file's upload is interrupted.
+        """
+        with self._chunk_lock:
+            reservation = self._chunk_uploads[plain_hash]
+
+        def landed(f: Future):
+            result = f.result()
+            with self._chunk_lock:
+                self._chunk_uploads.pop(plain_hash, None)
+                if result:
+                    self.chunk_index.add(plain_hash, {**result, 'plain_size': size})
+            if result:
+                self._count('chunks_uploaded', 1, 'bytes_uploaded', stored_size)
+                try:
+                    self.store.journal_chunk(relative_path, plain_hash, {**result, 'plain_size': size})
+                except Exception as e:
+                    logger.warning(f"Could not journal chunk of {relative_path}: {e}")
+            reservation.set_result(result)
+
+        chunk_hash = HashManager.calculate_chunk_hash(data, self.hash_algorithm)
+        stored_size = len(data)
+        # Named by content, since the file hash is only known once the file has been read
+        then(
+            self._upload_blob(f"chunk_{plain_hash.rpartition(':')[2]}.bin", data, failed, priority),
+            lambda result: {'chunk_hash': chunk_hash, 'webhook_url': result[0], 'cdn_url': result[1], **fields}
+        ).add_done_callback(landed)
+        return reservation
+
+    def _release_chunk(self, plain_hash: str):
+        """Drop a reservation that will not be uploaded; files waiting on it fail"""
+        with self._chunk_lock:
+            reservation = self._chunk_uploads.pop(plain_hash, None)
+        if reservation is not None:
+            reservation.set_result(None)
+
+    def _count(self, *pairs):
+        """Add to upload stats: _count('name', amount, 'other', amount, ...)"""
+        with self._stats_lock:
+            for name, amount in zip(pairs[::2], pairs[1::2]):
+                self.stats[name] += amount
+
+    def _upload_blob(self, filename: str, data: bytes, failed: Optional[threading.Event] = None,
+                     priority: Optional[str] = None) -> Future:
+        """Upload data, batched with others if small; resolves to (webhook_url, cdn_url) or None"""
+        if len(data) <= BATCH_ATTACHMENT_THRESHOLD:
+            return self.batcher.add(filename, data, priority)
+        return self.upload_pool.submit(
+            self._upload_chunk, filename, data, failed or threading.Event(),
+            priority=priority, cost=len(data)
+        )
+
+    def _pack_file(self, relative_path: str, data: bytes, metadata: FileMetadata) -> bool:
+        """Encrypt a small file's contents and append them to the open pack"""
+        try:
+            if metadata.compressed:
+                data = self.compression_manager.compress_data(data, metadata.codec)
+            data = self.encryption_manager.encrypt_data(data)
+            pack_id, offset, length, future = self.packer.add(data)
+        except Exception as e:
+            logger.error(f"Error packing file {relative_path}: {e}", exc_info=True)
+            self._settle_file_upload(relative_path, metadata.file_hash, False)
+            with self._metadata_lock:
+                self._in_progress.discard(relative_path)
             return False
 
+        metadata.layout = LAYOUT_PACK
+        metadata.pack = {'pack_id': pack_id, 'offset': offset, 'length': length}
+        with self._uploads_cond:
+            self._uploads_pending += 1
+        future.add_done_callback(
+            lambda f: self._finish_packed_file(relative_path, metadata, f.result())
+        )
+        return True
+
+    def _finish_packed_file(self, relative_path: str, metadata: FileMetadata,
+                            result: Optional[tuple]):
+        """Record a packed file once its pack has been uploaded"""
+        stored = False
+        try:
+            if not result:
+                logger.error(f"Failed to upload pack for {relative_path}")
+                return
+            webhook_url, cdn_url, pack_hash = result
+            # The pack is the file's only chunk; its hash covers the whole pack
+            metadata.chunks = [{
+                'chunk_index': 0,
+                'chunk_hash': pack_hash,
+                'webhook_url': webhook_url,
+                'cdn_url': cdn_url
+            }]
+            self._record_file(relative_path, metadata.to_dict(), metadata)
+            stored = True
+            logger.info(f"Successfully uploaded file: {relative_path} (pack {metadata.pack['pack_id']})")
+        except Exception as e:
+            logger.error(f"Error finishing file {relative_path}: {e}", exc_info=True)
+        finally:
+            self._settle_file_upload(relative_path, metadata.file_hash, stored)
+            self._upload_finished(relative_path)
+
+    def _upload_chunk(self, chunk_filename: str, chunk_data: bytes,
+                      failed: threading.Event) -> Optional[tuple]:
+        """Upload one chunk in its own message; returns (webhook_url, cdn_url) or None"""
+        if failed.is_set():
+            return None
+
+        # The scheduler routes the chunk to the webhook that can take it soonest
+        webhook_url, response = self.webhook_manager.upload_chunk(chunk_data, chunk_filename)
+        if not response:
+            logger.error(f"Failed to upload chunk {chunk_filename}")
+            failed.set()
+            return None
+
+        cdn_url = self.webhook_manager.extract_cdn_url(response, chunk_filename)
+        if not cdn_url:
+            logger.warning(f"No CDN URL in response for chunk {chunk_filename}")
+            failed.set()
+            return None
+
+        logger.info(f"Uploaded chunk: {chunk_filename}")
+        # Save response to log
+        self._log_response(chunk_filename, response)
+        return webhook_url, cdn_url
+
+    def _finish_file(self, relative_path: str, metadata: FileMetadata, pending: list,
+                     failed: threading.Event):
+        """Record a file once all of its chunk uploads have finished"""
+        stored = False
+        try:
+            results = [future.result() for _, future, _ in pending]
+            if failed.is_set() or not pending or any(result is None for result in results):
+                logger.error(f"Failed to upload all chunks for {relative_path}")
+                return
+
+            metadata.chunks = [
+                {'chunk_index': chunk_index, **result, **extra}
+                for (chunk_index, _, extra), result in zip(pending, results)
+            ]
+
+            # Save metadata
+            self._record_file(relative_path, metadata.to_dict(), metadata)
+            stored = True
+            logger.info(f"Successfully uploaded file: {relative_path}")
+        except Exception as e:
+            logger.error(f"Error finishing file {relative_path}: {e}", exc_info=True)
+        finally:
+            self._settle_file_upload(relative_path, metadata.file_hash, stored)
+            self._upload_finished(relative_path)
+
+    def _upload_finished(self, relative_path: str):
+        with self._metadata_lock:
+            self._in_progress.discard(relative_path)
+        with self._uploads_cond:
+            self._uploads_pending -= 1
+            self._uploads_cond.notify_all()
+
+    def wait_for_uploads(self):
+        """Seal the open pack, send any partial batch and wait for queued uploads"""
+        self.packer.flush()
+        self.batcher.flush()
+        with self._uploads_cond:
+            while self._uploads_pending > 0:
+                self._uploads_cond.wait()
+
     def _process_folder(self, folder_path: Path):
-        """Process a folder and create metadata"""
+        """Process a folder and queue its metadata for upload"""
         logger.info(f"Processing folder: {folder_path}")
 
         try:
             relative_path = str(folder_path.relative_to(D_SYNCED_DIR))
 
             # Check if already processed
-            if relative_path in self.folders_metadata:
-                logger.info(f"Folder already tracked: {relative_path}")
-                return
+            with self._metadata_lock:
+                if relative_path in self.folders_metadata:
+                    logger.info(f"Folder already tracked: {relative_path}")
+                    return
 
             # Create metadata
-            metadata = FolderMetadata(folder_path)
-
-            # Create folder metadata JSON
-            folder_json_path = folder_path / "folder_metadata.json"
-            folder_json_data = metadata.to_dict()
-
-            # Upload folder metadata
-            webhook_url = self.webhook_manager.get_random_webhook()
-            if webhook_url:
-                response = self.webhook_manager.upload_bytes(
-                    webhook_url,
-                    json.dumps(folder_json_data).encode(),
-                    f"folder_metadata_{relative_path.replace(chr(92), '_')}.json"
-                )
+            metadata = FolderMetadata(folder_path, *self.folder_stats.counts(relative_path))
+            entry = metadata.to_dict()
+            with self._metadata_lock:
+                self.folders_metadata[relative_path] = entry
+            self._queue_folder_upload(relative_path, entry)
 
-                if response:
-                    cdn_url = self.webhook_manager.extract_cdn_url(response)
-                    metadata.cdn_url = cdn_url
-                    logger.info(f"Uploaded folder metadata: {relative_path}")
+        except Exception as e:
+            logger.error(f"Error processing folder {folder_path}: {e}", exc_info=True)
 
-            self.folders_metadata[relative_path] = metadata.to_dict()
-            self._save_folders_metadata()
-            logger.info(f"Successfully processed folder: {relative_path}")
+    def _queue_folder_upload(self, relative_path: str, entry: Dict):
+        """Upload a folder's metadata; it is small, so it shares a message with other attachments"""
+        with self._uploads_cond:
+            self._uploads_pending += 1
+        future = self.batcher.add(
+            f"folder_metadata_{relative_path.replace(chr(92), '_')}.json",
+            json.dumps(entry).encode()
+        )
+        future.add_done_callback(
+            lambda f: self._finish_folder(relative_path, entry, f.result())
+        )
+
+    def _refresh_folder_counts(self):
+        """Update and re-upload metadata of tracked folders whose counts changed"""
+        changed = []
+        with self._metadata_lock:
+            for relative_path, (file_count, folder_count) in self.folder_stats.take_dirty().items():
+                entry = self.folders_metadata.get(relative_path)
+                if entry is None or (entry.get('file_count'), entry.get('folder_count')) == (file_count, folder_count):
+                    continue
+                entry = {**entry, 'file_count': file_count, 'folder_count': folder_count}
+                self.folders_metadata[relative_path] = entry
+                changed.append((relative_path, entry))
+        if changed:
+            logger.info(f"Folder counts changed for {len(changed)} folders")
+        for relative_path, entry in changed:
+            self._queue_folder_upload(relative_path, entry)
 
+    def _finish_folder(self, relative_path: str, entry: Dict, result: Optional[tuple]):
+        """Record a folder once its metadata upload has finished"""
+        try:
+            with self._metadata_lock:
+                if result:
+                    # Updates the stored entry unless a newer one replaced it meanwhile
+                    entry['cdn_url'] = result[1]
+                    logger.info(f"Uploaded folder metadata: {relative_path}")
+                if self.folders_metadata.get(relative_path) is entry:
+                    self.store.put_folder(relative_path, entry)
+                    self._folders_changed = True
+            logger.info(f"Successfully processed folder: {relative_path}")
         except Exception as e:
-            logger.error(f"Error processing folder {folder_path}: {e}", exc_info=True)
+            logger.error(f"Error finishing folder {relative_path}: {e}", exc_info=True)
+        finally:
+            self._upload_finished(relative_path)
 
     def _log_response(self, filename: str, response: Dict):
         """Log webhook response"""
         try:
             UPLOAD_LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
-            with open(UPLOAD_LOG_FILE, 'a') as f:
-                timestamp = datetime.now().isoformat()
-                f.write(f"\n[{timestamp}] {filename}\n")
-                f.write(json.dumps(response, indent=2))
-                f.write("\n" + "="*80 + "\n")
+            timestamp = datetime.now().isoformat()
+            entry = f"\n[{timestamp}] {filename}\n{json.dumps(response, indent=2)}\n{'='*80}\n"
+            with self._log_lock, open(UPLOAD_LOG_FILE, 'a') as f:
+                f.write(entry)
         except Exception as e:
             logger.error(f"Error logging response: {e}")
 
+    @staticmethod
+    def _syncable(name: str) -> bool:
+        """Hidden files and JSON metadata files are never synced"""
+        return not name.startswith('.') and not name.endswith('.json')
+
+    def _find_changes(self, scan: Dict) -> List[Path]:
+        """Walk the tree against the stat cache and return new or changed files.
+
+        Folders found are collected in scan['folders'] and folder counts are
+        adjusted by each listing's change. A directory whose mtime matches its cached,
+        fully synced listing is not listed again, but its files are still
+        stat'ed: editing a file in place does not change its directory's mtime.
+        """
+        changed = []
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            directory = D_SYNCED_DIR / relative_dir
+            try:
+                dir_stat = directory.stat()
+                cached = self.stat_cache.reusable_listing(relative_dir, dir_stat)
+                if cached:
+                    scan['dirs_reused'] += 1
+                    scan['skipped'] += len(cached['dirs'])
+                    for name in cached['files']:
+                        relative_path = StatCache.join(relative_dir, name)
+                        try:
+                            unchanged = self.stat_cache.file_unchanged(relative_path, os.stat(directory / name))
+                        except FileNotFoundError:
+                            continue  # Removed since; the directory's mtime shows it next scan
+                        if unchanged:
+                            scan['skipped'] += 1
+                        else:
+                            changed.append(directory / name)
+                    stack.extend(StatCache.join(relative_dir, name) for name in cached['dirs'])
+                    continue
+
+                files, dirs = [], []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name == '__pycache__':
+                                continue
+                            dirs.append(entry.name)
+                            scan['folders'].append(Path(entry.path))
+                        elif entry.is_file():
+                            if not self._syncable(entry.name):
+                                continue
+                            files.append(entry.name)
+                            relative_path = StatCache.join(relative_dir, entry.name)
+                            # os.stat, not entry.stat(): on Windows the latter reports st_ino 0,
+                            # which never matches the inode recorded in the stat cache
+                            if self.stat_cache.file_unchanged(relative_path, os.stat(entry.path)):
+                                scan['skipped'] += 1
+                            else:
+                                changed.append(Path(entry.path))
+            except OSError as e:
+                logger.warning(f"Could not scan {directory}: {e}")
+                continue
+
+            scan['examined'] += len(files) + len(dirs)
+            scan['listed'].append(relative_dir)
+            gone, file_delta, dir_delta = self.stat_cache.record_listing(relative_dir, dir_stat, files, dirs)
+            self.folder_stats.adjust(relative_dir, file_delta, dir_delta)
+            for relative_path in gone:
+                self.folder_stats.remove_tree(relative_path)
+            self._vanished += gone
+            stack.extend(StatCache.join(relative_dir, name) for name in dirs)
+        return changed
+
+    def _prioritise(self, file_paths: List[Path]) -> List[Path]:
+        """Order files by priority class, then size, so small and urgent files start first"""
+        def key(file_path: Path):
+            try:
+                st = file_path.stat()
+            except OSError:
+                return (0, 0)
+            relative_path = str(file_path.relative_to(D_SYNCED_DIR))
+            source = self.store.upload_requested(relative_path) or 'scan'
+            priority = self.priorities.classify(relative_path, st.st_size, st.st_mtime, source)
+            return (self.priorities.rank(priority), st.st_size)
+        return sorted(file_paths, key=key)
+
     def scan_directory(self):
         """Scan d-synced directory for new files and folders"""
         logger.info("Scanning directory for changes...")
@@ -359,30 +994,174 @@ class D_SyncUpload:
             logger.warning(f"D-synced directory not found: {D_SYNCED_DIR}")
             return
 
-        # Process all items in directory
-        for item in D_SYNCED_DIR.rglob('*'):
-            if item.is_dir() and item.name != '__pycache__':
-                # Skip if it's the main d-synced folder
-                if item != D_SYNCED_DIR:
-                    self._process_folder(item)
-            elif item.is_file():
-                # Skip hidden files and JSON metadata files
-                if not item.name.startswith('.') and not item.name.endswith('.json'):
-                    self._process_file(item)
-
-    def watch(self, interval: int = 60):
-        """Watch directory for changes"""
+        self._merge_external_changes()
+        started = time.perf_counter()
+        scan = {'examined': 0, 'skipped': 0, 'dirs_reused': 0, 'listed': [], 'folders': []}
+        pending_files = self._find_changes(scan)
+        # Folders are recorded after the walk, once their counts are complete
+        for folder_path in scan['folders']:
+            self._process_folder(folder_path)
+        logger.info(
+            f"Scan listed {len(scan['listed'])} directories ({scan['examined']} entries) in "
+            f"{time.perf_counter() - started:.2f}s: {len(pending_files)} new or changed files, "
+            f"{scan['skipped']} unchanged entries skipped "
+            f"({scan['dirs_reused']} directories reused from the stat cache)"
+        )
+
+        with ThreadPoolExecutor(max_workers=self.file_concurrency,
+                                thread_name_prefix='d-sync-file') as executor:
+            list(executor.map(self._process_file, self._prioritise(pending_files)))
+        self._refresh_folder_counts()
+        self.wait_for_uploads()
+        self._save_folders_metadata()
+        self._report_journal()
+
+        self._forget_vanished()
+        # Listings become reusable once every file in them has been synced
+        for relative_dir in scan['listed']:
+            self.stat_cache.mark_complete(relative_dir)
+        try:
+            self.stat_cache.save()
+        except OSError as e:
+            logger.warning(f"Could not save stat cache: {e}")
+
+        logger.info(
+            f"Batched {self.batcher.attachments_sent} attachments into "
+            f"{self.batcher.messages_sent} messages"
+        )
+        logger.info(
+            f"Uploaded {self.stats['chunks_uploaded']} chunks ({self.stats['bytes_uploaded']} bytes); "
+            f"deduplicated {self.stats['files_deduplicated']} files and "
+            f"{self.stats['chunks_deduplicated']} chunks, saving {self.stats['bytes_deduplicated']} bytes; "
+            f"{self.stats['files_renamed']} renames, {self.stats['files_updated']} files updated"
+        )
+        if self.packer.files_packed:
+            logger.info(f"Packed {self.packer.files_packed} files into {self.packer.packs_sealed} packs")
+        # Publish the manifest as soon as a scan's uploads are in
+        self.manifest_sync.flush()
+        self.manifest_sync.log_stats()
+        self.upload_pool.log_stats()
+        self.compression_manager.log_stats()
+        self.webhook_manager.scheduler.log_utilisation()
+        self.webhook_manager.transport.log_stats()
+
+    def watch(self, interval: int = 60, mode: str = WATCH_MODE):
+        """Watch directory for changes.
+
+        mode "inotify" uploads files as filesystem events report them (Linux),
+        "poll" rescans every interval seconds, and "auto" uses inotify where
+        available.
+        """
         logger.info(f"Starting watch with {interval}s interval")
-        
+
         try:
-            while True:
-                self.scan_directory()
-                logger.debug(f"Scan complete, waiting {interval}s...")
-                time.sleep(interval)
+            if mode != 'poll' and InotifyWatcher.available():
+                self._watch_events(interval)
+            else:
+                if mode == 'inotify':
+                    logger.warning("inotify is not available on this platform, polling instead")
+                self._watch_poll(interval)
         except KeyboardInterrupt:
             logger.info("Watch stopped by user")
         except Exception as e:
             logger.error(f"Error during watch: {e}", exc_info=True)
+        finally:
+            self.close()
+
+    def _forget_vanished(self):
+        """Drop cache entries for removed paths; kept until now so moves could be matched by inode"""
+        vanished, self._vanished = self._vanished, []
+        for relative_path in vanished:
+            self.stat_cache.forget(relative_path)
+
+    def _note_added(self, path: Path, is_dir: bool = False):
+        """Count a file or folder reported by the watcher"""
+        relative_path = str(path.relative_to(D_SYNCED_DIR))
+        if self.stat_cache.add_entry(relative_path, is_dir):
+            self.folder_stats.adjust(os.path.dirname(relative_path), 0 if is_dir else 1, 1 if is_dir else 0)
+
+    def _note_removed(self, path: Path):
+        """Uncount a file or folder the watcher reported removed"""
+        relative_path = str(path.relative_to(D_SYNCED_DIR))
+        kind = self.stat_cache.remove_entry(relative_path)
+        if kind is None:
+            return
+        parent = os.path.dirname(relative_path)
+        if kind == 'dirs':
+            self.folder_stats.adjust(parent, 0, -1)
+            self.folder_stats.remove_tree(relative_path)
+        else:
+            self.folder_stats.adjust(parent, -1, 0)
+        self._vanished.append(relative_path)
+
+    def _watch_poll(self, interval: int):
+        while True:
+            self.scan_directory()
+            logger.debug(f"Scan complete, waiting {interval}s...")
+            time.sleep(interval)
+
+    def _watch_events(self, interval: int):
+        """Feed settled files from inotify into the upload queue"""
+        try:
+            watcher = InotifyWatcher(D_SYNCED_DIR)
+        except OSError as e:
+            logger.warning(f"Could not start inotify watch ({e}), polling instead")
+            return self._watch_poll(interval)
+
+        logger.info("Watching for filesystem events")
+        executor = ThreadPoolExecutor(max_workers=self.file_concurrency,
+                                      thread_name_prefix='d-sync-file')
+        try:
+            # Catch up on anything that changed while not running
+            self.scan_directory()
+            last_flush = time.monotonic()
+            while True:
+                files, directories, removed, overflowed = watcher.poll(timeout=1.0)
+                if overflowed:
+                    logger.warning("inotify event queue overflowed, rescanning")
+                    self.scan_directory()
+                    continue
+
+                for path in removed:
+                    self._note_removed(path)
+                directories = [
+                    directory for directory in directories
+                    if directory.is_dir() and '__pycache__' not in directory.relative_to(D_SYNCED_DIR).parts
+                ]
+                for directory in directories:
+                    self._note_added(directory, is_dir=True)
+                for file_path in files:
+                    if (self._syncable(file_path.name) and file_path.is_file()
+                            and '__pycache__' not in file_path.relative_to(D_SYNCED_DIR).parts):
+                        self._note_added(file_path)
+                        executor.submit(self._process_file, file_path, 'watch')
+                for directory in directories:
+                    self._process_folder(directory)
+
+                # Nothing else would seal a partly filled pack between events
+                if time.monotonic() - last_flush >= interval:
+                    self._merge_external_changes()
+                    self._refresh_folder_counts()
+                    self._save_folders_metadata()
+                    self.packer.flush()
+                    self._forget_vanished()
+                    self.stat_cache.save()
+                    last_flush = time.monotonic()
+        finally:
+            executor.shutdown(wait=True)
+            watcher.close()
+
+    def close(self):
+        """Wait for in-flight uploads and release worker threads"""
+        self.wait_for_uploads()
+        self.manifest_sync.close()
+        self.upload_pool.shutdown(wait=True)
+        self.compression_pool.shutdown(wait=True)
+        self._save_folders_metadata()
+        try:
+            self.stat_cache.save()
+        except OSError as e:
+            logger.warning(f"Could not save stat cache: {e}")
 
 
 def main():
@@ -4,7 +4,6 @@ Serves a localhost interface for uploading and downloading files
 """
 
 import os
-import json
 import threading
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -16,13 +15,14 @@ import sys
 sys.path.insert(0, str(Path(__file__).parent))
 
 from utils import (
-    Logger, D_SYNCED_DIR, FILES_JSON, WEBHOOKS_FILE, BASE_DIR,
-    CompressionManager, EncryptionManager, HashManager
+    Logger, D_SYNCED_DIR, WEBHOOKS_FILE, BASE_DIR,
+    CompressionManager, EncryptionManager, HashManager, MetadataStore
 )
 from utils.webhook_refresh import WebhookMessageRefresh
+from utils.bandwidth import DIRECTIONS, LIMITS_SETTING, current_usage, get_shaper
 
 try:
-    from flask import Flask, request, jsonify, send_file, render_template_string
+    from flask import Flask, Response, request, jsonify, send_file, render_template_string
 except ImportError:
     print("Flask not installed. Install with: pip install flask")
     sys.exit(1)
@@ -33,6 +33,19 @@ app = Flask(__name__, static_folder=None)
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB max
 app.config['UPLOAD_FOLDER'] = str(D_SYNCED_DIR)
 
+# Metadata store shared with the uploader; opened on first request
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> MetadataStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MetadataStore()
+        return _store
+
+
 # Track current upload status
 upload_status = {
     'is_uploading': False,
@@ -462,6 +475,19 @@ HTML_TEMPLATE = '''
                             <p>📝 Deleted Files: <strong id="deletedCount">0</strong></p>
                         </div>
                     </div>
+
+                    <div style="border-top: 1px solid #e0e0e0; padding-top: 20px; margin-top: 20px;">
+                        <p style="color: #999; margin-bottom: 10px;">Bandwidth (MB/s, empty = schedule)</p>
+                        <div style="color: #333; line-height: 1.8;">
+                            <p>⬆️ Upload: <strong id="uploadRate">0</strong> <span id="uploadLimit" style="color: #999;"></span></p>
+                            <p>⬇️ Download: <strong id="downloadRate">0</strong> <span id="downloadLimit" style="color: #999;"></span></p>
+                        </div>
+                        <div style="margin-top: 10px;">
+                            <input type="number" id="uploadLimitInput" min="0" step="0.1" placeholder="Upload" style="width: 90px;">
+                            <input type="number" id="downloadLimitInput" min="0" step="0.1" placeholder="Download" style="width: 90px;">
+                            <button type="button" onclick="setBandwidth()">Apply</button>
+                        </div>
+                    </div>
                 </div>
             </div>
         </div>
@@ -673,6 +699,39 @@ HTML_TEMPLATE = '''
             document.getElementById('deletedCount').textContent = deleted;
         }
         
+        function formatRate(rate) {
+            return rate ? `${formatFileSize(rate)}/s` : 'unlimited';
+        }
+
+        function loadBandwidth() {
+            fetch('/api/bandwidth')
+                .then(response => response.json())
+                .then(data => {
+                    for (const direction of ['upload', 'download']) {
+                        const limit = data.limits[direction];
+                        document.getElementById(`${direction}Rate`).textContent = formatFileSize(data.rates[direction]) + '/s';
+                        document.getElementById(`${direction}Limit`).textContent = `(limit ${formatRate(limit.limit)}, ${limit.source})`;
+                    }
+                })
+                .catch(error => console.error('Error loading bandwidth:', error));
+        }
+
+        function setBandwidth() {
+            const limits = {};
+            for (const direction of ['upload', 'download']) {
+                const value = document.getElementById(`${direction}LimitInput`).value;
+                limits[direction] = value === '' ? null : Math.round(parseFloat(value) * 1024 * 1024);
+            }
+            fetch('/api/bandwidth', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(limits)
+            })
+                .then(response => response.json())
+                .then(() => loadBandwidth())
+                .catch(error => console.error('Error setting bandwidth:', error));
+        }
+
         function checkUploadStatus() {
             fetch('/api/upload-status')
                 .then(response => response.json())
@@ -690,11 +749,13 @@ HTML_TEMPLATE = '''
         // Load files on startup
         loadFiles();
         checkUploadStatus();
+        loadBandwidth();
         
         // Refresh every 2 seconds
         setInterval(() => {
             checkUploadStatus();
             loadFiles();
+            loadBandwidth();
         }, 2000);
     </script>
 </body>
@@ -710,16 +771,11 @@ def index():
 
 @app.route('/api/files', methods=['GET'])
 def get_files():
-    """Get all files from files.json but sanitize sensitive fields before returning to client."""
+    """Get all files from the metadata store but sanitize sensitive fields before returning to client."""
     try:
-        if not FILES_JSON.exists():
-            return jsonify({'files': {}})
-
-        with open(FILES_JSON, 'r') as f:
-            data = json.load(f)
-
+        store = get_store()
         sanitized = {}
-        for key, meta in data.get('files', {}).items():
+        for key, meta in store.all_files().items():
             sanitized[key] = {
                 'file_path': meta.get('file_path', key),
                 'file_size': meta.get('file_size', 0),
@@ -731,7 +787,7 @@ def get_files():
                 'chunk_count': len(meta.get('chunks', []))
             }
 
-        return jsonify({'last_updated': data.get('last_updated'), 'files': sanitized})
+        return jsonify({'last_updated': store.last_updated(), 'files': sanitized})
     except Exception as e:
         logger.error(f"Error reading files: {e}")
         return jsonify({'error': str(e)}), 500
@@ -758,6 +814,8 @@ def upload_file():
         
         file_path = D_SYNCED_DIR / file.filename
         file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Uploads from the browser go ahead of background syncing
+        get_store().request_upload(file.filename, 'web')
         file.save(str(file_path))
         
         upload_status['is_uploading'] = False
@@ -778,21 +836,55 @@ def get_upload_status():
     return jsonify(upload_status)
 
 
+@app.route('/api/bandwidth', methods=['GET'])
+def get_bandwidth():
+    """Current upload/download limits and the rates measured by running d-sync processes"""
+    try:
+        store = get_store()
+        shaper = get_shaper()
+        limits = shaper.limits_at()
+        overrides = store.get_setting(LIMITS_SETTING) or {}
+        for direction in DIRECTIONS:
+            if overrides.get(direction) is not None:
+                limits[direction] = {'limit': overrides[direction], 'source': 'dashboard'}
+        usage = current_usage(store)
+        rates = {direction: sum(report[direction]['rate'] for report in usage) for direction in DIRECTIONS}
+        return jsonify({'limits': limits, 'rates': rates, 'processes': usage, 'schedule': shaper.schedule})
+    except Exception as e:
+        logger.error(f"Error reading bandwidth: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/bandwidth', methods=['POST'])
+def set_bandwidth():
+    """Override upload/download limits (bytes per second, 0 = unlimited, null = schedule)"""
+    try:
+        body = request.get_json(silent=True) or {}
+        limits = {}
+        for direction in DIRECTIONS:
+            value = body.get(direction)
+            if value is not None:
+                # bool is an int subclass; JSON true would otherwise mean 1 byte per second
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    return jsonify({'success': False, 'error': f'Invalid {direction} limit'}), 400
+                limits[direction] = int(value)
+        get_store().set_setting(LIMITS_SETTING, limits or None)
+        get_shaper().refresh(force=True)
+        logger.info(f"Bandwidth limits set from the dashboard: {limits or 'schedule'}")
+        return jsonify({'success': True, 'limits': limits})
+    except Exception as e:
+        logger.error(f"Bandwidth error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/delete/<filename>', methods=['POST'])
 def delete_file(filename):
-    """Mark file as deleted in files.json"""
+    """Mark file as deleted in the metadata store; the uploader exports it to files.json"""
     try:
-        if FILES_JSON.exists():
-            with open(FILES_JSON, 'r') as f:
-                data = json.load(f)
-            
-            if filename in data.get('files', {}):
-                data['files'][filename]['deleted'] = True
-                with open(FILES_JSON, 'w') as f:
-                    json.dump(data, f, indent=2)
-                logger.info(f"File marked as deleted: {filename}")
-                return jsonify({'success': True})
-        
+        if get_store().mark_deleted(filename):
+            logger.info(f"File marked as deleted: {filename}")
+            return jsonify({'success': True})
+
         return jsonify({'success': False, 'error': 'File not found'}), 404
     except Exception as e:
         logger.error(f"Delete error: {e}")
@@ -807,24 +899,29 @@ def download_file(filename):
         if filename.endswith('.crdownload'):
             return jsonify({'error': 'Cannot download incomplete files'}), 400
         
-        if not FILES_JSON.exists():
-            return jsonify({'error': 'No files metadata'}), 404
-        
-        with open(FILES_JSON, 'r') as f:
-            data = json.load(f)
-        
-        if filename not in data.get('files', {}):
+        file_meta = get_store().get_file(filename)
+        if file_meta is None:
             return jsonify({'error': 'File not found'}), 404
         
-        file_meta = data['files'][filename]
-        
         # Check if file is deleted
         if file_meta.get('deleted'):
             return jsonify({'error': 'File has been deleted'}), 410
         
         # Download from Discord
         from d_sync_download import D_SyncDownload
-        downloader = D_SyncDownload()
+        downloader = D_SyncDownload(files_metadata={filename: file_meta})
+
+        # Range requests fetch only the chunks covering the range, where the layout allows it
+        file_size = file_meta.get('file_size', 0)
+        byte_range = request.range.range_for_length(file_size) if request.range else None
+        if byte_range:
+            start, end = byte_range
+            data = downloader.read_range(filename, start, end - start)
+            if data is not None:
+                response = Response(data, status=206, mimetype='application/octet-stream')
+                response.headers['Content-Range'] = f'bytes {start}-{start + len(data) - 1}/{file_size}'
+                response.headers['Accept-Ranges'] = 'bytes'
+                return response
         
         # Download and reconstruct
         success = downloader.download_file(filename)
@@ -4,13 +4,54 @@ from .config import *
 from .logger import Logger
 from .encryption import EncryptionManager
 from .compression import CompressionManager
+from .compression_codecs import Codec, register_codec, get_codec, available_codecs
 from .hashing import HashManager
 from .webhook_handler import WebhookManager
+from .upload_pool import UploadPool, UploadPriorities, when_all, then
+from .attachment_batcher import AttachmentBatcher
+from .packing import PackBuilder
+from .chunking import ContentDefinedChunker
+from .chunk_index import ChunkIndex
+from .transport import HttpTransport, get_transport
+from .bandwidth import BandwidthShaper, get_shaper
+from .stat_cache import StatCache
+from .folder_stats import FolderStats
+from .metadata_store import MetadataStore
+from .manifest_sync import ManifestSync
+from .manifest_codec import encode_manifest, decode_manifest, load_manifest
+from .manifest_shards import ShardedManifest, load_remote_manifest
+from .inotify_watcher import InotifyWatcher
 
 __all__ = [
     'Logger',
     'EncryptionManager',
     'CompressionManager',
+    'Codec',
+    'register_codec',
+    'get_codec',
+    'available_codecs',
     'HashManager',
     'WebhookManager',
+    'UploadPool',
+    'UploadPriorities',
+    'when_all',
+    'then',
+    'AttachmentBatcher',
+    'PackBuilder',
+    'ContentDefinedChunker',
+    'ChunkIndex',
+    'HttpTransport',
+    'get_transport',
+    'BandwidthShaper',
+    'get_shaper',
+    'StatCache',
+    'FolderStats',
+    'MetadataStore',
+    'ManifestSync',
+    'encode_manifest',
+    'decode_manifest',
+    'load_manifest',
+    'ShardedManifest',
+    'load_remote_manifest',
+    'InotifyWatcher',
 ]
@@ -0,0 +1,122 @@
+"""Multi-attachment message batching for d-sync"""
+
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+from .logger import Logger
+from .config import WEBHOOK_MAX_ATTACHMENTS, BATCH_MAX_BYTES, BATCH_MAX_DELAY
+
+logger = Logger(__name__)
+
+
+class AttachmentBatcher:
+    """Packs small uploads into multi-attachment webhook messages.
+
+    Each ``add`` returns a future that resolves to ``(webhook_url, cdn_url)``
+    once the message carrying the attachment lands, or ``None`` on failure.
+    A batch is sent when it reaches ``max_files`` attachments or ``max_bytes``,
+    after ``max_delay`` seconds, or on ``flush``.
+    """
+
+    def __init__(self, webhook_manager, upload_pool, max_files: int = WEBHOOK_MAX_ATTACHMENTS,
+                 max_bytes: int = BATCH_MAX_BYTES, max_delay: float = BATCH_MAX_DELAY,
+                 on_response=None):
+        self.webhook_manager = webhook_manager
+        self.upload_pool = upload_pool
+        self.max_files = max(1, int(max_files))
+        self.max_bytes = int(max_bytes)
+        self.max_delay = max_delay
+        self.on_response = on_response  # Called with (filenames, response) for logging
+        self._pending: List[Tuple[str, bytes, Future]] = []
+        self._pending_bytes = 0
+        self._pending_priorities = set()
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self.messages_sent = 0
+        self.attachments_sent = 0
+
+    def add(self, filename: str, data: bytes, priority: Optional[str] = None) -> Future:
+        """Queue an attachment for the next batched message.
+
+        A message is uploaded in the most urgent priority class of its attachments.
+        """
+        future = Future()
+        ready = []
+        with self._lock:
+            if self._pending and self._pending_bytes + len(data) > self.max_bytes:
+                ready.append(self._take())
+            self._pending.append((filename, data, future))
+            self._pending_bytes += len(data)
+            self._pending_priorities.add(priority)
+            if len(self._pending) >= self.max_files:
+                ready.append(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        for batch, urgency in ready:
+            self._submit(batch, urgency)
+        return future
+
+    def flush(self):
+        """Send whatever is pending now"""
+        with self._lock:
+            batch, urgency = self._take()
+        if batch:
+            self._submit(batch, urgency)
+
+    def _take(self) -> Tuple[List[Tuple[str, bytes, Future]], Optional[str]]:
+        """Detach the pending batch and its priority class; caller must hold the lock"""
+        urgency = self.upload_pool.most_urgent(self._pending_priorities)
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        self._pending_priorities = set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch, urgency
+
+    def _submit(self, batch: List[Tuple[str, bytes, Future]], priority: Optional[str]):
+        self.upload_pool.submit(
+            self._send, batch, priority=priority, cost=sum(len(data) for _, data, _ in batch)
+        )
+
+    def _send(self, batch: List[Tuple[str, bytes, Future]]):
+        try:
+            webhook_url, response = self.webhook_manager.upload_many(
+                [(filename, data) for filename, data, _ in batch]
+            )
+            urls = self.webhook_manager.extract_cdn_urls(response) if response else []
+            if response and len(urls) == len(batch):
+                with self._lock:
+                    self.messages_sent += 1
+                    self.attachments_sent += len(batch)
+                if self.on_response:
+                    self.on_response([filename for filename, _, _ in batch], response)
+                for (_, _, future), cdn_url in zip(batch, self._match_urls(batch, urls, response)):
+                    future.set_result((webhook_url, cdn_url) if cdn_url else None)
+                return
+            logger.error(f"Batched upload of {len(batch)} attachments failed")
+        except Exception as e:
+            logger.error(f"Batched upload failed: {e}", exc_info=True)
+
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    @staticmethod
+    def _match_urls(batch, urls: List[str], response) -> List[Optional[str]]:
+        """CDN URL for each batch entry.
+
+        Attachments are matched by filename; Discord may sanitise names, so
+        entries that do not match fall back to upload order.
+        """
+        by_name = {}
+        for attachment in response.get('attachments', []):
+            by_name.setdefault(attachment.get('filename'), []).append(attachment.get('url'))
+
+        matched = []
+        for position, (filename, _, _) in enumerate(batch):
+            candidates = by_name.get(filename)
+            matched.append(candidates.pop(0) if candidates else urls[position])
+        return matched
@@ -0,0 +1,293 @@
+"""Bandwidth shaping for d-sync transfers"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+from .logger import Logger
+from .config import (
+    METADATA_DB, UPLOAD_RATE_LIMIT, DOWNLOAD_RATE_LIMIT, BANDWIDTH_SCHEDULE,
+    BANDWIDTH_BURST_SECONDS, BANDWIDTH_REFRESH_INTERVAL, BANDWIDTH_WINDOW
+)
+
+logger = Logger(__name__)
+
+DIRECTIONS = ('upload', 'download')
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+MIN_BURST = 64 * 1024  # Bucket size floor, so a slow limit still sends whole socket blocks
+
+# Store settings: limits set from the dashboard, and each process's measured rates
+LIMITS_SETTING = 'bandwidth.limits'
+USAGE_SETTING_PREFIX = 'bandwidth.usage.'
+
+
+class TokenBucket:
+    """Token bucket refilled at rate bytes per second; rate 0 means unlimited.
+
+    A take larger than the tokens available leaves the bucket in debt and
+    sleeps until it is repaid, so concurrent callers share the rate.
+    """
+
+    def __init__(self, rate: float = 0, burst_seconds: float = BANDWIDTH_BURST_SECONDS):
+        self.burst_seconds = burst_seconds
+        self.rate = 0.0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    @property
+    def capacity(self) -> float:
+        return max(self.rate * self.burst_seconds, MIN_BURST)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            was_limited = self.rate > 0
+            self._refill()
+            self.rate = max(0.0, float(rate or 0))
+            # A new limit starts with a full bucket; a changed one keeps at most one bucket of debt
+            self._tokens = max(-self.capacity, min(self._tokens, self.capacity)) if was_limited else self.capacity
+
+    def take(self, size: int) -> float:
+        """Take size bytes of tokens, sleeping while in debt; returns the seconds slept"""
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self._tokens -= size
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class BandwidthLimiter:
+    """Rate limit and byte accounting for one direction of traffic"""
+
+    def __init__(self, direction: str, window: float = BANDWIDTH_WINDOW):
+        self.direction = direction
+        self.bucket = TokenBucket()
+        self.window = window
+        self.limit = 0
+        self.source = 'default'  # Where the limit came from: default, schedule or dashboard
+        self._bins = deque()  # [second, bytes] for the measured rate
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.throttled_seconds = 0.0
+
+    def set_limit(self, limit: int, source: str):
+        if limit != self.limit:
+            logger.info(
+                f"{self.direction.capitalize()} limit {format_rate(limit)} ({source})"
+            )
+            self.bucket.set_rate(limit)
+        self.limit, self.source = limit, source
+
+    def transfer(self, size: int):
+        """Account for size bytes sent or received, waiting if over the limit"""
+        slept = self.bucket.take(size)
+        second = int(time.monotonic())
+        with self._lock:
+            self.bytes += size
+            self.throttled_seconds += slept
+            if self._bins and self._bins[-1][0] == second:
+                self._bins[-1][1] += size
+            else:
+                self._bins.append([second, size])
+            self._trim(second)
+
+    def _trim(self, second: int):
+        while self._bins and self._bins[0][0] <= second - self.window:
+            self._bins.popleft()
+
+    def rate(self) -> float:
+        """Measured bytes per second over the last window"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(int(now))
+            total = sum(size for _, size in self._bins)
+        return total / self.window
+
+    def stats(self) -> Dict:
+        return {
+            'limit': self.limit,
+            'source': self.source,
+            'rate': round(self.rate()),
+            'bytes': self.bytes,
+            'throttled_seconds': round(self.throttled_seconds, 2),
+        }
+
+
+def format_rate(rate: float) -> str:
+    if not rate:
+        return "unlimited"
+    if rate >= 1024 * 1024:
+        return f"{rate / (1024 * 1024):.1f} MB/s"
+    return f"{rate / 1024:.0f} KB/s"
+
+
+def _parse_days(days) -> set:
+    """Weekday numbers (Monday 0) from "mon-fri", "sat,sun" or a list of names or numbers"""
+    if days is None:
+        return set(range(7))
+    if isinstance(days, str):
+        days = days.split(',')
+    result = set()
+    for day in days:
+        if isinstance(day, int):
+            result.add(day % 7)
+            continue
+        first, _, last = day.strip().lower().partition('-')
+        start = DAYS.index(first[:3])
+        end = DAYS.index(last[:3]) if last else start
+        result.update(d % 7 for d in range(start, end + 1 if end >= start else end + 8))
+    return result
+
+
+def _minutes(clock: str) -> int:
+    hours, _, minutes = clock.partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def schedule_entry(schedule: List[Dict], when: datetime) -> Optional[Dict]:
+    """First schedule entry covering a moment; "start"/"end" may wrap past midnight"""
+    now = when.hour * 60 + when.minute
+    for entry in schedule:
+        start, end = _minutes(entry.get('start', '00:00')), _minutes(entry.get('end', '24:00'))
+        # An overnight window belongs to the day it started on
+        day = when.weekday() if start <= end or now >= start else (when.weekday() - 1) % 7
+        if day not in _parse_days(entry.get('days')):
+            continue
+        if (start <= now < end) if start <= end else (now >= start or now < end):
+            return entry
+    return None
+
+
+class BandwidthShaper:
+    """Upload and download limits for this process.
+
+    Limits come, in order of precedence, from the web dashboard (stored in
+    the metadata store, so they reach every d-sync process), from the first
+    BANDWIDTH_SCHEDULE entry covering the current time, or from
+    UPLOAD_RATE_LIMIT / DOWNLOAD_RATE_LIMIT. They are re-read every
+    BANDWIDTH_REFRESH_INTERVAL seconds, when the measured rates are also
+    published for the dashboard.
+    """
+
+    def __init__(self, schedule: Optional[List[Dict]] = None,
+                 defaults: Optional[Dict[str, int]] = None, store=None):
+        self.schedule = BANDWIDTH_SCHEDULE if schedule is None else schedule
+        self.defaults = defaults or {'upload': UPLOAD_RATE_LIMIT, 'download': DOWNLOAD_RATE_LIMIT}
+        self.limiters = {direction: BandwidthLimiter(direction) for direction in DIRECTIONS}
+        self.upload = self.limiters['upload']
+        self.download = self.limiters['download']
+        self._store = store
+        self._usage_key = f"{USAGE_SETTING_PREFIX}{os.getpid()}"
+        self._refresh_lock = threading.Lock()
+        self._refreshed = 0.0
+        self.refresh()
+
+    def _get_store(self):
+        # Dashboard limits live in the metadata store; a machine that only
+        # restores from files.json has none and uses its configured limits
+        if self._store is None and METADATA_DB.exists():
+            try:
+                from .metadata_store import MetadataStore
+                self._store = MetadataStore()
+            except Exception as e:
+                logger.debug(f"Bandwidth limits from the dashboard unavailable: {e}")
+        return self._store
+
+    def limits_at(self, when: Optional[datetime] = None) -> Dict[str, Dict]:
+        """Configured limit and its source per direction, ignoring dashboard overrides"""
+        entry = schedule_entry(self.schedule, when or datetime.now())
+        limits = {}
+        for direction in DIRECTIONS:
+            if entry is not None and direction in entry:
+                limits[direction] = {'limit': int(entry[direction] or 0), 'source': 'schedule'}
+            else:
+                limits[direction] = {'limit': int(self.defaults.get(direction) or 0), 'source': 'default'}
+        return limits
+
+    def refresh(self, force: bool = False):
+        """Re-read limits and publish measured rates if the refresh interval has passed"""
+        now = time.monotonic()
+        if not force and now - self._refreshed < BANDWIDTH_REFRESH_INTERVAL:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._refreshed = now
+            limits = self.limits_at()
+            store = self._get_store()
+            if store is not None:
+                try:
+                    overrides = store.get_setting(LIMITS_SETTING) or {}
+                    for direction in DIRECTIONS:
+                        if overrides.get(direction) is not None:
+                            limits[direction] = {'limit': int(overrides[direction]), 'source': 'dashboard'}
+                    self._publish(store)
+                except Exception as e:
+                    logger.debug(f"Could not sync bandwidth settings: {e}")
+            for direction, limit in limits.items():
+                self.limiters[direction].set_limit(limit['limit'], limit['source'])
+        finally:
+            self._refresh_lock.release()
+
+    def _publish(self, store):
+        usage = {direction: limiter.stats() for direction, limiter in self.limiters.items()}
+        if not any(stat['bytes'] for stat in usage.values()):
+            return
+        usage['process'] = os.path.basename(sys.argv[0]) or 'python'
+        usage['updated_at'] = time.time()
+        store.set_setting(self._usage_key, usage)
+
+    def throttle(self, direction: str, size: int):
+        """Account for size bytes in a direction, waiting if over its limit"""
+        self.refresh()
+        self.limiters[direction].transfer(size)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {direction: limiter.stats() for direction, limiter in self.limiters.items()}
+
+    def log_stats(self):
+        for direction, stat in self.stats().items():
+            if stat['bytes']:
+                logger.info(
+                    f"Bandwidth {direction}: {stat['bytes']} bytes, {format_rate(stat['rate'])} "
+                    f"over the last {BANDWIDTH_WINDOW:g}s, limit {format_rate(stat['limit'])} "
+                    f"({stat['source']}), throttled {stat['throttled_seconds']}s"
+                )
+
+
+def current_usage(store, max_age: float = 3 * BANDWIDTH_REFRESH_INTERVAL) -> List[Dict]:
+    """Measured rates published by running d-sync processes; stale reports are dropped"""
+    now = time.time()
+    usage = []
+    for key, report in store.settings(USAGE_SETTING_PREFIX).items():
+        if now - report.get('updated_at', 0) > max_age:
+            store.set_setting(key, None)
+        else:
+            usage.append(report)
+    return usage
+
+
+_shared_shaper: Optional[BandwidthShaper] = None
+_shared_lock = threading.Lock()
+
+
+def get_shaper() -> BandwidthShaper:
+    """Return the process-wide shaper, creating it on first use"""
+    global _shared_shaper
+    with _shared_lock:
+        if _shared_shaper is None:
+            _shared_shaper = BandwidthShaper()
+        return _shared_shaper
@@ -0,0 +1,43 @@
+"""Global chunk index for d-sync"""
+
+import threading
+from typing import Dict, Optional
+from .logger import Logger
+
+logger = Logger(__name__)
+
+
+class ChunkIndex:
+    """Maps plaintext chunk hashes to chunks already stored on Discord.
+
+    Only self-contained chunks (compressed and encrypted on their own) are
+    indexed, so a stored chunk can be referenced from any file.
+    """
+
+    # Fields copied from a chunk record; chunk_index is per file and not kept
+    RECORD_FIELDS = ('chunk_hash', 'webhook_url', 'cdn_url', 'plain_size', 'compressed', 'codec', 'encryption')
+
+    def __init__(self):
+        self._chunks: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def get(self, plain_hash: str) -> Optional[Dict]:
+        """Return the stored chunk for a plaintext hash, if any"""
+        with self._lock:
+            return self._chunks.get(plain_hash)
+
+    def add(self, plain_hash: str, record: Dict):
+        """Remember where a chunk with this plaintext hash is stored"""
+        entry = {key: record[key] for key in self.RECORD_FIELDS if key in record}
+        with self._lock:
+            self._chunks.setdefault(plain_hash, entry)
+
+    def index_file(self, file_metadata: Dict):
+        """Add every self-contained chunk of a files.json entry, including its earlier versions"""
+        for version in [file_metadata] + file_metadata.get('versions', []):
+            for chunk in version.get('chunks', []):
+                if chunk.get('plain_hash') and chunk.get('cdn_url'):
+                    self.add(chunk['plain_hash'], chunk)
@@ -0,0 +1,104 @@
+"""Content-defined chunking for d-sync"""
+
+import hashlib
+from typing import BinaryIO, Iterator
+from .config import CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE, CHUNK_SIZE
+
+_MASK32 = (1 << 32) - 1
+# Bytes hashed per pass before checking for a boundary with exact positions
+_SCAN_BLOCK = 4096
+
+# Gear table must never change: chunk boundaries (and therefore dedup hits)
+# depend on it, so it is derived deterministically rather than randomly.
+# A 32-bit hash keeps the arithmetic on small ints, which is much faster in CPython.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+
+def _high_mask(bits: int) -> int:
+    """Mask over the top ``bits`` bits of the 32-bit gear hash"""
+    bits = max(1, min(bits, 31))
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+class ContentDefinedChunker:
+    """FastCDC-style chunker using a gear rolling hash with normalised chunking.
+
+    Boundaries depend on content rather than offsets, so an insertion only
+    changes the chunks around it and identical regions in different files
+    produce identical chunks.
+    """
+
+    def __init__(self, min_size: int = CDC_MIN_SIZE, avg_size: int = CDC_AVG_SIZE,
+                 max_size: int = CDC_MAX_SIZE):
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError("CDC sizes must satisfy 0 < min <= avg <= max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        # Stricter mask before the average size, looser after it
+        self.mask_small = _high_mask(bits + 1)
+        self.mask_large = _high_mask(bits - 1)
+
+    def cut_point(self, data, start: int = 0) -> int:
+        """Length of the chunk starting at ``start`` in ``data``"""
+        remaining = len(data) - start
+        if remaining <= self.min_size:
+            return remaining
+
+        i = start + self.min_size
+        normal = start + min(self.avg_size, remaining)
+        limit = start + min(self.max_size, remaining)
+
+        h, cut = self._scan(data, i, normal, 0, self.mask_small)
+        if cut is None:
+            h, cut = self._scan(data, normal, limit, h, self.mask_large)
+        return (limit if cut is None else cut) - start
+
+    @staticmethod
+    def _scan(data, begin: int, end: int, h: int, mask: int):
+        """Roll the gear hash over data[begin:end]; returns (hash, cut position or None).
+
+        Blocks are first hashed without tracking positions, and only a block
+        that contains a boundary is re-scanned to locate it exactly.
+        """
+        gear_at = GEAR.__getitem__
+        for block_start in range(begin, end, _SCAN_BLOCK):
+            block_end = min(block_start + _SCAN_BLOCK, end)
+            block_hash = h
+            for value in map(gear_at, data[block_start:block_end]):
+                h = ((h << 1) + value) & _MASK32
+                if not h & mask:
+                    break
+            else:
+                continue
+
+            h = block_hash
+            for i in range(block_start, block_end):
+                h = ((h << 1) + GEAR[data[i]]) & _MASK32
+                if not h & mask:
+                    return h, i + 1
+        return h, None
+
+    def chunks(self, stream: BinaryIO) -> Iterator[bytes]:
+        """Yield content-defined chunks while reading ``stream`` incrementally"""
+        buffer = bytearray()
+        eof = False
+        emitted = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                block = stream.read(CHUNK_SIZE)
+                if block:
+                    buffer += block
+                else:
+                    eof = True
+            if not buffer:
+                # Always emit at least one chunk so empty files still get a chunk
+                if not emitted:
+                    yield b""
+                return
+
+            emitted = True
+            cut = self.cut_point(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
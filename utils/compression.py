@@ -1,32 +1,187 @@
 """Compression/decompression utilities for d-sync"""
 
+import fnmatch
+import threading
+import time
 import zlib
-from .config import COMPRESSION_LEVEL
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from .logger import Logger
+from .compression_codecs import get_codec
+from .config import (
+    COMPRESSION_ENABLED, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE, COMPRESSION_SKIP_EXTENSIONS,
+    COMPRESSION_SAMPLE_SIZE, COMPRESSION_SAMPLE_BLOCKS, COMPRESSION_MAX_RATIO, COMPRESSION_CODEC,
+    COMPRESSION_LEVELS, COMPRESSION_CODEC_RULES, COMPRESSION_COLD_CODEC, COMPRESSION_COLD_AGE_DAYS
+)
+
+# Files written before codecs were recorded used zlib
+DEFAULT_CODEC = 'zlib'
+
+logger = Logger(__name__)
+
+
+class _TimedCompressor:
+    """Incremental compressor that reports bytes and time to its manager"""
+
+    def __init__(self, manager: 'CompressionManager', codec: str):
+        self._manager = manager
+        self._compressor = get_codec(codec).compressor(manager.level_for(codec))
+
+    def compress(self, data: bytes) -> bytes:
+        started = time.perf_counter()
+        out = self._compressor.compress(data)
+        self._manager._note('compressed', len(data), time.perf_counter() - started)
+        return out
+
+    def flush(self) -> bytes:
+        started = time.perf_counter()
+        out = self._compressor.flush()
+        self._manager._note('compressed', 0, time.perf_counter() - started)
+        return out
 
 
 class CompressionManager:
-    """Manages file compression and decompression"""
+    """Manages file compression and decompression.
 
-    def __init__(self, level=COMPRESSION_LEVEL):
+    ``should_compress`` decides per file whether compression is worth the
+    CPU: files of a known compressed type are skipped, and other files are
+    sampled by trial-compressing a few evenly spaced blocks at level 1.
+    ``compress_chunk`` makes the same call per chunk after the fact, keeping
+    the plain bytes when compression did not pay off. ``select_codec``
+    picks the codec for a file; callers record it and pass it back to
+    decompress.
+    """
+
+    def __init__(self, level=COMPRESSION_LEVEL, codec: str = COMPRESSION_CODEC):
         self.level = level
+        self.codec = codec
+        self._lock = threading.Lock()
+        self._stats = {
+            'compressed_bytes': 0, 'compress_seconds': 0.0,
+            'skipped_files': 0, 'skipped_bytes': 0, 'sample_seconds': 0.0,
+            'plain_chunks': 0, 'plain_chunk_bytes': 0,
+        }
+
+    def _note(self, kind: str, size: int, seconds: float):
+        with self._lock:
+            if kind == 'compressed':
+                self._stats['compressed_bytes'] += size
+                self._stats['compress_seconds'] += seconds
+            elif kind == 'sampled':
+                self._stats['sample_seconds'] += seconds
+            elif kind == 'skipped':
+                self._stats['skipped_files'] += 1
+                self._stats['skipped_bytes'] += size
+            else:
+                self._stats['plain_chunks'] += 1
+                self._stats['plain_chunk_bytes'] += size
 
-    def compress_data(self, data: bytes) -> bytes:
-        """Compress data using zlib"""
-        return zlib.compress(data, self.level)
+    def should_compress(self, file_path: Path, size: int) -> bool:
+        """Whether to compress a file: big enough, not a compressed type, and samples shrink"""
+        if not COMPRESSION_ENABLED or size <= COMPRESSION_MIN_SIZE:
+            return False
+        if file_path.suffix.lower() in COMPRESSION_SKIP_EXTENSIONS:
+            logger.debug(f"Not compressing {file_path.name}: compressed file type")
+            self._note('skipped', size, 0.0)
+            return False
+        ratio = self.sample_ratio(file_path, size)
+        if ratio > COMPRESSION_MAX_RATIO:
+            logger.debug(f"Not compressing {file_path.name}: samples compress to {ratio:.0%}")
+            self._note('skipped', size, 0.0)
+            return False
+        return True
 
-    def decompress_data(self, compressed_data: bytes) -> bytes:
-        """Decompress data using zlib"""
-        return zlib.decompress(compressed_data)
+    def select_codec(self, relative_path: str, mtime: float) -> str:
+        """Codec for a file: the first matching path rule, else the cold or default codec"""
+        for pattern, codec in COMPRESSION_CODEC_RULES.items():
+            if fnmatch.fnmatch(relative_path, pattern):
+                return codec
+        if COMPRESSION_COLD_CODEC and time.time() - mtime > COMPRESSION_COLD_AGE_DAYS * 86400:
+            return COMPRESSION_COLD_CODEC
+        return self.codec
 
-    def compress_file(self, file_path) -> bytes:
+    def level_for(self, codec: str) -> int:
+        if codec == DEFAULT_CODEC:
+            return self.level
+        return COMPRESSION_LEVELS.get(codec, get_codec(codec).default_level)
+
+    def sample_ratio(self, file_path: Path, size: int) -> float:
+        """Compressed/original size of evenly spaced blocks, trial-compressed at level 1"""
+        started = time.perf_counter()
+        blocks = max(1, min(COMPRESSION_SAMPLE_BLOCKS, size // COMPRESSION_SAMPLE_SIZE))
+        step = (size - COMPRESSION_SAMPLE_SIZE) // (blocks - 1) if blocks > 1 else 0
+        sampled = packed = 0
+        try:
+            with open(file_path, 'rb') as f:
+                for index in range(blocks):
+                    f.seek(index * step)
+                    block = f.read(COMPRESSION_SAMPLE_SIZE)
+                    sampled += len(block)
+                    packed += len(zlib.compress(block, 1))
+        except OSError as e:
+            logger.debug(f"Could not sample {file_path}: {e}")
+            return 0.0
+        finally:
+            self._note('sampled', 0, time.perf_counter() - started)
+        return packed / sampled if sampled else 0.0
+
+    def compress_data(self, data: bytes, codec: Optional[str] = None) -> bytes:
+        """Compress data with a codec (the default codec if None)"""
+        codec = codec or self.codec
+        started = time.perf_counter()
+        out = get_codec(codec).compress(data, self.level_for(codec))
+        self._note('compressed', len(data), time.perf_counter() - started)
+        return out
+
+    def compress_chunk(self, data: bytes, codec: Optional[str] = None) -> Tuple[bytes, bool]:
+        """Compress a chunk; returns (stored bytes, compressed), keeping the plain bytes if smaller"""
+        out = self.compress_data(data, codec)
+        if len(out) > len(data) * COMPRESSION_MAX_RATIO:
+            self._note('plain_chunk', len(data), 0.0)
+            return data, False
+        return out, True
+
+    def decompress_data(self, compressed_data: bytes, codec: str = DEFAULT_CODEC) -> bytes:
+        """Decompress data written with a codec"""
+        return get_codec(codec).decompress(compressed_data)
+
+    def compressor(self, codec: Optional[str] = None):
+        """Return an incremental compressor"""
+        return _TimedCompressor(self, codec or self.codec)
+
+    def decompressor(self, codec: str = DEFAULT_CODEC):
+        """Return an incremental decompressor"""
+        return get_codec(codec).decompressor()
+
+    def compress_file(self, file_path, codec: Optional[str] = None) -> bytes:
         """Compress entire file and return compressed bytes"""
         with open(file_path, 'rb') as f:
             data = f.read()
-        return self.compress_data(data)
+        return self.compress_data(data, codec)
 
-    def decompress_file(self, compressed_data: bytes, output_path):
+    def decompress_file(self, compressed_data: bytes, output_path, codec: str = DEFAULT_CODEC):
         """Decompress data and write to file"""
-        decompressed_data = self.decompress_data(compressed_data)
+        decompressed_data = self.decompress_data(compressed_data, codec)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         with open(output_path, 'wb') as f:
             f.write(decompressed_data)
+
+    def stats(self) -> Dict:
+        """Bytes compressed and skipped; CPU saved is estimated from the measured compression rate"""
+        with self._lock:
+            stats = dict(self._stats)
+        rate = stats['compress_seconds'] / stats['compressed_bytes'] if stats['compressed_bytes'] else 0.0
+        stats['seconds_saved'] = round(stats['skipped_bytes'] * rate - stats['sample_seconds'], 2)
+        stats['compress_seconds'] = round(stats['compress_seconds'], 2)
+        stats['sample_seconds'] = round(stats['sample_seconds'], 3)
+        return stats
+
+    def log_stats(self):
+        stat = self.stats()
+        if stat['skipped_files'] or stat['plain_chunks']:
+            logger.info(
+                f"Compression: skipped {stat['skipped_files']} files ({stat['skipped_bytes']} bytes), "
+                f"saving ~{stat['seconds_saved']}s CPU (sampling took {stat['sample_seconds']}s); "
+                f"{stat['plain_chunks']} chunks stored plain; compressed {stat['compressed_bytes']} bytes "
+                f"in {stat['compress_seconds']}s"
+            )
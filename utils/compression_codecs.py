@@ -0,0 +1,219 @@
+"""Compression codec registry for d-sync"""
+
+import argparse
+import bz2
+import lzma
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec:
+    """A compression algorithm, usable on whole buffers or incrementally.
+
+    Incremental compressors and decompressors have ``compress``/``flush`` and
+    ``decompress``/``flush`` like zlib's.
+    """
+
+    name = ''
+    default_level = 6
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def compressor(self, level: int):
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+
+class _Decompressor:
+    """Gives decompressors without ``flush`` (lzma, bz2) the zlib interface"""
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        flush = getattr(self._decompressor, 'flush', None)
+        return flush() if flush else b''
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    default_level = 6
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def compressor(self, level):
+        return zlib.compressobj(level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    default_level = 6
+
+    def compress(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+    def compressor(self, level):
+        return lzma.LZMACompressor(preset=level)
+
+    def decompressor(self):
+        return _Decompressor(lzma.LZMADecompressor())
+
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+    default_level = 9
+
+    def compress(self, data, level):
+        return bz2.compress(data, max(1, level))
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+    def compressor(self, level):
+        return bz2.BZ2Compressor(max(1, level))
+
+    def decompressor(self):
+        return _Decompressor(bz2.BZ2Decompressor())
+
+
+class ZstdCodec(Codec):
+    """Zstandard, available when the ``zstandard`` package is installed"""
+
+    name = 'zstd'
+    default_level = 3
+
+    def compress(self, data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data):
+        # Frames written by compressobj do not record their size, so decompress as a stream
+        decompressor = self.decompressor()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def compressor(self, level):
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    def decompressor(self):
+        return _Decompressor(zstandard.ZstdDecompressor().decompressobj())
+
+
+_CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    """Codec by id; raises ValueError for unknown or unavailable codecs"""
+    codec = _CODECS.get(name)
+    if codec is None:
+        hint = " (install the zstandard package)" if name == 'zstd' else ""
+        raise ValueError(f"Compression codec {name!r} is not available{hint}")
+    return codec
+
+
+def available_codecs() -> List[str]:
+    return list(_CODECS)
+
+
+for _codec in (ZlibCodec(), LzmaCodec(), Bz2Codec()):
+    register_codec(_codec)
+if zstandard is not None:
+    register_codec(ZstdCodec())
+
+
+def _corpus(paths: List[Path], limit: int) -> List[bytes]:
+    """Up to limit bytes from each file under the given paths"""
+    samples = []
+    for root in paths:
+        files = [root] if root.is_file() else sorted(p for p in root.rglob('*') if p.is_file())
+        for file_path in files:
+            try:
+                with open(file_path, 'rb') as f:
+                    data = f.read(limit)
+            except OSError:
+                continue
+            if data:
+                samples.append(data)
+    return samples
+
+
+def benchmark(samples: List[bytes], codecs: Optional[Dict[str, List[int]]] = None) -> List[Dict]:
+    """Ratio and compress/decompress MB/s of each codec and level over the samples"""
+    total = sum(len(sample) for sample in samples)
+    results = []
+    for name, levels in (codecs or {name: [_CODECS[name].default_level] for name in _CODECS}).items():
+        codec = get_codec(name)
+        for level in levels:
+            started = time.perf_counter()
+            packed = [codec.compress(sample, level) for sample in samples]
+            compress_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            for sample, data in zip(samples, packed):
+                if codec.decompress(data) != sample:
+                    raise ValueError(f"{name} level {level} failed to round-trip")
+            decompress_seconds = time.perf_counter() - started
+            stored = sum(len(data) for data in packed)
+            results.append({
+                'codec': name, 'level': level,
+                'ratio': round(total / stored, 2) if stored else 0.0,
+                'compress_mbps': round(total / 1e6 / compress_seconds, 1) if compress_seconds else 0.0,
+                'decompress_mbps': round(total / 1e6 / decompress_seconds, 1) if decompress_seconds else 0.0,
+            })
+    return results
+
+
+def main():
+    """Benchmark codecs: python -m utils.compression_codecs PATH [PATH ...] [--levels zlib=1,6,9 lzma=0,6]"""
+    parser = argparse.ArgumentParser(description="d-sync compression codec benchmark")
+    parser.add_argument('paths', nargs='+', type=Path, help="files or directories to sample")
+    parser.add_argument('--levels', nargs='*', default=[], metavar='CODEC=L1,L2',
+                        help="levels to try per codec (default: each codec's default level)")
+    parser.add_argument('--limit', type=int, default=8 * 1024 * 1024, help="bytes read per file")
+    args = parser.parse_args()
+
+    codecs = {name: [_CODECS[name].default_level] for name in _CODECS}
+    for spec in args.levels:
+        name, _, levels = spec.partition('=')
+        get_codec(name)
+        codecs[name] = [int(level) for level in levels.split(',') if level]
+
+    samples = _corpus(args.paths, args.limit)
+    if not samples:
+        raise SystemExit("No readable files found")
+    print(f"{len(samples)} files, {sum(len(s) for s in samples) / 1e6:.1f} MB")
+    print(f"{'codec':<6} {'level':>5} {'ratio':>7} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for row in benchmark(samples, codecs):
+        print(f"{row['codec']:<6} {row['level']:>5} {row['ratio']:>7} "
+              f"{row['compress_mbps']:>10} {row['decompress_mbps']:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -17,12 +17,90 @@ MIN_PARTITION_SIZE = 1024  # 1 KB minimum
 WEBHOOKS_FILE = BASE_DIR / "webhooks.txt"
 FOLDERS_JSON = BASE_DIR / "folders.json"
 FILES_JSON = BASE_DIR / "files.json"
+# SQLite store holding file and folder metadata; files.json and
+# folders.json are exported from it
+METADATA_DB = BASE_DIR / "d-sync.db"
 
 # Webhook options
 WEBHOOK_WAIT_PARAM = "?wait=true"
+WEBHOOK_MAX_IN_FLIGHT = 2  # Concurrent requests allowed per webhook
+RATE_LIMIT_MAX_RETRIES = 5  # 429 responses tolerated per request before giving up
+WEBHOOK_MAX_ATTACHMENTS = 10  # Discord's per-message attachment limit
+
+# Small uploads (chunks of small files, folder metadata) share webhook messages
+BATCH_ATTACHMENT_THRESHOLD = 1024 * 1024  # Uploads up to 1 MB are batched
+BATCH_MAX_BYTES = int(MAX_PARTITION_SIZE)  # Total attachment bytes per message
+BATCH_MAX_DELAY = 2.0  # Seconds a partial batch may wait for more attachments
+
+# HTTP transport (shared keep-alive connection pools)
+HTTP_POOL_CONNECTIONS = 10  # Hosts with a cached connection pool
+HTTP_POOL_MAXSIZE = 16  # Keep-alive connections per host; keep >= UPLOAD_CONCURRENCY
+HTTP_CONNECT_TIMEOUT = 10  # Seconds
+HTTP_READ_TIMEOUT = 60  # Seconds
+HTTP_TIMING_SAMPLES = 1000  # Recent per-request timings kept for inspection
+
+# Upload concurrency
+UPLOAD_CONCURRENCY = 8  # Chunk uploads in flight at once, spread over all webhooks
+FILE_UPLOAD_CONCURRENCY = 4  # Files processed in parallel during a scan
+# Upload priority classes, highest first; a file takes the first class whose
+# rules all match. Rules: "source" ("web", "watch" or "scan"), "max_size" and
+# "min_size" (bytes), "patterns" (globs on the relative path), "max_age_days"
+# (since last modified). Scans start files in class order, smallest first, and
+# busy classes share the upload workers in proportion to their weights, so a
+# huge file keeps moving without holding up small ones.
+UPLOAD_PRIORITY_CLASSES = [
+    {"name": "web", "weight": 8, "source": "web"},
+    {"name": "small", "weight": 4, "max_size": 16 * 1024 * 1024},
+    {"name": "recent", "weight": 2, "max_age_days": 1},
+    {"name": "bulk", "weight": 1},
+]
+# Class for uploads not made on behalf of one file: pack blobs, folder
+# metadata and attachment batches holding only those. They are small and
+# other files wait on them, so they go with small files rather than bulk.
+UPLOAD_DEFAULT_CLASS = "small"
+
+# Bandwidth shaping, in bytes per second (0 = unlimited). During the hours of
+# a BANDWIDTH_SCHEDULE entry its "upload"/"download" limits apply instead
+# (first match wins; "days" like "mon-fri", "end" may be past midnight).
+# Limits set from the web dashboard override both until cleared.
+UPLOAD_RATE_LIMIT = 0
+DOWNLOAD_RATE_LIMIT = 0
+BANDWIDTH_SCHEDULE = [
+    # {"days": "mon-fri", "start": "09:00", "end": "18:00", "upload": 2 * 1024 * 1024},
+]
+BANDWIDTH_BURST_SECONDS = 1.0  # Bucket size, in seconds at the limit
+BANDWIDTH_REFRESH_INTERVAL = 5.0  # Seconds between re-reading limits (schedule, dashboard)
+BANDWIDTH_WINDOW = 10.0  # Seconds of traffic behind the measured rate
+
+# Pack files: small files are concatenated (each encrypted separately) into
+# shared pack blobs of up to MAX_PARTITION_SIZE
+PACK_SMALL_FILES = False
+PACK_FILE_THRESHOLD = 100 * 1024  # Files up to 100 KB are packed
+PACK_CACHE_SIZE = 4  # Downloaded packs kept in memory while restoring
+
+# Incremental scanning: (inode, size, mtime_ns) of synced files and cached
+# directory listings, so unchanged parts of the tree are not re-examined
+STAT_CACHE_FILE = BASE_DIR / "stat_cache.json"
+
+# Watch mode: "inotify" reacts to filesystem events (Linux), "poll" rescans
+# every interval, "auto" uses inotify where available
+WATCH_MODE = "auto"
+WATCH_DEBOUNCE = 2.0  # Seconds a closed file must stay quiet before upload
+WATCH_SETTLE_TIMEOUT = 30.0  # Seconds before a file written without closing is uploaded
+
+# Modified files are re-uploaded (only chunks whose content changed are sent);
+# this many earlier versions are kept in each entry's "versions" list
+FILE_VERSIONS_KEPT = 5
 
 # Files.json remote metadata (stores webhook and message id)
 FILES_JSON_UPLOAD_META = BASE_DIR / "files_json_remote.json"
+# Metadata changes are pushed to the remote manifest at most this often
+# (seconds); pending changes are also flushed after each scan and on shutdown
+MANIFEST_SYNC_INTERVAL = 30.0
+# Hex digits of the path hash that pick a file's remote manifest shard (2 = 256 shards)
+MANIFEST_SHARD_PREFIX = 2
+# Remote manifest encoding: "binary" (compressed, interned URLs) or "json"
+MANIFEST_ENCODING = "binary"
 
 # Logging
 LOG_FILE = LOGS_DIR / "d-sync.log"
@@ -32,14 +110,78 @@ DOWNLOAD_LOG_FILE = LOGS_DIR / "download.log"
 # Encryption
 ENCRYPTION_ENABLED = True
 ENCRYPTION_KEY_FILE = BASE_DIR / ".encryption_key"
+# Format for new uploads: "aesgcm-hkdf-v1" (AES-256-GCM over segments under a
+# per-stream HKDF key, raw binary output) or "fernet" (base64 output, a third larger). Each entry records its
+# format, so stored files always decrypt.
+ENCRYPTION_FORMAT = "aesgcm-hkdf-v1"
+ENCRYPTION_SEGMENT_SIZE = 1024 * 1024  # Plaintext bytes per authenticated segment
 
 # Compression
 COMPRESSION_ENABLED = True
 COMPRESSION_LEVEL = 6  # 0-9, 6 is default
+# Codec for new files: "zlib", "lzma", "bz2" or "zstd" (needs the zstandard package).
+# The codec is recorded per file, so changing it never affects stored files.
+COMPRESSION_CODEC = "zlib"
+COMPRESSION_LEVELS = {"zlib": COMPRESSION_LEVEL, "lzma": 6, "bz2": 9, "zstd": 3}
+# Glob on the relative path -> codec, first match wins, e.g. {"archive/*": "lzma"}
+COMPRESSION_CODEC_RULES = {}
+# Codec for files not modified for COMPRESSION_COLD_AGE_DAYS (None keeps COMPRESSION_CODEC)
+COMPRESSION_COLD_CODEC = None
+COMPRESSION_COLD_AGE_DAYS = 30
+COMPRESSION_MIN_SIZE = 100 * 1024  # Files up to 100 KB are stored uncompressed
+# Already-compressed formats; these are never compressed again
+COMPRESSION_SKIP_EXTENSIONS = {
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.m4v', '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.epub', '.jar', '.apk',
+}
+# Other files are sampled: this many evenly spaced blocks are trial-compressed,
+# and the file is compressed only if they shrink to COMPRESSION_MAX_RATIO or less
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SAMPLE_BLOCKS = 4
+COMPRESSION_MAX_RATIO = 0.9
+
+# Hash for new file and chunk hashes: "sha256" or "blake2b" (faster in pure
+# software). Each stored hash records its algorithm, so both always verify.
+HASH_ALGORITHM = "sha256"
 
 # Chunk size for reading files
 CHUNK_SIZE = 1024 * 1024  # 1 MB
 
+# File layouts (stored as 'layout' in files.json; entries without it are 'whole')
+LAYOUT_WHOLE = "whole"  # whole file compressed + encrypted, then partitioned
+LAYOUT_STREAM = "stream"  # one compressed stream, each partition encrypted on its own
+LAYOUT_PACK = "pack"  # file encrypted on its own and stored at an offset inside a shared pack
+LAYOUT_CDC = "cdc"  # content-defined chunks, each compressed + encrypted on its own
+LAYOUT_FRAMES = "frames"  # fixed-size frames, each compressed + encrypted on its own, in parallel
+
+# Plaintext bytes per streamed partition, keeping every encrypted partition under
+# MAX_PARTITION_SIZE. Fernet base64-encodes its output (4/3 expansion plus
+# header/HMAC); aesgcm-hkdf-v1 adds 16 bytes per segment and a 47-byte header.
+if ENCRYPTION_FORMAT == "fernet":
+    STREAM_SEGMENT_SIZE = int(MAX_PARTITION_SIZE * 3 / 4) - 1024
+else:
+    STREAM_SEGMENT_SIZE = int(MAX_PARTITION_SIZE) - 4 * 1024
+
+# Chunking mode for new uploads: "fixed" (streamed fixed-size partitions) or
+# "cdc" (content-defined chunks deduplicated across files; CPU-heavier)
+CHUNKING_MODE = "fixed"
+CDC_MIN_SIZE = 512 * 1024
+CDC_AVG_SIZE = 2 * 1024 * 1024
+# Under STREAM_SEGMENT_SIZE, which already allows for the encryption overhead
+# of either format (Fernet or aesgcm-hkdf-v1). Chunks that do not shrink are stored
+# uncompressed, so the extra 64KB is headroom, not room for codec expansion
+CDC_MAX_SIZE = STREAM_SEGMENT_SIZE - 64 * 1024
+
+# Files larger than this are split into frames, each compressed and encrypted on
+# its own by COMPRESSION_WORKERS threads (zlib, lzma and bz2 release the GIL, so
+# threads use every core). Frames record their plaintext offset, so a byte range
+# can be restored by fetching only the frames that cover it.
+FRAME_SIZE = STREAM_SEGMENT_SIZE  # Plaintext bytes per frame; frames that do not shrink are stored plain
+FRAME_LAYOUT_THRESHOLD = FRAME_SIZE
+COMPRESSION_WORKERS = os.cpu_count() or 1
+
 # Ensure directories exist
 D_SYNCED_DIR.mkdir(parents=True, exist_ok=True)
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
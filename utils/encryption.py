@@ -1,18 +1,144 @@
 """Encryption/decryption utilities for d-sync"""
 
-from cryptography.fernet import Fernet
-from pathlib import Path
+import base64
 import os
-from .config import ENCRYPTION_KEY_FILE
+import struct
+from pathlib import Path
+from typing import Optional
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from .config import ENCRYPTION_KEY_FILE, ENCRYPTION_FORMAT, ENCRYPTION_SEGMENT_SIZE
+
+# Encryption formats, recorded as 'encryption' in files.json; entries without it are Fernet
+FORMAT_FERNET = 'fernet'
+FORMAT_AESGCM = 'aesgcm-hkdf-v1'
+
+# aesgcm-hkdf-v1 layout, after Tink's AES-GCM-HKDF streaming AEAD: header
+# (magic, segment size, 32-byte random salt, 7-byte random nonce prefix), then
+# segments of up to segment-size plaintext bytes, each followed by its 16-byte
+# tag. Every stream is encrypted under its own key, derived from the master key
+# and the stream's salt, so the short nonce prefix never has to be unique
+# across the many streams (chunks, frames, packs) made with one key file.
+# Segment i uses the nonce prefix + i (uint32) + a last-segment flag, and
+# authenticates the header, so segments cannot be reordered, dropped, or cut
+# off at a segment boundary.
+_MAGIC = b'DSE\x02'
+_SALT_SIZE = 32
+_HEADER = struct.Struct(f'>4sI{_SALT_SIZE}s7s')
+_TAG_SIZE = 16
+_KDF_INFO = b'd-sync aesgcm-hkdf-v1'
+
+
+def _stream_aead(master_key: bytes, salt: bytes) -> AESGCM:
+    """AES-256-GCM under the key for one stream, from the master key with HKDF-SHA256"""
+    return AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=_KDF_INFO).derive(master_key))
+
+
+class _SegmentCipher:
+    """Nonces and AEAD calls shared by the stream encryptor and decryptor"""
+
+    def __init__(self, master_key: bytes, header: bytes):
+        _, _, salt, _ = _HEADER.unpack(header)
+        self._aead = _stream_aead(master_key, salt)
+        self._header = header
+        self._prefix = header[-7:]
+        self._index = 0
+
+    def _nonce(self, last: bool) -> bytes:
+        if self._index > 0xFFFFFFFF:
+            raise ValueError("Too many segments in one encrypted stream")
+        nonce = self._prefix + struct.pack('>IB', self._index, int(last))
+        self._index += 1
+        return nonce
+
+    def seal(self, segment: bytes, last: bool) -> bytes:
+        return self._aead.encrypt(self._nonce(last), segment, self._header)
+
+    def open(self, segment: bytes, last: bool) -> bytes:
+        try:
+            return self._aead.decrypt(self._nonce(last), segment, self._header)
+        except InvalidTag:
+            raise ValueError("Encrypted data failed authentication") from None
+
+
+class StreamEncryptor:
+    """Incremental aesgcm-hkdf-v1 encryption: ``update`` then ``finalize``, raw binary output"""
+
+    def __init__(self, master_key: bytes, segment_size: int = ENCRYPTION_SEGMENT_SIZE):
+        self.segment_size = segment_size
+        header = _HEADER.pack(_MAGIC, segment_size, os.urandom(_SALT_SIZE), os.urandom(7))
+        self._cipher = _SegmentCipher(master_key, header)
+        self._pending = bytearray(header)  # Output not yet returned
+        self._buffer = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        # Keep at least one byte back: the final segment must be sealed as last
+        while len(self._buffer) > self.segment_size:
+            self._pending += self._cipher.seal(bytes(self._buffer[:self.segment_size]), last=False)
+            del self._buffer[:self.segment_size]
+        out, self._pending = bytes(self._pending), bytearray()
+        return out
+
+    def finalize(self) -> bytes:
+        out = bytes(self._pending) + self._cipher.seal(bytes(self._buffer), last=True)
+        self._pending, self._buffer = bytearray(), bytearray()
+        return out
+
+
+class StreamDecryptor:
+    """Incremental aesgcm-hkdf-v1 decryption; ``finalize`` fails if the stream was cut short"""
+
+    def __init__(self, master_key: bytes):
+        self._master_key = master_key
+        self._cipher: Optional[_SegmentCipher] = None
+        self._sealed_size = 0
+        self._buffer = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        if self._cipher is None:
+            if len(self._buffer) < _HEADER.size:
+                return b''
+            header = bytes(self._buffer[:_HEADER.size])
+            magic, segment_size, _, _ = _HEADER.unpack(header)
+            if magic != _MAGIC or segment_size <= 0:
+                raise ValueError("Not an aesgcm-hkdf-v1 encrypted stream")
+            del self._buffer[:_HEADER.size]
+            self._cipher = _SegmentCipher(self._master_key, header)
+            self._sealed_size = segment_size + _TAG_SIZE
+
+        out = bytearray()
+        while len(self._buffer) > self._sealed_size:
+            out += self._cipher.open(bytes(self._buffer[:self._sealed_size]), last=False)
+            del self._buffer[:self._sealed_size]
+        return bytes(out)
+
+    def finalize(self) -> bytes:
+        if self._cipher is None or len(self._buffer) < _TAG_SIZE:
+            raise ValueError("Encrypted stream is truncated")
+        out = self._cipher.open(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        return out
 
 
 class EncryptionManager:
-    """Manages file encryption and decryption"""
+    """Manages file encryption and decryption.
 
-    def __init__(self):
+    New data is encrypted in ``ENCRYPTION_FORMAT``; aesgcm-hkdf-v1 derives
+    its per-stream keys from the Fernet key, so one key file decrypts both
+    formats.
+    """
+
+    def __init__(self, scheme: str = ENCRYPTION_FORMAT):
         self.key_file = ENCRYPTION_KEY_FILE
         self.key = self._load_or_create_key()
         self.cipher = Fernet(self.key)
+        self.scheme = scheme
+        self._master_key = base64.urlsafe_b64decode(self.key.strip())
 
     def _load_or_create_key(self) -> bytes:
         """Load encryption key from file or create a new one"""
@@ -27,13 +153,29 @@ class EncryptionManager:
             os.chmod(self.key_file, 0o600)
             return key
 
+    def encryptor(self) -> StreamEncryptor:
+        return StreamEncryptor(self._master_key)
+
+    def decryptor(self) -> StreamDecryptor:
+        return StreamDecryptor(self._master_key)
+
     def encrypt_data(self, data: bytes) -> bytes:
-        """Encrypt data using Fernet symmetric encryption"""
-        return self.cipher.encrypt(data)
+        """Encrypt data in the configured format"""
+        if self.scheme == FORMAT_FERNET:
+            return self.cipher.encrypt(data)
+        encryptor = self.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
 
-    def decrypt_data(self, encrypted_data: bytes) -> bytes:
-        """Decrypt data using Fernet symmetric decryption"""
-        return self.cipher.decrypt(encrypted_data)
+    def decrypt_data(self, encrypted_data: bytes, scheme: Optional[str] = None) -> bytes:
+        """Decrypt data in the given format, or the one its header shows if None"""
+        if scheme is None:
+            scheme = FORMAT_AESGCM if encrypted_data[:len(_MAGIC)] == _MAGIC else FORMAT_FERNET
+        if scheme == FORMAT_FERNET:
+            return self.cipher.decrypt(encrypted_data)
+        if scheme != FORMAT_AESGCM:
+            raise ValueError(f"Unknown encryption format {scheme!r}")
+        decryptor = self.decryptor()
+        return decryptor.update(encrypted_data) + decryptor.finalize()
 
     def encrypt_file(self, file_path: Path) -> bytes:
         """Encrypt entire file and return encrypted bytes"""
@@ -41,9 +183,9 @@ class EncryptionManager:
             data = f.read()
         return self.encrypt_data(data)
 
-    def decrypt_file(self, encrypted_data: bytes, output_path: Path):
+    def decrypt_file(self, encrypted_data: bytes, output_path: Path, scheme: Optional[str] = None):
         """Decrypt data and write to file"""
-        decrypted_data = self.decrypt_data(encrypted_data)
+        decrypted_data = self.decrypt_data(encrypted_data, scheme)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         with open(output_path, 'wb') as f:
             f.write(decrypted_data)
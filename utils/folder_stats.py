@@ -0,0 +1,92 @@
+"""Recursive folder statistics for d-sync"""
+
+import os
+import threading
+from typing import Dict, List, Set, Tuple
+
+
+class FolderStats:
+    """File and subfolder counts for every directory in the tree.
+
+    Counts are built once, bottom-up, from directory listings and then kept
+    current by applying each directory's change to it and its ancestors, so
+    an added or removed entry costs O(depth) rather than a rescan.
+    """
+
+    def __init__(self):
+        self._totals: Dict[str, List[int]] = {}  # relative dir -> [file_count, folder_count]
+        self._dirty: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def rebuild(self, listings: Dict[str, Dict]):
+        """Compute every folder's counts in one pass over {relative dir: {files, dirs}}"""
+        totals = {}
+        # Deepest directories first, so children are summed before their parents
+        for relative_dir in sorted(listings, key=self._depth, reverse=True):
+            listing = listings[relative_dir]
+            file_count, folder_count = len(listing['files']), len(listing['dirs'])
+            for name in listing['dirs']:
+                child = totals.get(os.path.join(relative_dir, name) if relative_dir else name)
+                if child:
+                    file_count += child[0]
+                    folder_count += child[1]
+            totals[relative_dir] = [file_count, folder_count]
+        with self._lock:
+            self._totals = totals
+            self._dirty = set(totals)
+
+    def counts(self, relative_dir: str) -> Tuple[int, int]:
+        """(file_count, folder_count) below a directory"""
+        with self._lock:
+            total = self._totals.get(relative_dir, (0, 0))
+            return total[0], total[1]
+
+    def adjust(self, relative_dir: str, files: int, folders: int):
+        """Apply a change in a directory's direct entries to it and its ancestors"""
+        if not files and not folders:
+            return
+        with self._lock:
+            for path in self._lineage(relative_dir):
+                total = self._totals.setdefault(path, [0, 0])
+                total[0] += files
+                total[1] += folders
+                self._dirty.add(path)
+
+    def remove_tree(self, relative_dir: str):
+        """Forget a removed directory and subtract its contents from its ancestors.
+
+        The directory itself is accounted for by its parent's listing change.
+        """
+        with self._lock:
+            total = self._totals.get(relative_dir)
+            if total is None:
+                return
+            prefix = relative_dir + os.sep
+            for path in [p for p in self._totals if p == relative_dir or p.startswith(prefix)]:
+                del self._totals[path]
+                self._dirty.discard(path)
+            for path in self._lineage(os.path.dirname(relative_dir)):
+                if path in self._totals:
+                    self._totals[path][0] -= total[0]
+                    self._totals[path][1] -= total[1]
+                    self._dirty.add(path)
+
+    def take_dirty(self) -> Dict[str, Tuple[int, int]]:
+        """Counts of directories that changed since the last call"""
+        with self._lock:
+            dirty = {path: tuple(self._totals[path]) for path in self._dirty if path in self._totals}
+            self._dirty.clear()
+            return dirty
+
+    @staticmethod
+    def _depth(relative_dir: str) -> int:
+        return relative_dir.count(os.sep) + 1 if relative_dir else 0
+
+    @staticmethod
+    def _lineage(relative_dir: str) -> List[str]:
+        """The directory and each of its ancestors up to the root ('')"""
+        paths = [relative_dir]
+        while relative_dir:
+            relative_dir = os.path.dirname(relative_dir)
+            paths.append(relative_dir)
+        return paths
@@ -2,28 +2,103 @@
 
 import hashlib
 from pathlib import Path
-from typing import Tuple
+from typing import List
 from .config import CHUNK_SIZE
 
+# Hash algorithms for file and chunk hashes. SHA-256 digests are stored as bare
+# hex (as they always were); others carry their name, e.g. "blake2b:<hex>", so
+# every stored hash says how to verify it.
+DEFAULT_ALGORITHM = 'sha256'
+ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+
+
+class Hasher:
+    """Incremental hash whose hexdigest is in the stored format"""
+
+    def __init__(self, algorithm: str = DEFAULT_ALGORITHM):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm!r}")
+        self.algorithm = algorithm
+        self._hash = ALGORITHMS[algorithm]()
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+
+    def hexdigest(self) -> str:
+        return HashManager.format_digest(self._hash.digest(), self.algorithm)
+
 
 class HashManager:
     """Manages file hashing operations"""
 
     @staticmethod
-    def calculate_file_hash(file_path: Path) -> str:
-        """Calculate SHA256 hash of a file"""
-        sha256_hash = hashlib.sha256()
+    def algorithm_of(digest: str) -> str:
+        """Algorithm a stored hash was made with"""
+        name, sep, _ = digest.partition(':')
+        return name if sep else DEFAULT_ALGORITHM
+
+    @staticmethod
+    def format_digest(digest: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+        if algorithm == DEFAULT_ALGORITHM:
+            return digest.hex()
+        return f"{algorithm}:{digest.hex()}"
+
+    @staticmethod
+    def hasher(algorithm: str = DEFAULT_ALGORITHM) -> Hasher:
+        """Return an incremental hasher"""
+        return Hasher(algorithm)
+
+    @staticmethod
+    def calculate_file_hash(file_path: Path, algorithm: str = DEFAULT_ALGORITHM) -> str:
+        """Calculate the hash of a file (SHA256 by default)"""
+        file_hash = Hasher(algorithm)
         with open(file_path, "rb") as f:
             for byte_block in iter(lambda: f.read(CHUNK_SIZE), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+                file_hash.update(byte_block)
+        return file_hash.hexdigest()
 
     @staticmethod
-    def calculate_data_hash(data: bytes) -> str:
-        """Calculate SHA256 hash of bytes"""
-        return hashlib.sha256(data).hexdigest()
+    def calculate_data_hash(data: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+        """Calculate the hash of bytes (SHA256 by default)"""
+        data_hash = Hasher(algorithm)
+        data_hash.update(data)
+        return data_hash.hexdigest()
 
     @staticmethod
-    def calculate_chunk_hash(data: bytes) -> str:
-        """Calculate SHA256 hash of a chunk"""
-        return hashlib.sha256(data).hexdigest()
+    def calculate_chunk_hash(data: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+        """Calculate the hash of a chunk (SHA256 by default)"""
+        return HashManager.calculate_data_hash(data, algorithm)
+
+    @staticmethod
+    def verify(data: bytes, expected: str) -> bool:
+        """Whether data matches a stored hash, in whichever algorithm made it"""
+        return HashManager.calculate_data_hash(data, HashManager.algorithm_of(expected)) == expected
+
+    @staticmethod
+    def merkle_root(leaf_hashes: List[str]) -> str:
+        """Root of a binary Merkle tree over chunk hashes, in their algorithm.
+
+        Leaves are H(0x00 || chunk digest) and inner nodes H(0x01 || left ||
+        right); an odd node at the end of a level moves up unchanged.
+        """
+        algorithm = HashManager.algorithm_of(leaf_hashes[0]) if leaf_hashes else DEFAULT_ALGORITHM
+        new = ALGORITHMS[algorithm]
+
+        def node(*parts: bytes) -> bytes:
+            h = new()
+            for part in parts:
+                h.update(part)
+            return h.digest()
+
+        level = [node(b'\x00', bytes.fromhex(leaf.rpartition(':')[2])) for leaf in leaf_hashes]
+        if not level:
+            return HashManager.format_digest(node(b''), algorithm)
+        while len(level) > 1:
+            level = [
+                node(b'\x01', level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                for i in range(0, len(level), 2)
+            ]
+        return HashManager.format_digest(level[0], algorithm)
@@ -0,0 +1,204 @@
+"""Linux inotify watcher for d-sync"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .logger import Logger
+from .config import WATCH_DEBOUNCE, WATCH_SETTLE_TIMEOUT
+
+logger = Logger(__name__)
+
+# Event bits from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; followed by the name
+
+
+def _load_libc():
+    """libc with the inotify calls, or None where inotify does not exist"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class InotifyWatcher:
+    """Recursive inotify watch of a directory tree.
+
+    ``poll`` returns files whose writes have settled: closed after writing
+    or moved in, with no further events for ``debounce`` seconds. Files that
+    are opened but never closed (e.g. hard links) are reported once idle for
+    ``settle_timeout`` seconds. Directories created or moved into the tree are
+    watched as they appear and their existing files reported. Files and
+    directories deleted or moved out are reported as removed. A kernel queue
+    overflow is reported so the caller can rescan instead.
+    """
+
+    def __init__(self, root: Path, debounce: float = WATCH_DEBOUNCE,
+                 settle_timeout: float = WATCH_SETTLE_TIMEOUT):
+        self._libc = _load_libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.root = root
+        self.debounce = debounce
+        self.settle_timeout = settle_timeout
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self._dirs: Dict[int, Path] = {}  # watch descriptor -> directory
+        self._pending: Dict[Path, float] = {}  # file -> time it is considered settled
+        self._new_dirs: List[Path] = []
+        self._removed: List[Path] = []
+        self._overflowed = False
+        try:
+            # Files already present are left to the caller's initial scan
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    @staticmethod
+    def available() -> bool:
+        return _load_libc() is not None
+
+    def add_tree(self, directory: Path) -> Tuple[List[Path], List[Path]]:
+        """Watch a directory and everything below it; returns (files, directories) found.
+
+        Each directory is watched before it is listed, so a file created in
+        between is reported by both and never missed.
+        """
+        files, directories = [], []
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            if not self._add_watch(current):
+                continue
+            directories.append(current)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+                        elif entry.is_file():
+                            files.append(Path(entry.path))
+            except OSError as e:
+                logger.debug(f"Could not list {current}: {e}")
+        return files, directories
+
+    def _add_watch(self, directory: Path) -> bool:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+            return True
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            # Out of watches; the caller must not trust event-driven sync
+            raise OSError(err, "inotify watch limit reached (fs.inotify.max_user_watches)")
+        logger.debug(f"Could not watch {directory}: {os.strerror(err)}")
+        return False
+
+    def _remove_tree(self, directory: Path):
+        """Stop watching a directory that left the tree, and everything below it"""
+        for wd, path in list(self._dirs.items()):
+            if path == directory or directory in path.parents:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+        for path in [p for p in self._pending if directory in p.parents]:
+            del self._pending[path]
+
+    def poll(self, timeout: float) -> Tuple[List[Path], List[Path], List[Path], bool]:
+        """Wait up to timeout seconds.
+
+        Returns (settled files, new directories, removed paths, overflowed).
+        """
+        now = time.monotonic()
+        if self._pending:
+            timeout = max(0.0, min(timeout, min(self._pending.values()) - now))
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            self._read_events()
+
+        now = time.monotonic()
+        settled = [path for path, deadline in self._pending.items() if deadline <= now]
+        for path in settled:
+            del self._pending[path]
+        new_dirs, self._new_dirs = self._new_dirs, []
+        removed, self._removed = self._removed, []
+        overflowed, self._overflowed = self._overflowed, False
+        return settled, new_dirs, removed, overflowed
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                start = offset + _EVENT.size
+                name = os.fsdecode(data[start:start + length].rstrip(b'\0'))
+                offset = start + length
+                self._handle(wd, mask, name)
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self._overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self._dirs.pop(wd, None)
+            return
+        directory: Optional[Path] = self._dirs.get(wd)
+        if directory is None or mask & IN_DELETE_SELF:
+            return
+
+        path = directory / name
+        now = time.monotonic()
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                files, directories = self.add_tree(path)
+                self._new_dirs += directories
+                for file_path in files:
+                    self._pending[file_path] = now + self.debounce
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._remove_tree(path)
+                self._removed.append(path)
+            return
+
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._pending[path] = now + self.debounce
+        elif mask & (IN_CREATE | IN_MODIFY):
+            # Still being written; wait for the close, or for it to go quiet
+            self._pending[path] = now + max(self.debounce, self.settle_timeout)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._pending.pop(path, None)
+            self._removed.append(path)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
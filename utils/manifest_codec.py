@@ -0,0 +1,151 @@
+"""Compact binary manifest encoding for d-sync"""
+
+import argparse
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+# Header: magic and format version, then a zlib stream holding the string
+# tables and the manifest body as two lines of compact JSON
+MAGIC = b'DSYNCMF'
+CODEC_VERSION = 1
+_HEADER = struct.Struct('>7sB')
+
+# Keys whose string values are replaced by indexes into the string tables,
+# in chunk records only (items of a "chunks" list, in entries and their
+# versions); elsewhere, e.g. as file paths, they are ordinary keys
+_WEBHOOK_KEY = 'webhook_url'
+_URL_KEY = 'cdn_url'
+_CHUNKS_KEY = 'chunks'
+
+
+class _Interner:
+    """String table that hands out an index per distinct value, in first-seen order"""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def add(self, value: str) -> int:
+        index = self._index.get(value)
+        if index is None:
+            index = self._index[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+
+def _split_url(url: str) -> Tuple[str, str]:
+    """Split a CDN URL after its channel, so attachments in one channel share a prefix"""
+    base = url.partition('?')[0]
+    prefix = base.rsplit('/', 2)[0] if base.count('/') > 3 else ''
+    return prefix, url[len(prefix):]
+
+
+def _pack_record(record: Dict, webhooks: _Interner, prefixes: _Interner) -> Dict:
+    packed = dict(record)
+    webhook = record.get(_WEBHOOK_KEY)
+    if isinstance(webhook, str):
+        packed[_WEBHOOK_KEY] = webhooks.add(webhook)
+    elif _WEBHOOK_KEY in record:
+        # Anything but a string (e.g. None) is kept verbatim, marked as such
+        packed[_WEBHOOK_KEY] = {'raw': webhook}
+    url = record.get(_URL_KEY)
+    if isinstance(url, str):
+        prefix, rest = _split_url(url)
+        packed[_URL_KEY] = [prefixes.add(prefix), rest]
+    elif _URL_KEY in record:
+        packed[_URL_KEY] = {'raw': url}
+    return packed
+
+
+def _unpack_record(record: Dict, webhooks: List[str], prefixes: List[str]) -> Dict:
+    webhook = record.get(_WEBHOOK_KEY)
+    if webhook is not None:
+        record[_WEBHOOK_KEY] = webhooks[webhook] if isinstance(webhook, int) else webhook['raw']
+    url = record.get(_URL_KEY)
+    if url is not None:
+        record[_URL_KEY] = prefixes[url[0]] + url[1] if isinstance(url, list) else url['raw']
+    return record
+
+
+def _walk_chunks(value: Any, record_fn) -> Any:
+    """Copy of value with record_fn applied to every chunk record"""
+    if isinstance(value, dict):
+        return {
+            key: [record_fn(item) if isinstance(item, dict) else item for item in item_value]
+            if key == _CHUNKS_KEY and isinstance(item_value, list) else _walk_chunks(item_value, record_fn)
+            for key, item_value in value.items()
+        }
+    if isinstance(value, list):
+        return [_walk_chunks(item, record_fn) for item in value]
+    return value
+
+
+def is_binary_manifest(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_manifest(manifest: Dict, level: int = 9) -> bytes:
+    """Encode a files.json-style dict; the same dict always gives the same bytes"""
+    webhooks, prefixes = _Interner(), _Interner()
+    # Keys are sorted first so table indexes do not depend on insertion order
+    canonical = json.loads(json.dumps(manifest, sort_keys=True))
+    body = _walk_chunks(canonical, lambda record: _pack_record(record, webhooks, prefixes))
+    # The string tables come first, then the body that indexes into them
+    tables = json.dumps([webhooks.values, prefixes.values], separators=(',', ':'))
+    payload = (tables + '\n' + json.dumps(body, sort_keys=True, separators=(',', ':'))).encode('utf-8')
+    return _HEADER.pack(MAGIC, CODEC_VERSION) + zlib.compress(payload, level)
+
+
+def decode_manifest(data: bytes) -> Dict:
+    """Decode bytes written by encode_manifest"""
+    if len(data) < _HEADER.size or not is_binary_manifest(data):
+        raise ValueError("not a binary d-sync manifest")
+    _, version = _HEADER.unpack_from(data)
+    if version > CODEC_VERSION:
+        raise ValueError(f"manifest version {version} is newer than supported ({CODEC_VERSION})")
+    tables, _, body = zlib.decompress(data[_HEADER.size:]).partition(b'\n')
+    webhooks, prefixes = json.loads(tables)
+    return _walk_chunks(json.loads(body), lambda record: _unpack_record(record, webhooks, prefixes))
+
+
+def parse_manifest(data: bytes) -> Dict:
+    """Decode a manifest in either the binary or the JSON format"""
+    if is_binary_manifest(data):
+        return decode_manifest(data)
+    return json.loads(data)
+
+
+def load_manifest(path: Path) -> Dict:
+    """Read a manifest file in either format"""
+    with open(path, 'rb') as f:
+        return parse_manifest(f.read())
+
+
+def main():
+    """Convert between formats: python -m utils.manifest_codec {encode,decode} SOURCE DEST"""
+    parser = argparse.ArgumentParser(description="d-sync manifest format conversion")
+    parser.add_argument('action', choices=['encode', 'decode'])
+    parser.add_argument('source', type=Path)
+    parser.add_argument('dest', type=Path)
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.source)
+    if args.action == 'encode':
+        data = encode_manifest(manifest)
+        if decode_manifest(data) != manifest:
+            raise SystemExit("Round trip check failed; nothing written")
+    else:
+        data = json.dumps(manifest, indent=2).encode('utf-8')
+    temp_path = args.dest.with_name(args.dest.name + '.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, args.dest)
+    print(f"Wrote {len(data)} bytes to {args.dest} ({os.path.getsize(args.source)} bytes in)")
+
+
+if __name__ == '__main__':
+    main()
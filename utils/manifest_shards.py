@@ -0,0 +1,275 @@
+"""Sharded remote manifest for d-sync"""
+
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from .hashing import HashManager
+from .logger import Logger
+from .manifest_codec import encode_manifest, parse_manifest
+from .config import (
+    FILES_JSON_UPLOAD_META, MANIFEST_SHARD_PREFIX, MANIFEST_ENCODING, WEBHOOK_MAX_ATTACHMENTS, BATCH_MAX_BYTES
+)
+
+logger = Logger(__name__)
+
+MANIFEST_FORMAT = 'd-sync-sharded-manifest'
+MANIFEST_VERSION = 1
+
+
+def shard_of(path: str, prefix_len: int = MANIFEST_SHARD_PREFIX) -> str:
+    """Shard id of a file path: the first hex digits of its SHA-256"""
+    return HashManager.calculate_chunk_hash(path.encode('utf-8'))[:prefix_len]
+
+
+def encode_document(document: Dict, encoding: str = MANIFEST_ENCODING) -> bytes:
+    """Canonical bytes of a shard or root, so unchanged content always hashes the same"""
+    if encoding == 'binary':
+        return encode_manifest(document)
+    return json.dumps(document, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def encode_shard(shard_id: str, files: Dict[str, Dict], encoding: str = MANIFEST_ENCODING) -> bytes:
+    return encode_document({'version': MANIFEST_VERSION, 'shard': shard_id, 'files': files}, encoding)
+
+
+class ShardedManifest:
+    """Remote copy of files.json split into content-addressed shards.
+
+    Files are grouped into shards by path hash prefix. Each shard is uploaded
+    as ``manifest_<shard>_<hash>.dsm`` (``.json`` with the JSON encoding) and
+    a small root index lists every
+    shard's hash and CDN URL. ``sync`` rebuilds only shards touched since the
+    last sync, uploads those whose hash changed (several per message), then
+    updates the root. The state of the whole shard set is kept in
+    ``files_json_remote.json``.
+    """
+
+    def __init__(self, webhook_manager, state_path: Path = FILES_JSON_UPLOAD_META,
+                 prefix_len: int = MANIFEST_SHARD_PREFIX, encoding: str = MANIFEST_ENCODING):
+        self.webhook_manager = webhook_manager
+        self.state_path = state_path
+        self.prefix_len = prefix_len
+        self.encoding = encoding
+        self._suffix = '.dsm' if encoding == 'binary' else '.json'
+        self._members: Dict[str, Set[str]] = {}  # shard id -> file paths
+        self._dirty: Set[str] = set()
+        self._lock = threading.Lock()
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict:
+        state = {}
+        if self.state_path.exists():
+            try:
+                with open(self.state_path, 'r') as f:
+                    state = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Could not read {self.state_path}: {e}")
+        if state.get('format') != MANIFEST_FORMAT:
+            # A monolithic files.json message becomes the root message, which is patched in place
+            legacy = {key: state[key] for key in ('webhook_url', 'message_id', 'cdn_url') if key in state}
+            state = {
+                'format': MANIFEST_FORMAT, 'prefix_len': self.prefix_len,
+                'root': legacy or None, 'shards': {}
+            }
+        if state.get('prefix_len') != self.prefix_len:
+            # Shard boundaries moved; every shard is rebuilt on the next sync
+            state['prefix_len'] = self.prefix_len
+            state['shards'] = {}
+        return state
+
+    def _save_state(self):
+        temp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def touch(self, paths: Iterable[str]):
+        """Mark the shards holding these paths for the next sync"""
+        with self._lock:
+            for path in paths:
+                shard_id = shard_of(path, self.prefix_len)
+                self._members.setdefault(shard_id, set()).add(path)
+                self._dirty.add(shard_id)
+
+    def sync(self, entries_for: Callable[[Iterable[str]], Dict[str, Dict]]) -> Optional[int]:
+        """Upload changed shards and the root; returns bytes sent or None on failure.
+
+        entries_for returns the current entries for a set of paths, omitting
+        paths that are no longer tracked.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            members = {shard_id: set(self._members.get(shard_id, ())) for shard_id in dirty}
+
+        changed: List[Tuple[str, str, bytes, int]] = []  # (shard id, hash, data, file count)
+        removed = []
+        for shard_id in sorted(dirty):
+            entries = entries_for(members[shard_id])
+            with self._lock:
+                self._members[shard_id] = set(entries) | (self._members.get(shard_id, set()) - members[shard_id])
+            if not entries:
+                if shard_id in self.state['shards']:
+                    removed.append(shard_id)
+                continue
+            data = encode_shard(shard_id, entries, self.encoding)
+            digest = HashManager.calculate_chunk_hash(data)
+            current = self.state['shards'].get(shard_id)
+            if not current or current.get('hash') != digest:
+                changed.append((shard_id, digest, data, len(entries)))
+
+        if not changed and not removed and self.state.get('root') and not self.state.get('root_stale'):
+            return 0
+
+        try:
+            # Shards uploaded before a failure stay recorded; the root is republished next time
+            self.state['root_stale'] = True
+            sent = self._upload_shards(changed)
+            if sent is None:
+                raise RuntimeError("shard upload failed")
+            for shard_id in removed:
+                self._retire(self.state['shards'].pop(shard_id))
+            root_sent = self._publish_root()
+            if root_sent is None:
+                raise RuntimeError("root upload failed")
+            self.state['root_stale'] = False
+        except Exception as e:
+            logger.error(f"Remote manifest sync failed: {e}")
+            self._save_state()
+            with self._lock:
+                self._dirty |= dirty
+            return None
+
+        self._delete_retired()
+        self._save_state()
+        logger.info(
+            f"Synced remote manifest: {len(changed)} of {len(self.state['shards'])} shards uploaded, "
+            f"{len(removed)} removed"
+        )
+        return sent + root_sent
+
+    def _upload_shards(self, changed: List[Tuple[str, str, bytes, int]]) -> Optional[int]:
+        """Upload changed shards, several per message; records them in the state"""
+        sent = 0
+        batch: List[Tuple[str, str, bytes, int]] = []
+
+        def send(batch) -> bool:
+            attachments = [(f"manifest_{shard_id}_{digest[:16]}{self._suffix}", data)
+                           for shard_id, digest, data, _ in batch]
+            webhook_url, response = self.webhook_manager.upload_many(attachments)
+            urls = self.webhook_manager.extract_cdn_urls(response) if response else []
+            if len(urls) != len(batch):
+                return False
+            by_name = {a.get('filename'): a.get('url') for a in response.get('attachments', [])}
+            for (name, _), (shard_id, digest, data, count), url in zip(attachments, batch, urls):
+                if shard_id in self.state['shards']:
+                    self._retire(self.state['shards'][shard_id])
+                self.state['shards'][shard_id] = {
+                    'hash': digest, 'files': count, 'size': len(data),
+                    'webhook_url': webhook_url, 'message_id': response.get('id'),
+                    'cdn_url': by_name.get(name, url),
+                }
+            return True
+
+        size = 0
+        for item in changed:
+            if batch and (len(batch) >= WEBHOOK_MAX_ATTACHMENTS or size + len(item[2]) > BATCH_MAX_BYTES):
+                if not send(batch):
+                    return None
+                batch, size = [], 0
+            batch.append(item)
+            size += len(item[2])
+            sent += len(item[2])
+        if batch and not send(batch):
+            return None
+        return sent
+
+    def root_index(self) -> Dict:
+        return {
+            'format': MANIFEST_FORMAT,
+            'version': MANIFEST_VERSION,
+            'prefix_len': self.prefix_len,
+            'last_updated': datetime.now().isoformat(),
+            'file_count': sum(shard['files'] for shard in self.state['shards'].values()),
+            'shards': {
+                shard_id: {key: shard[key] for key in ('hash', 'files', 'size', 'cdn_url', 'webhook_url')}
+                for shard_id, shard in sorted(self.state['shards'].items())
+            },
+        }
+
+    def _publish_root(self) -> Optional[int]:
+        """PATCH the root message in place, or post a new one; returns bytes sent"""
+        data = encode_document(self.root_index(), self.encoding)
+        root = self.state.get('root') or {}
+        if root.get('webhook_url') and root.get('message_id'):
+            response = self.webhook_manager.patch_message(
+                root['webhook_url'], root['message_id'], data=data, filename=f'manifest_root{self._suffix}'
+            )
+            if response:
+                root['cdn_url'] = self.webhook_manager.extract_cdn_url(response)
+                root['last_updated'] = datetime.now().isoformat()
+                return len(data)
+            logger.info("Patching manifest root failed; will upload a new message")
+
+        webhook_url = self.webhook_manager.get_webhook()
+        if not webhook_url:
+            logger.warning("No webhook available to upload the manifest root")
+            return None
+        response = self.webhook_manager.upload_bytes(webhook_url, data, f'manifest_root{self._suffix}')
+        if not response:
+            return None
+        if root.get('webhook_url') and root.get('message_id'):
+            self.webhook_manager.delete_message(root['webhook_url'], root['message_id'])
+        self.state['root'] = {
+            'webhook_url': webhook_url,
+            'message_id': response.get('id'),
+            'cdn_url': self.webhook_manager.extract_cdn_url(response),
+            'last_updated': datetime.now().isoformat(),
+        }
+        logger.info(f"Uploaded manifest root as message {response.get('id')}")
+        return len(data)
+
+    def _retire(self, shard: Dict):
+        """Remember a replaced shard's message for deletion once the new root is live"""
+        if shard.get('message_id'):
+            self.state.setdefault('retired', []).append([shard['webhook_url'], shard['message_id']])
+
+    def _delete_retired(self):
+        """Delete retired messages once no current shard shares them"""
+        current = {
+            (shard['webhook_url'], shard['message_id'])
+            for shard in self.state['shards'].values() if shard.get('message_id')
+        }
+        retired = {tuple(ref) for ref in self.state.get('retired', [])}
+        for webhook_url, message_id in retired - current:
+            try:
+                self.webhook_manager.delete_message(webhook_url, message_id)
+            except Exception:
+                logger.debug(f"Failed to delete old manifest message {message_id}")
+        self.state['retired'] = sorted([list(ref) for ref in retired & current])
+
+
+def load_remote_manifest(transport, root_url: str) -> Optional[Dict[str, Dict]]:
+    """Rebuild the files dict from a remote root index, verifying each shard's hash"""
+    try:
+        response = transport.get(root_url)
+        response.raise_for_status()
+        root = parse_manifest(response.content)
+        if root.get('format') != MANIFEST_FORMAT:
+            # A monolithic files.json
+            return root.get('files', {})
+
+        files: Dict[str, Dict] = {}
+        for shard_id, shard in root.get('shards', {}).items():
+            response = transport.get(shard['cdn_url'])
+            response.raise_for_status()
+            if HashManager.calculate_chunk_hash(response.content) != shard['hash']:
+                logger.error(f"Manifest shard {shard_id} failed hash verification")
+                return None
+            files.update(parse_manifest(response.content).get('files', {}))
+        return files
+    except Exception as e:
+        logger.error(f"Could not load remote manifest: {e}")
+        return None
@@ -0,0 +1,127 @@
+"""Debounced remote manifest synchronisation for d-sync"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+from .logger import Logger
+from .config import MANIFEST_SYNC_INTERVAL
+
+logger = Logger(__name__)
+
+
+class ManifestSync:
+    """Runs a manifest sync in the background at most once per interval.
+
+    Callers ``mark_dirty`` after each metadata change; however many changes
+    arrive, the background thread calls ``sync`` once per ``interval``
+    seconds. ``sync`` returns the number of bytes sent, or None on failure
+    (the manifest stays dirty and is retried next interval). ``flush`` syncs
+    immediately and waits for it; ``close`` flushes and stops the thread.
+    """
+
+    def __init__(self, sync: Callable[[], Optional[int]], interval: float = MANIFEST_SYNC_INTERVAL):
+        self.sync = sync
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._dirty_since: Optional[float] = None  # When the oldest unsynced change happened
+        self._flush_requested = False
+        self._syncing = False
+        self._stopping = False
+        self._next_allowed = 0.0
+        self._attempts = 0
+        self._stats = {
+            'syncs': 0, 'failures': 0, 'changes': 0, 'bytes_sent': 0,
+            'last_lag': 0.0, 'max_lag': 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name='d-sync-manifest', daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        """Note that the manifest changed and needs syncing"""
+        with self._cond:
+            self._stats['changes'] += 1
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Sync pending changes now and wait; returns False if the sync failed or timed out"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._dirty_since is None and not self._syncing:
+                return True
+            # A sync already running may have started before the latest change
+            target = self._attempts + (2 if self._syncing and self._dirty_since is not None else 1)
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._attempts < target and self._thread.is_alive():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._dirty_since is None
+
+    def close(self):
+        """Flush pending changes and stop the background thread"""
+        self.flush()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    if self._dirty_since is not None and (self._flush_requested or now >= self._next_allowed):
+                        break
+                    self._cond.wait(
+                        self._next_allowed - now if self._dirty_since is not None else None
+                    )
+                if self._stopping:
+                    return
+                dirty_since, self._dirty_since = self._dirty_since, None
+                self._flush_requested = False
+                self._syncing = True
+
+            try:
+                sent = self.sync()
+            except Exception as e:
+                logger.error(f"Manifest sync failed: {e}", exc_info=True)
+                sent = None
+
+            with self._cond:
+                now = time.monotonic()
+                self._syncing = False
+                self._attempts += 1
+                self._next_allowed = now + self.interval
+                if sent is None:
+                    self._stats['failures'] += 1
+                    # Keep the original timestamp so lag covers the failed attempt
+                    if self._dirty_since is None or dirty_since < self._dirty_since:
+                        self._dirty_since = dirty_since
+                else:
+                    lag = now - dirty_since
+                    self._stats['syncs'] += 1
+                    self._stats['bytes_sent'] += sent
+                    self._stats['last_lag'] = lag
+                    self._stats['max_lag'] = max(self._stats['max_lag'], lag)
+                self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        """Sync counts, bytes sent and lag (seconds from first change to synced)"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = self._dirty_since is not None
+        stats['last_lag'] = round(stats['last_lag'], 2)
+        stats['max_lag'] = round(stats['max_lag'], 2)
+        return stats
+
+    def log_stats(self):
+        stat = self.stats()
+        logger.info(
+            f"Manifest: {stat['changes']} changes synced in {stat['syncs']} uploads "
+            f"({stat['bytes_sent']} bytes, {stat['failures']} failed), lag {stat['last_lag']}s "
+            f"(max {stat['max_lag']}s){', changes pending' if stat['pending'] else ''}"
+        )
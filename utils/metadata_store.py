@@ -0,0 +1,350 @@
+"""SQLite metadata store for d-sync"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+from .logger import Logger
+from .manifest_codec import encode_manifest, load_manifest
+from .config import METADATA_DB, FILES_JSON, FOLDERS_JSON, D_SYNCED_DIR
+
+logger = Logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    file_hash TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_hash ON files(file_hash);
+CREATE INDEX IF NOT EXISTS files_by_deleted ON files(deleted);
+CREATE INDEX IF NOT EXISTS files_by_updated ON files(updated_at);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_journal (
+    plain_hash TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS upload_journal_by_path ON upload_journal(path);
+CREATE TABLE IF NOT EXISTS upload_requests (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    requested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class MetadataStore:
+    """File and folder metadata in SQLite (WAL mode), shared by the uploader and web server.
+
+    Each entry is one row holding the same dict files.json/folders.json
+    hold, so an upload writes one row instead of rewriting the whole
+    manifest, and writers in other processes are serialised by SQLite.
+    files.json and folders.json are imported on first use and can be
+    exported at any time.
+
+    The upload journal records each self-contained chunk as soon as it is
+    uploaded, until a file entry references it, so an interrupted upload can
+    resume and chunks nothing references can be found.
+    """
+
+    def __init__(self, path: Path = METADATA_DB):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+        self._import_legacy()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit mode; writes go through _transaction
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the database write lock up front"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _file_row(path: str, entry: Dict, now: float) -> tuple:
+        return (path, entry.get('file_hash'), int(bool(entry.get('deleted'))), now,
+                json.dumps(entry, separators=(',', ':')))
+
+    def put_files(self, entries: Dict[str, Dict]):
+        """Insert or replace file entries in one transaction"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO files (path, file_hash, deleted, updated_at, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [self._file_row(path, entry, now) for path, entry in entries.items()]
+            )
+
+    def put_file(self, path: str, entry: Dict):
+        self.put_files({path: entry})
+
+    def get_file(self, path: str) -> Optional[Dict]:
+        row = self._connection().execute("SELECT data FROM files WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all_files(self) -> Dict[str, Dict]:
+        rows = self._connection().execute("SELECT path, data FROM files ORDER BY path")
+        return {path: json.loads(data) for path, data in rows}
+
+    def files_changed_since(self, since: float) -> Dict[str, Dict]:
+        """Entries written at or after a time.time() value, by any process"""
+        rows = self._connection().execute(
+            "SELECT path, data FROM files WHERE updated_at >= ?", (since,)
+        )
+        return {path: json.loads(data) for path, data in rows}
+
+    def find_by_hash(self, file_hash: str, include_deleted: bool = False) -> Dict[str, Dict]:
+        query = "SELECT path, data FROM files WHERE file_hash = ?"
+        if not include_deleted:
+            query += " AND deleted = 0"
+        return {path: json.loads(data) for path, data in self._connection().execute(query, (file_hash,))}
+
+    def mark_deleted(self, path: str) -> bool:
+        """Flag a file as deleted; returns False if it is not tracked"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM files WHERE path = ?", (path,)).fetchone()
+            if not row:
+                return False
+            entry = json.loads(row[0])
+            entry['deleted'] = True
+            conn.execute(
+                "UPDATE files SET deleted = 1, updated_at = ?, data = ? WHERE path = ?",
+                (time.time(), json.dumps(entry, separators=(',', ':')), path)
+            )
+        return True
+
+    def file_count(self, include_deleted: bool = True) -> int:
+        query = "SELECT COUNT(*) FROM files" + ("" if include_deleted else " WHERE deleted = 0")
+        return self._connection().execute(query).fetchone()[0]
+
+    def last_updated(self) -> Optional[str]:
+        """Time of the most recent file write, as an ISO timestamp"""
+        row = self._connection().execute("SELECT MAX(updated_at) FROM files").fetchone()
+        return datetime.fromtimestamp(row[0]).isoformat() if row and row[0] else None
+
+    def put_folder(self, path: str, entry: Dict):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO folders (path, updated_at, data) VALUES (?, ?, ?)",
+                (path, time.time(), json.dumps(entry, separators=(',', ':')))
+            )
+
+    def all_folders(self) -> Dict[str, Dict]:
+        rows = self._connection().execute("SELECT path, data FROM folders ORDER BY path")
+        return {path: json.loads(data) for path, data in rows}
+
+    def get_setting(self, key: str, default=None):
+        """Value of a runtime setting shared between d-sync processes"""
+        row = self._connection().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_setting(self, key: str, value):
+        """Store a JSON-serialisable runtime setting; None removes it"""
+        with self._transaction() as conn:
+            if value is None:
+                conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    (key, json.dumps(value, separators=(',', ':')))
+                )
+
+    def settings(self, prefix: str = '') -> Dict:
+        """All runtime settings whose key starts with prefix"""
+        rows = self._connection().execute(
+            "SELECT key, value FROM settings WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    def request_upload(self, path: str, source: str = 'web'):
+        """Ask the uploader to treat a file as coming from source (its priority class rule)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO upload_requests (path, source, requested_at) VALUES (?, ?, ?)",
+                (path, source, time.time())
+            )
+
+    def upload_requested(self, path: str) -> Optional[str]:
+        """Source an upload of this path was requested from, if any"""
+        row = self._connection().execute("SELECT source FROM upload_requests WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def take_upload_request(self, path: str) -> Optional[str]:
+        """Remove and return the pending upload request for a path"""
+        source = self.upload_requested(path)
+        if source is not None:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM upload_requests WHERE path = ?", (path,))
+        return source
+
+    def journal_chunk(self, path: str, plain_hash: str, record: Dict):
+        """Record an uploaded chunk of a file that is not finished yet"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO upload_journal (plain_hash, path, created_at, data) VALUES (?, ?, ?, ?)",
+                (plain_hash, path, time.time(), json.dumps(record, separators=(',', ':')))
+            )
+
+    def journal_entries(self) -> Dict[str, Dict]:
+        """plain_hash -> {path, created_at, chunk} for every journaled chunk"""
+        rows = self._connection().execute("SELECT plain_hash, path, created_at, data FROM upload_journal")
+        return {
+            plain_hash: {'path': path, 'created_at': created_at, 'chunk': json.loads(data)}
+            for plain_hash, path, created_at, data in rows
+        }
+
+    def settle_journal(self, plain_hashes: Iterable[str]):
+        """Drop journaled chunks that a file entry now references (or that were cleaned up)"""
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM upload_journal WHERE plain_hash = ?", [(h,) for h in plain_hashes])
+
+    def orphaned_journal(self, active: Iterable[str] = ()) -> Dict[str, Dict]:
+        """Journaled chunks no upload will use: their file is gone or was recorded without them.
+
+        Chunks of files that still exist untracked are kept for a resumed
+        upload; ``active`` lists paths being uploaded right now.
+        """
+        active = set(active)
+        tracked = {row[0] for row in self._connection().execute("SELECT path FROM files WHERE deleted = 0")}
+        return {
+            plain_hash: entry for plain_hash, entry in self.journal_entries().items()
+            if entry['path'] not in active
+            and (entry['path'] in tracked or not (D_SYNCED_DIR / entry['path']).is_file())
+        }
+
+    def _import_legacy(self):
+        """Import files.json and folders.json the first time the store is opened"""
+        conn = self._connection()
+        has_files = conn.execute("SELECT 1 FROM files LIMIT 1").fetchone()
+        has_folders = conn.execute("SELECT 1 FROM folders LIMIT 1").fetchone()
+        if not has_files and FILES_JSON.exists():
+            self.import_json(files_json=FILES_JSON)
+        if not has_folders and FOLDERS_JSON.exists():
+            self.import_json(folders_json=FOLDERS_JSON)
+
+    def import_json(self, files_json: Optional[Path] = None, folders_json: Optional[Path] = None):
+        """Load entries from files.json / folders.json, replacing rows with the same path.
+
+        files.json may be in the binary manifest encoding.
+        """
+        if files_json:
+            try:
+                files = load_manifest(files_json).get('files', {})
+                self.put_files(files)
+                logger.info(f"Imported {len(files)} files from {files_json}")
+            except (OSError, ValueError, zlib.error) as e:
+                logger.warning(f"Could not import {files_json}: {e}")
+        if folders_json:
+            try:
+                with open(folders_json, 'r') as f:
+                    folders = json.load(f).get('folders', {})
+                now = time.time()
+                with self._transaction() as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO folders (path, updated_at, data) VALUES (?, ?, ?)",
+                        [(path, now, json.dumps(entry, separators=(',', ':'))) for path, entry in folders.items()]
+                    )
+                logger.info(f"Imported {len(folders)} folders from {folders_json}")
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Could not import {folders_json}: {e}")
+
+    @staticmethod
+    def _write_json(path: Path, data: Dict, binary: bool = False):
+        """Write a manifest atomically so readers never see a partial one"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + '.tmp')
+        if binary:
+            with open(temp_path, 'wb') as f:
+                f.write(encode_manifest(data))
+        else:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+
+    def export_files_json(self, path: Path = FILES_JSON, binary: bool = False) -> int:
+        """Write files.json (or its binary encoding) from the store; returns the number of entries"""
+        files = self.all_files()
+        self._write_json(path, {'last_updated': datetime.now().isoformat(), 'files': files}, binary)
+        return len(files)
+
+    def export_folders_json(self, path: Path = FOLDERS_JSON) -> int:
+        """Write folders.json from the store; returns the number of entries"""
+        folders = self.all_folders()
+        self._write_json(path, {'last_updated': datetime.now().isoformat(), 'folders': folders})
+        return len(folders)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def main():
+    """Import or export files.json/folders.json, or list the upload journal:
+    python -m utils.metadata_store {import,export,journal}
+    """
+    parser = argparse.ArgumentParser(description="d-sync metadata store import/export")
+    parser.add_argument('action', choices=['import', 'export', 'journal'])
+    parser.add_argument('--files', type=Path, default=FILES_JSON, help="files.json path")
+    parser.add_argument('--folders', type=Path, default=FOLDERS_JSON, help="folders.json path")
+    parser.add_argument('--binary', action='store_true', help="export files in the binary manifest encoding")
+    parser.add_argument('--forget-orphans', action='store_true',
+                        help="with journal: drop orphaned chunks from the journal once cleaned up")
+    args = parser.parse_args()
+
+    store = MetadataStore()
+    if args.action == 'import':
+        store.import_json(files_json=args.files, folders_json=args.folders)
+    elif args.action == 'journal':
+        orphans = store.orphaned_journal()
+        for plain_hash, entry in sorted(store.journal_entries().items(), key=lambda item: item[1]['path']):
+            state = 'orphaned' if plain_hash in orphans else 'resumable'
+            created = datetime.fromtimestamp(entry['created_at']).isoformat(timespec='seconds')
+            print(f"{state}\t{entry['path']}\t{entry['chunk'].get('plain_size', 0)}\t{created}\t"
+                  f"{entry['chunk'].get('cdn_url')}")
+        if args.forget_orphans:
+            store.settle_journal(orphans)
+            print(f"Forgot {len(orphans)} orphaned chunks")
+    else:
+        print(f"Exported {store.export_files_json(args.files, args.binary)} files to {args.files}")
+        print(f"Exported {store.export_folders_json(args.folders)} folders to {args.folders}")
+
+
+if __name__ == '__main__':
+    main()
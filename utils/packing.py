@@ -0,0 +1,88 @@
+"""Pack file aggregation for d-sync"""
+
+import threading
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+from .hashing import HashManager
+from .logger import Logger
+from .config import MAX_PARTITION_SIZE
+
+logger = Logger(__name__)
+
+
+class PackBuilder:
+    """Concatenates individually encrypted small files into shared pack blobs.
+
+    ``add`` returns where the data landed in the current pack plus a future
+    for that pack. The future resolves to ``(webhook_url, cdn_url, pack_hash)``
+    once the sealed pack is uploaded, or ``None`` on failure. ``upload`` is
+    called with ``(filename, data)`` and must return a future resolving to
+    ``(webhook_url, cdn_url)`` or ``None``.
+    """
+
+    def __init__(self, upload: Callable[[str, bytes], Future],
+                 max_size: int = int(MAX_PARTITION_SIZE)):
+        self.upload = upload
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        self.packs_sealed = 0
+        self.files_packed = 0
+        self._new_pack()
+
+    def _new_pack(self):
+        self._pack_id = uuid.uuid4().hex
+        self._buffer = bytearray()
+        self._future = Future()
+        self._count = 0
+
+    def add(self, data: bytes) -> Tuple[str, int, int, Future]:
+        """Append data to the open pack; returns (pack_id, offset, length, future)"""
+        sealed = None
+        with self._lock:
+            if self._buffer and len(self._buffer) + len(data) > self.max_size:
+                sealed = self._seal()
+            pack_id, offset, future = self._pack_id, len(self._buffer), self._future
+            self._buffer += data
+            self._count += 1
+            self.files_packed += 1
+
+        if sealed:
+            self._upload(*sealed)
+        return pack_id, offset, len(data), future
+
+    def flush(self):
+        """Seal and upload the open pack if it holds anything"""
+        with self._lock:
+            sealed = self._seal() if self._buffer else None
+        if sealed:
+            self._upload(*sealed)
+
+    def _seal(self) -> Tuple[str, bytes, Future, int]:
+        """Detach the open pack and start a new one; caller must hold the lock"""
+        sealed = (self._pack_id, bytes(self._buffer), self._future, self._count)
+        self.packs_sealed += 1
+        self._new_pack()
+        return sealed
+
+    def _upload(self, pack_id: str, data: bytes, future: Future, count: int):
+        pack_hash = HashManager.calculate_chunk_hash(data)
+        logger.info(f"Uploading pack {pack_id} with {count} files ({len(data)} bytes)")
+
+        def done(upload_future: Future):
+            result: Optional[tuple] = None
+            try:
+                result = upload_future.result()
+            except Exception as e:
+                logger.error(f"Pack {pack_id} upload failed: {e}")
+            if result:
+                future.set_result((result[0], result[1], pack_hash))
+            else:
+                logger.error(f"Failed to upload pack {pack_id}")
+                future.set_result(None)
+
+        try:
+            self.upload(f"pack_{pack_id}.bin", data).add_done_callback(done)
+        except Exception as e:
+            logger.error(f"Could not queue pack {pack_id}: {e}", exc_info=True)
+            future.set_result(None)
@@ -0,0 +1,180 @@
+"""Persistent stat cache for incremental d-sync scans"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .logger import Logger
+from .config import STAT_CACHE_FILE
+
+logger = Logger(__name__)
+
+# Entries modified this recently may change again within the same timestamp
+# tick, so they are not trusted as unchanged (the same "racy" rule git uses)
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class StatCache:
+    """Remembers (inode, size, mtime_ns) for synced files and listings for directories.
+
+    A directory whose mtime is unchanged has the same entries as last time,
+    so if every file in it was already synced the scanner can skip listing it
+    and only descend into its cached subdirectories.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path = STAT_CACHE_FILE):
+        self.path = path
+        self.files: Dict[str, List[int]] = {}  # relative path -> [inode, size, mtime_ns]
+        self.dirs: Dict[str, Dict] = {}  # relative path -> {mtime_ns, listed_ns, files, dirs, complete}
+        self._lock = threading.Lock()
+        self._by_inode: Optional[Dict[tuple, str]] = None
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.files = data.get('files', {})
+                self.dirs = data.get('dirs', {})
+                logger.info(f"Loaded stat cache with {len(self.files)} files")
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Could not read stat cache, rescanning everything: {e}")
+
+    def save(self):
+        """Write the cache atomically"""
+        with self._lock:
+            data = {'version': self.VERSION, 'files': self.files, 'dirs': self.dirs}
+            temp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _key(st: os.stat_result) -> List[int]:
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def file_unchanged(self, relative_path: str, st: os.stat_result) -> bool:
+        """True if the file was synced and its inode, size and mtime still match"""
+        with self._lock:
+            return self.files.get(relative_path) == self._key(st)
+
+    def has_file(self, relative_path: str) -> bool:
+        """True if the file has a stat record, current or not"""
+        with self._lock:
+            return relative_path in self.files
+
+    @staticmethod
+    def _racy(mtime_ns: int, observed_ns: int) -> bool:
+        return mtime_ns > observed_ns - RACY_WINDOW_NS
+
+    def record_file(self, relative_path: str, st: os.stat_result, observed_ns: Optional[int] = None):
+        """Remember a file as synced in the state it had when stat'ed at observed_ns"""
+        if self._racy(st.st_mtime_ns, observed_ns or time.time_ns()):
+            return
+        with self._lock:
+            self.files[relative_path] = self._key(st)
+            self._by_inode = None
+
+    def find_by_stat(self, st: os.stat_result) -> Optional[str]:
+        """Path previously cached with the same inode, size and mtime (a rename candidate)"""
+        with self._lock:
+            if self._by_inode is None:
+                self._by_inode = {tuple(key): path for path, key in self.files.items()}
+            return self._by_inode.get(tuple(self._key(st)))
+
+    def reusable_listing(self, relative_dir: str, st: os.stat_result) -> Optional[Dict]:
+        """Cached listing of a directory if it is unchanged and fully synced"""
+        with self._lock:
+            cached = self.dirs.get(relative_dir)
+        if cached and cached.get('complete') and cached.get('mtime_ns') == st.st_mtime_ns:
+            return cached
+        return None
+
+    def record_listing(self, relative_dir: str, st: os.stat_result,
+                       files: List[str], dirs: List[str]) -> Tuple[List[str], int, int]:
+        """Store a fresh directory listing; it becomes reusable once marked complete.
+
+        Returns (gone, file_delta, dir_delta): the paths of children that
+        disappeared since the last listing, and the change in the number of
+        files and subdirectories. Gone paths stay cached until ``forget`` so
+        moves can still be matched by inode.
+        """
+        with self._lock:
+            previous = self.dirs.get(relative_dir) or self._empty_listing()
+            self.dirs[relative_dir] = {
+                'mtime_ns': st.st_mtime_ns, 'listed_ns': time.time_ns(),
+                'files': files, 'dirs': dirs, 'complete': False
+            }
+        gone = (set(previous['files']) - set(files)) | (set(previous['dirs']) - set(dirs))
+        return (
+            [self.join(relative_dir, name) for name in gone],
+            len(files) - len(previous['files']),
+            len(dirs) - len(previous['dirs'])
+        )
+
+    def add_entry(self, relative_path: str, is_dir: bool = False) -> bool:
+        """Add a path reported by a watcher to its parent's listing; False if already listed.
+
+        The parent's stored mtime no longer matches, so the next scan still
+        lists it and confirms the change.
+        """
+        parent, name = os.path.split(relative_path)
+        with self._lock:
+            names = self.dirs.setdefault(parent, self._empty_listing())['dirs' if is_dir else 'files']
+            if name in names:
+                return False
+            names.append(name)
+            self.dirs[parent]['complete'] = False
+            if is_dir:
+                self.dirs.setdefault(relative_path, self._empty_listing())
+            return True
+
+    def remove_entry(self, relative_path: str) -> Optional[str]:
+        """Drop a path reported removed from its parent's listing.
+
+        Returns 'files' or 'dirs' for the list it was in, or None if unlisted.
+        """
+        parent, name = os.path.split(relative_path)
+        with self._lock:
+            listing = self.dirs.get(parent)
+            for kind in ('files', 'dirs'):
+                if listing and name in listing[kind]:
+                    listing[kind].remove(name)
+                    listing['complete'] = False
+                    return kind
+        return None
+
+    @staticmethod
+    def _empty_listing() -> Dict:
+        return {'mtime_ns': 0, 'listed_ns': 0, 'files': [], 'dirs': [], 'complete': False}
+
+    def forget(self, relative_path: str):
+        """Drop a file, or a directory and everything below it"""
+        prefix = relative_path + os.sep
+        with self._lock:
+            for path in [p for p in self.dirs if p == relative_path or p.startswith(prefix)]:
+                del self.dirs[path]
+            for path in [p for p in self.files if p == relative_path or p.startswith(prefix)]:
+                del self.files[path]
+            self._by_inode = None
+
+    def mark_complete(self, relative_dir: str):
+        """Mark a listing reusable if every file in it has been synced"""
+        with self._lock:
+            cached = self.dirs.get(relative_dir)
+            if cached:
+                cached['complete'] = not self._racy(cached['mtime_ns'], cached['listed_ns']) and all(
+                    self.join(relative_dir, name) in self.files for name in cached['files']
+                )
+
+    @staticmethod
+    def join(relative_dir: str, name: str) -> str:
+        """Relative path of a directory entry, formatted like str(Path)"""
+        return os.path.join(relative_dir, name) if relative_dir else name
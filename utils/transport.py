@@ -0,0 +1,262 @@
+"""Shared HTTP transport for d-sync"""
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .logger import Logger
+from .bandwidth import BandwidthShaper, get_shaper
+from .config import (
+    HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT, HTTP_TIMING_SAMPLES
+)
+
+logger = Logger(__name__)
+
+# Connection setup timings for the request currently running on this thread
+_conn_timings = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    """HTTP connection that records TCP connect time"""
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        sock = super()._new_conn()
+        _conn_timings.tcp = time.perf_counter() - started
+        return sock
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that records TCP connect and TLS handshake time"""
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        sock = super()._new_conn()
+        _conn_timings.tcp = time.perf_counter() - started
+        return sock
+
+    def connect(self):
+        started = time.perf_counter()
+        _conn_timings.tcp = 0.0
+        super().connect()
+        _conn_timings.tls = time.perf_counter() - started - _conn_timings.tcp
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _ShapedBody:
+    """Request body that takes upload bandwidth as the connection reads it"""
+
+    def __init__(self, data: bytes, shaper):
+        self._data = memoryview(data)
+        self._position = 0
+        self._shaper = shaper
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self._data) - self._position
+        block = self._data[self._position:self._position + size].tobytes()
+        self._position += len(block)
+        if block:
+            self._shaper.throttle('upload', len(block))
+        return block
+
+
+class _ShapedStream:
+    """Response stream that takes download bandwidth as its body is read"""
+
+    def __init__(self, raw, shaper):
+        self._raw = raw
+        self._shaper = shaper
+
+    def stream(self, amt: int = 2 ** 16, decode_content=None):
+        for block in self._raw.stream(amt, decode_content=decode_content):
+            self._shaper.throttle('download', len(block))
+            yield block
+
+    def read(self, *args, **kwargs) -> bytes:
+        block = self._raw.read(*args, **kwargs)
+        if block:
+            self._shaper.throttle('download', len(block))
+        return block
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _TimedAdapter(HTTPAdapter):
+    """Adapter whose pools hand out timing-aware connections.
+
+    With a bandwidth shaper, request bodies and response bodies pass through
+    it block by block, so limits and byte counts follow the actual transfer.
+    """
+
+    def __init__(self, *args, shaper=None, **kwargs):
+        self.shaper = shaper
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if self.shaper is not None and isinstance(request.body, bytes) and request.body:
+            request = request.copy()
+            request.body = _ShapedBody(request.body, self.shaper)
+        response = super().send(request, stream=stream, **kwargs)
+        if self.shaper is not None:
+            response.raw = _ShapedStream(response.raw, self.shaper)
+        return response
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class HttpTransport:
+    """Keep-alive HTTP transport shared by uploads, downloads and refreshes.
+
+    Connections are pooled per host, so consecutive chunk requests reuse an
+    open TCP+TLS connection. Each request records connect, TLS, time to first
+    byte and transfer timings. An optional BandwidthShaper rate-limits and
+    counts the bytes sent and received.
+    """
+
+    def __init__(self, pool_connections: int = HTTP_POOL_CONNECTIONS,
+                 pool_maxsize: int = HTTP_POOL_MAXSIZE,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT,
+                 shaper: Optional[BandwidthShaper] = None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.shaper = shaper
+        self.session = requests.Session()
+        adapter = _TimedAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0,
+            shaper=shaper
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=HTTP_TIMING_SAMPLES)
+        self._totals = {
+            'requests': 0, 'new_connections': 0, 'errors': 0,
+            'connect': 0.0, 'tls': 0.0, 'ttfb': 0.0, 'transfer': 0.0,
+        }
+
+    def request(self, method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+        """Send a request over the pooled session and record its timings"""
+        _conn_timings.tcp = None
+        _conn_timings.tls = None
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, url, timeout=timeout or self.timeout, **kwargs
+            )
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._totals['errors'] += 1
+            raise
+        total = time.perf_counter() - started
+
+        connect = _conn_timings.tcp or 0.0
+        tls = _conn_timings.tls or 0.0
+        # elapsed runs from sending the request to parsing the response headers
+        headers_at = response.elapsed.total_seconds() if response.elapsed else total
+        sample = {
+            'method': method.upper(),
+            'host': requests.utils.urlparse(url).hostname,
+            'status': response.status_code,
+            'reused': _conn_timings.tcp is None,
+            'connect': connect,
+            'tls': tls,
+            'ttfb': max(0.0, headers_at - connect - tls),
+            'transfer': max(0.0, total - headers_at),
+            'total': total,
+        }
+        with self._lock:
+            self._samples.append(sample)
+            self._totals['requests'] += 1
+            self._totals['new_connections'] += 0 if sample['reused'] else 1
+            for key in ('connect', 'tls', 'ttfb', 'transfer'):
+                self._totals[key] += sample[key]
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def recent_timings(self) -> list:
+        """Timing samples for the most recent requests"""
+        with self._lock:
+            return list(self._samples)
+
+    def stats(self) -> Dict:
+        """Aggregate request counts and mean timings in seconds"""
+        with self._lock:
+            totals = dict(self._totals)
+        count = max(totals['requests'], 1)
+        return {
+            'requests': totals['requests'],
+            'errors': totals['errors'],
+            'new_connections': totals['new_connections'],
+            'reused_connections': totals['requests'] - totals['new_connections'],
+            'avg_connect': round(totals['connect'] / max(totals['new_connections'], 1), 4),
+            'avg_tls': round(totals['tls'] / max(totals['new_connections'], 1), 4),
+            'avg_ttfb': round(totals['ttfb'] / count, 4),
+            'avg_transfer': round(totals['transfer'] / count, 4),
+        }
+
+    def log_stats(self):
+        """Log a summary of connection reuse and timings"""
+        stat = self.stats()
+        if stat['requests']:
+            logger.info(
+                f"HTTP: {stat['requests']} requests, {stat['reused_connections']} on reused "
+                f"connections, avg connect {stat['avg_connect']}s, TLS {stat['avg_tls']}s, "
+                f"TTFB {stat['avg_ttfb']}s, transfer {stat['avg_transfer']}s"
+            )
+        if self.shaper is not None:
+            self.shaper.log_stats()
+
+    def close(self):
+        self.session.close()
+
+
+_shared_transport: Optional[HttpTransport] = None
+_shared_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """Return the process-wide transport, creating it on first use"""
+    global _shared_transport
+    with _shared_lock:
+        if _shared_transport is None:
+            _shared_transport = HttpTransport(shaper=get_shaper())
+        return _shared_transport
@@ -0,0 +1,202 @@
+"""Concurrent upload pool for d-sync"""
+
+import fnmatch
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional
+from .logger import Logger
+from .config import UPLOAD_CONCURRENCY, UPLOAD_PRIORITY_CLASSES, UPLOAD_DEFAULT_CLASS
+
+logger = Logger(__name__)
+
+
+class UploadPriorities:
+    """Assigns files to the upload priority classes in UPLOAD_PRIORITY_CLASSES"""
+
+    def __init__(self, classes: Optional[List[Dict]] = None):
+        self.classes = classes or UPLOAD_PRIORITY_CLASSES
+        self._rank = {cls['name']: rank for rank, cls in enumerate(self.classes)}
+
+    def weights(self) -> Dict[str, int]:
+        return {cls['name']: max(1, int(cls.get('weight', 1))) for cls in self.classes}
+
+    def rank(self, name: str) -> int:
+        return self._rank.get(name, len(self.classes))
+
+    def classify(self, relative_path: str, size: int, mtime: float, source: str = 'scan') -> str:
+        """Name of the first class whose rules all match (the last class if none do)"""
+        for cls in self.classes:
+            if 'source' in cls and cls['source'] != source:
+                continue
+            if 'max_size' in cls and size > cls['max_size']:
+                continue
+            if 'min_size' in cls and size < cls['min_size']:
+                continue
+            if 'patterns' in cls and not any(fnmatch.fnmatch(relative_path, p) for p in cls['patterns']):
+                continue
+            if 'max_age_days' in cls and time.time() - mtime > cls['max_age_days'] * 86400:
+                continue
+            return cls['name']
+        return self.classes[-1]['name']
+
+
+class UploadPool:
+    """Runs chunk uploads on worker threads, shared fairly between priority classes.
+
+    Each class has its own in-flight window: submitting blocks while it is
+    full, so a producer never holds more than ``2 * max_workers`` partitions
+    of one class in memory, and a full window in one class never blocks
+    another. A free worker takes the next job from the busy class that has
+    been served the fewest bytes relative to its weight, so large uploads
+    keep moving while small ones overtake them.
+    """
+
+    def __init__(self, max_workers: int = UPLOAD_CONCURRENCY, weights: Optional[Dict[str, int]] = None,
+                 default_class: str = UPLOAD_DEFAULT_CLASS):
+        self.max_workers = max(1, int(max_workers))
+        self.weights = dict(weights or {'default': 1})
+        # Jobs without a known class (pack blobs, folder metadata, batches of
+        # those) are small and wanted soon, so they must not queue behind bulk
+        self.default_class = default_class if default_class in self.weights else next(iter(self.weights))
+        self._queues: Dict[str, deque] = {name: deque() for name in self.weights}
+        self._windows = {name: threading.BoundedSemaphore(self.max_workers * 2) for name in self.weights}
+        self._served = {name: 0.0 for name in self.weights}  # Bytes served / weight
+        self._stats = {
+            name: {'jobs': 0, 'bytes': 0, 'wait_seconds': 0.0, 'max_wait': 0.0, 'peak_depth': 0}
+            for name in self.weights
+        }
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f'd-sync-upload_{i}', daemon=True)
+            for i in range(self.max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn: Callable, *args, priority: Optional[str] = None, cost: int = 0, **kwargs) -> Future:
+        """Schedule an upload in a priority class, waiting for a free slot in its window.
+
+        cost is the job's size in bytes, used to share workers between classes.
+        """
+        name = priority if priority in self._queues else self.default_class
+        self._windows[name].acquire()
+        future = Future()
+        future.add_done_callback(lambda _: self._windows[name].release())
+        with self._cond:
+            if self._shutdown:
+                self._windows[name].release()
+                raise RuntimeError("Upload pool has been shut down")
+            queue = self._queues[name]
+            if not queue:
+                # A class that was idle starts level with the busy ones rather than with credit
+                busy = [self._served[other] for other, q in self._queues.items() if q]
+                self._served[name] = max(self._served[name], min(busy, default=self._served[name]))
+            queue.append((future, fn, args, kwargs, max(1, cost), time.monotonic()))
+            stat = self._stats[name]
+            stat['peak_depth'] = max(stat['peak_depth'], len(queue))
+            self._cond.notify()
+        return future
+
+    def most_urgent(self, names: Iterable[Optional[str]]) -> Optional[str]:
+        """Highest priority class among names, or None if none is known"""
+        known = set(names)
+        return next((name for name in self.weights if name in known), None)
+
+    def _next_job(self):
+        """Pop the job of the busy class served least for its weight; caller holds the lock"""
+        name = min((n for n, q in self._queues.items() if q), key=lambda n: self._served[n])
+        future, fn, args, kwargs, cost, queued_at = self._queues[name].popleft()
+        self._served[name] += cost / self.weights[name]
+        waited = time.monotonic() - queued_at
+        stat = self._stats[name]
+        stat['jobs'] += 1
+        stat['bytes'] += cost
+        stat['wait_seconds'] += waited
+        stat['max_wait'] = max(stat['max_wait'], waited)
+        return future, fn, args, kwargs
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not any(self._queues.values()):
+                    self._cond.wait()
+                if not any(self._queues.values()):
+                    return
+                future, fn, args, kwargs = self._next_job()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def depth(self) -> Dict[str, int]:
+        """Jobs waiting for a worker, per class"""
+        with self._cond:
+            return {name: len(queue) for name, queue in self._queues.items()}
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per class: jobs started, their bytes, queue wait (total, average, max), current and peak depth"""
+        with self._cond:
+            stats = {name: dict(stat, depth=len(self._queues[name])) for name, stat in self._stats.items()}
+        for stat in stats.values():
+            stat['avg_wait'] = round(stat['wait_seconds'] / stat['jobs'], 3) if stat['jobs'] else 0.0
+            stat['wait_seconds'] = round(stat['wait_seconds'], 2)
+            stat['max_wait'] = round(stat['max_wait'], 2)
+        return stats
+
+    def log_stats(self):
+        for name, stat in self.stats().items():
+            if stat['jobs'] or stat['depth']:
+                logger.info(
+                    f"Upload queue {name}: {stat['jobs']} jobs ({stat['bytes']} bytes), "
+                    f"wait avg {stat['avg_wait']}s max {stat['max_wait']}s, "
+                    f"depth {stat['depth']} (peak {stat['peak_depth']})"
+                )
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting uploads; queued ones still run. Optionally wait for them"""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def when_all(futures: List[Future], callback: Callable[[], None]):
+    """Call ``callback`` once every future has finished (immediately if there are none)"""
+    if not futures:
+        callback()
+        return
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def then(future: Future, fn: Callable) -> Future:
+    """Return a future resolving to ``fn(result)``; a None result or an error resolves to None"""
+    chained = Future()
+
+    def done(f: Future):
+        try:
+            result = f.result()
+            chained.set_result(fn(result) if result is not None else None)
+        except Exception:
+            chained.set_result(None)
+
+    future.add_done_callback(done)
+    return chained
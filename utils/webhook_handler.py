@@ -2,11 +2,13 @@
 
 import requests
 from pathlib import Path
-from typing import Optional, List, Dict
-import random
+from typing import Callable, Optional, List, Dict, Tuple
 import json
+import time
 from .logger import Logger
-from .config import WEBHOOKS_FILE, WEBHOOK_WAIT_PARAM
+from .config import WEBHOOKS_FILE, WEBHOOK_WAIT_PARAM, RATE_LIMIT_MAX_RETRIES
+from .webhook_scheduler import WebhookScheduler
+from .transport import HttpTransport, get_transport
 
 logger = Logger(__name__)
 
@@ -14,8 +16,10 @@ logger = Logger(__name__)
 class WebhookManager:
     """Manages Discord webhook operations"""
 
-    def __init__(self):
+    def __init__(self, transport: Optional[HttpTransport] = None):
         self.webhooks = self._load_webhooks()
+        self.scheduler = WebhookScheduler(self.webhooks)
+        self.transport = transport or get_transport()
 
     def _load_webhooks(self) -> List[str]:
         """Load webhooks from webhooks.txt"""
@@ -24,81 +28,208 @@ class WebhookManager:
             return []
 
         with open(WEBHOOKS_FILE, 'r') as f:
-            webhooks = [line.strip() for line in f.readlines() if line.strip()]
+            webhooks = [
+                line.strip() for line in f.readlines()
+                if line.strip() and not line.strip().startswith('#')
+            ]
         return webhooks
 
-    def get_random_webhook(self) -> Optional[str]:
-        """Get a random webhook URL"""
+    def get_webhook(self) -> Optional[str]:
+        """Get the webhook that can accept a request soonest"""
         if not self.webhooks:
             logger.error("No webhooks available")
             return None
-        return random.choice(self.webhooks)
+        return self.scheduler.peek()
+
+    # Kept for callers written against the old random selection
+    get_random_webhook = get_webhook
+
+    @staticmethod
+    def _parse_retry_after(response: requests.Response) -> Tuple[float, bool]:
+        """Return (seconds, is_global) from a 429 response"""
+        try:
+            body = response.json()
+            return float(body.get('retry_after', 1.0)), bool(body.get('global', False))
+        except (ValueError, TypeError, AttributeError):
+            pass
+        try:
+            return float(response.headers.get('Retry-After', 1.0)), False
+        except (TypeError, ValueError):
+            return 1.0, False
+
+    def _request(self, method: str, webhook_url: Optional[str], path: str,
+                 build_kwargs: Callable[[], Dict]) -> Tuple[Optional[str], Optional[requests.Response]]:
+        """Send a webhook request through the scheduler, waiting out 429s.
+
+        If ``webhook_url`` is None the scheduler picks the webhook that can take
+        the request soonest, and may switch webhooks after a 429. Returns the
+        webhook used and the final response.
+        """
+        chosen, response = None, None
+        for _ in range(RATE_LIMIT_MAX_RETRIES + 1):
+            chosen = self.scheduler.acquire(webhook_url)
+            if not chosen:
+                logger.error("No webhooks available")
+                return None, None
+
+            started = time.monotonic()
+            response = None
+            try:
+                url = f"{chosen.rstrip('/')}{path}"
+                response = self.transport.request(method, url, **build_kwargs())
+            finally:
+                self.scheduler.release(
+                    chosen,
+                    response.headers if response is not None else None,
+                    response.status_code if response is not None else None,
+                    time.monotonic() - started,
+                )
+
+            if response.status_code != 429:
+                return chosen, response
+            retry_after, is_global = self._parse_retry_after(response)
+            self.scheduler.rate_limited(chosen, retry_after, is_global)
+
+        logger.error(f"Giving up after {RATE_LIMIT_MAX_RETRIES} rate-limited retries")
+        return chosen, response
 
     def upload_file(self, webhook_url: str, file_path: Path, chunk_index: int = 0) -> Optional[Dict]:
         """Upload a file to Discord via webhook"""
+        handles = []
+
+        def build():
+            f = open(file_path, 'rb')
+            handles.append(f)
+            return {'files': {'file': f}}
+
         try:
-            with open(file_path, 'rb') as f:
-                files = {'file': f}
-                # Add wait=true to get full response
-                url = f"{webhook_url.rstrip('/')}{WEBHOOK_WAIT_PARAM}"
-                response = requests.post(url, files=files, timeout=60)
-                response.raise_for_status()
-                return response.json()
+            # Add wait=true to get full response
+            _, response = self._request('POST', webhook_url, WEBHOOK_WAIT_PARAM, build)
+            if response is None:
+                return None
+            response.raise_for_status()
+            return response.json()
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to upload file {file_path}: {e}")
             return None
+        finally:
+            for f in handles:
+                f.close()
 
     def upload_bytes(self, webhook_url: str, data: bytes, filename: str) -> Optional[Dict]:
         """Upload bytes to Discord via webhook"""
         try:
-            files = {'file': (filename, data)}
-            url = f"{webhook_url.rstrip('/')}{WEBHOOK_WAIT_PARAM}"
-            response = requests.post(url, files=files, timeout=60)
+            _, response = self._request(
+                'POST', webhook_url, WEBHOOK_WAIT_PARAM,
+                lambda: {'files': {'file': (filename, data)}}
+            )
+            if response is None:
+                return None
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to upload {filename}: {e}")
             return None
 
-    def extract_cdn_url(self, response: Dict) -> Optional[str]:
-        """Extract CDN URL from Discord webhook response"""
+    def upload_chunk(self, data: bytes, filename: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """Upload bytes to whichever webhook can take them soonest.
+
+        Returns (webhook_url, response JSON); the response is None on failure.
+        """
+        try:
+            webhook_url, response = self._request(
+                'POST', None, WEBHOOK_WAIT_PARAM,
+                lambda: {'files': {'file': (filename, data)}}
+            )
+            if response is None:
+                return webhook_url, None
+            response.raise_for_status()
+            return webhook_url, response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to upload {filename}: {e}")
+            return None, None
+
+    def upload_many(self, attachments: List[Tuple[str, bytes]],
+                    webhook_url: Optional[str] = None) -> Tuple[Optional[str], Optional[Dict]]:
+        """Upload several attachments in one webhook message.
+
+        Returns (webhook_url, response JSON); the response is None on failure.
+        """
         try:
-            if 'attachments' in response and len(response['attachments']) > 0:
-                return response['attachments'][0]['url']
-        except (KeyError, IndexError, TypeError) as e:
+            webhook_url, response = self._request(
+                'POST', webhook_url, WEBHOOK_WAIT_PARAM,
+                lambda: {'files': {
+                    f'files[{index}]': (filename, data)
+                    for index, (filename, data) in enumerate(attachments)
+                }}
+            )
+            if response is None:
+                return webhook_url, None
+            response.raise_for_status()
+            return webhook_url, response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to upload {len(attachments)} attachments: {e}")
+            return None, None
+
+    def extract_cdn_url(self, response: Dict, filename: Optional[str] = None) -> Optional[str]:
+        """Extract CDN URL from Discord webhook response.
+
+        With ``filename`` the matching attachment is returned, otherwise the first.
+        """
+        try:
+            attachments = response.get('attachments') or []
+            if filename is not None:
+                for attachment in attachments:
+                    if attachment.get('filename') == filename:
+                        return attachment['url']
+            if attachments:
+                return attachments[0]['url']
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
             logger.error(f"Failed to extract CDN URL from response: {e}")
         return None
 
+    def extract_cdn_urls(self, response: Dict) -> List[str]:
+        """Extract the CDN URL of every attachment, in upload order"""
+        try:
+            return [attachment['url'] for attachment in response.get('attachments') or []]
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Failed to extract CDN URLs from response: {e}")
+            return []
+
     def patch_message(self, webhook_url: str, message_id: str, file_path: Optional[Path] = None, data: Optional[bytes] = None, filename: Optional[str] = None) -> Optional[Dict]:
         """Patch (edit) a webhook message. Attempts to replace the attachment by PATCHing with a new file.
         Returns the message JSON on success or None on failure."""
-        try:
-            base = webhook_url.rstrip('/')
-            url = f"{base}/messages/{message_id}"
+        handles = []
 
+        def build():
             if file_path is not None:
-                with open(file_path, 'rb') as f:
-                    files = {'file': f}
-                    response = requests.patch(url, files=files, timeout=60)
-            elif data is not None and filename is not None:
-                files = {'file': (filename, data)}
-                response = requests.patch(url, files=files, timeout=60)
-            else:
-                # No file provided, just try to edit the content to touch the message
-                response = requests.patch(url, json={'content': ''}, timeout=60)
+                f = open(file_path, 'rb')
+                handles.append(f)
+                return {'files': {'file': f}}
+            if data is not None and filename is not None:
+                return {'files': {'file': (filename, data)}}
+            # No file provided, just try to edit the content to touch the message
+            return {'json': {'content': ''}}
 
+        try:
+            _, response = self._request('PATCH', webhook_url, f"/messages/{message_id}", build)
+            if response is None:
+                return None
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to patch message {message_id}: {e}")
             return None
+        finally:
+            for f in handles:
+                f.close()
 
     def delete_message(self, webhook_url: str, message_id: str) -> bool:
         """Delete a webhook message. Returns True on success."""
         try:
-            base = webhook_url.rstrip('/')
-            url = f"{base}/messages/{message_id}"
-            response = requests.delete(url, timeout=60)
+            _, response = self._request('DELETE', webhook_url, f"/messages/{message_id}", dict)
+            if response is None:
+                return False
             if response.status_code in (200, 204):
                 return True
             logger.warning(f"Delete message returned status {response.status_code}")
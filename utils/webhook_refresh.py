@@ -6,6 +6,7 @@ import json
 from pathlib import Path
 from .logger import Logger
 from .config import FILES_JSON
+from .transport import get_transport
 
 logger = Logger(__name__)
 
@@ -29,7 +30,7 @@ class WebhookMessageRefresh:
             
             # Get channel ID from webhook
             webhook_info_url = f"https://discord.com/api/webhooks/{webhook_id}/{webhook_token}"
-            response = requests.get(webhook_info_url, timeout=10)
+            response = get_transport().get(webhook_info_url, timeout=10)
             response.raise_for_status()
             webhook_data = response.json()
             
@@ -43,7 +44,7 @@ class WebhookMessageRefresh:
             
             # Note: This requires a bot token, not a webhook token
             # For now, we'll try with webhook token (may fail)
-            response = requests.get(messages_url, timeout=10)
+            response = get_transport().get(messages_url, timeout=10)
             
             if response.status_code == 401:
                 logger.warning("Cannot access channel messages with webhook token")
@@ -69,7 +70,7 @@ class WebhookMessageRefresh:
             
             # Get webhook info (includes channel)
             webhook_info_url = f"https://discord.com/api/webhooks/{webhook_id}/{webhook_token}"
-            response = requests.get(webhook_info_url, timeout=10)
+            response = get_transport().get(webhook_info_url, timeout=10)
             response.raise_for_status()
             webhook_data = response.json()
             
@@ -106,7 +107,7 @@ class WebhookMessageRefresh:
     def test_cdn_url(cdn_url: str) -> bool:
         """Test if CDN URL is still valid"""
         try:
-            response = requests.head(cdn_url, timeout=5, allow_redirects=True)
+            response = get_transport().head(cdn_url, timeout=5, allow_redirects=True)
             return response.status_code == 200
         except requests.exceptions.RequestException:
             return False
@@ -0,0 +1,173 @@
+"""Rate-limit-aware webhook scheduling for d-sync"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+from .logger import Logger
+from .config import WEBHOOK_MAX_IN_FLIGHT
+
+logger = Logger(__name__)
+
+
+class WebhookBucket:
+    """Token bucket state for one webhook, fed by Discord's rate-limit headers"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None  # None until Discord tells us
+        self.reset_at = 0.0  # time.monotonic() when the bucket refills
+        self.in_flight = 0
+        self.last_used = 0.0
+        # Utilisation counters
+        self.requests = 0
+        self.rate_limited = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    @property
+    def label(self) -> str:
+        """Webhook id, safe to log (the token is never included)"""
+        parts = self.url.rstrip('/').split('/')
+        return parts[-2] if len(parts) >= 2 else self.url
+
+    def available_at(self, now: float, max_in_flight: int) -> Optional[float]:
+        """Earliest time this webhook can take a request, or None if it is saturated"""
+        if self.in_flight >= max_in_flight:
+            return None
+        if now >= self.reset_at or self.remaining is None:
+            return now
+        # Requests still in flight have not been counted by Discord yet
+        if self.remaining - self.in_flight > 0:
+            return now
+        return self.reset_at
+
+
+class WebhookScheduler:
+    """Routes requests to the webhook that can accept them soonest.
+
+    Buckets are updated from ``X-RateLimit-*`` headers on every response and
+    from ``retry_after`` on 429s, so callers wait exactly as long as Discord
+    asks instead of failing.
+    """
+
+    def __init__(self, webhooks: List[str], max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._buckets: Dict[str, WebhookBucket] = {url: WebhookBucket(url) for url in webhooks}
+        self._cond = threading.Condition()
+        self._started = time.monotonic()
+
+    def _bucket(self, webhook_url: str) -> WebhookBucket:
+        bucket = self._buckets.get(webhook_url)
+        if bucket is None:
+            # Webhooks outside webhooks.txt (e.g. stored in old metadata) still get tracked
+            bucket = self._buckets[webhook_url] = WebhookBucket(webhook_url)
+        return bucket
+
+    def peek(self) -> Optional[str]:
+        """Return the webhook that could take a request soonest, without reserving it"""
+        with self._cond:
+            if not self._buckets:
+                return None
+            now = time.monotonic()
+            return min(
+                self._buckets.values(),
+                key=lambda b: (b.available_at(now, self.max_in_flight) or float('inf'),
+                               b.in_flight, b.last_used)
+            ).url
+
+    def acquire(self, webhook_url: Optional[str] = None) -> Optional[str]:
+        """Reserve a request slot, waiting until a webhook has capacity.
+
+        With ``webhook_url`` the slot is taken on that webhook; otherwise the
+        webhook that can accept a request soonest is chosen.
+        """
+        with self._cond:
+            if webhook_url is None and not self._buckets:
+                return None
+            wait_start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                candidates = [self._bucket(webhook_url)] if webhook_url else list(self._buckets.values())
+                best, best_at = None, None
+                for bucket in candidates:
+                    at = bucket.available_at(now, self.max_in_flight)
+                    if at is None:
+                        continue
+                    key = (at, bucket.in_flight, bucket.last_used)
+                    if best is None or key < (best_at, best.in_flight, best.last_used):
+                        best, best_at = bucket, at
+
+                if best is not None and best_at <= now:
+                    best.in_flight += 1
+                    best.last_used = now
+                    best.wait_seconds += now - wait_start
+                    return best.url
+
+                # Either every webhook is saturated (wait for a release) or the
+                # soonest one refills at best_at
+                self._cond.wait(None if best is None else best_at - now)
+
+    def release(self, webhook_url: str, headers: Optional[Dict] = None,
+                status_code: Optional[int] = None, elapsed: float = 0.0):
+        """Return a slot and record the rate-limit state reported by Discord"""
+        with self._cond:
+            bucket = self._bucket(webhook_url)
+            bucket.in_flight = max(0, bucket.in_flight - 1)
+            bucket.requests += 1
+            bucket.busy_seconds += elapsed
+            if headers:
+                self._apply_headers(bucket, headers)
+            self._cond.notify_all()
+
+    def rate_limited(self, webhook_url: str, retry_after: float, is_global: bool = False):
+        """Block a webhook (or all of them) for the advertised retry_after"""
+        with self._cond:
+            reset_at = time.monotonic() + max(0.0, retry_after)
+            buckets = self._buckets.values() if is_global else [self._bucket(webhook_url)]
+            for bucket in buckets:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, reset_at)
+            self._bucket(webhook_url).rate_limited += 1
+            self._cond.notify_all()
+        scope = "all webhooks" if is_global else f"webhook {self._bucket(webhook_url).label}"
+        logger.warning(f"Rate limited on {scope}; retrying in {retry_after:.2f}s")
+
+    @staticmethod
+    def _apply_headers(bucket: WebhookBucket, headers: Dict):
+        try:
+            if headers.get('X-RateLimit-Limit') is not None:
+                bucket.limit = int(headers['X-RateLimit-Limit'])
+            if headers.get('X-RateLimit-Remaining') is not None:
+                bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            if headers.get('X-RateLimit-Reset-After') is not None:
+                bucket.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset-After'])
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Ignoring malformed rate-limit headers: {e}")
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-webhook utilisation, keyed by webhook id"""
+        with self._cond:
+            elapsed = max(time.monotonic() - self._started, 1e-9)
+            return {
+                bucket.label: {
+                    'requests': bucket.requests,
+                    'rate_limited': bucket.rate_limited,
+                    'in_flight': bucket.in_flight,
+                    'remaining': bucket.remaining,
+                    'busy_seconds': round(bucket.busy_seconds, 3),
+                    'wait_seconds': round(bucket.wait_seconds, 3),
+                    'utilisation': round(bucket.busy_seconds / (elapsed * self.max_in_flight), 4),
+                }
+                for bucket in self._buckets.values()
+            }
+
+    def log_utilisation(self):
+        """Log a one-line utilisation summary per webhook"""
+        for label, stat in self.stats().items():
+            if stat['requests']:
+                logger.info(
+                    f"Webhook {label}: {stat['requests']} requests, "
+                    f"{stat['rate_limited']} rate limited, "
+                    f"{stat['utilisation']:.1%} utilised, {stat['wait_seconds']}s waited"
+                )